@@ -11,6 +11,12 @@ _ = TranslationStringFactory('arche_pas')
 DEFAULTS = {
     #Allow HTTP? Good for debug reasons, not good for anything else
     'arche_pas.insecure_transport': False,
+    #Record timings and outcome counters, exposed as Prometheus text at /pas_metrics
+    'arche_pas.metrics': False,
+    #Check provider settings files for changes this often, in seconds. 0 disables.
+    'arche_pas.reload_interval': 0,
+    #Reindex users linked to added or removed providers when the application starts
+    'arche_pas.auto_reindex': True,
 }
 
 
@@ -18,6 +24,10 @@ def format_providers(data):
     """ Read configuration option at arche_pas.providers, which should look something like:
         arche_pas.providers.googe_oauth2 /path/to/config.json
         someotherprovider /path/that/config.json
+
+        The same provider may be added several times with a name after the module:
+        arche_pas.providers.gamma:gamma_it /path/to/it.json
+        arche_pas.providers.gamma:gamma_fkit /path/to/fkit.json
     """
     results = {}
     if data is None:
@@ -34,7 +44,7 @@ def format_providers(data):
 
 def includeme(config):
     from os import environ
-    bools = ('arche_pas.insecure_transport',)
+    bools = ('arche_pas.insecure_transport', 'arche_pas.metrics', 'arche_pas.auto_reindex')
     settings = config.registry.settings
     settings['arche_pas.providers'] = providers = format_providers(settings.get('arche_pas.providers', ''))
     if not providers:
@@ -45,18 +55,36 @@ def includeme(config):
             settings[k] = v
     for k in bools:
         settings[k] = asbool(settings[k])
+    settings['arche_pas.reload_interval'] = int(settings['arche_pas.reload_interval'])
     if settings['arche_pas.insecure_transport']:
         environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
         logger.warn('OAuthlib configured to allow insecure transport')
     # FIXME: Make this configurable
     environ["OAUTHLIB_RELAX_TOKEN_SCOPE"] = "1"
+    config.include('.cache')
+    config.include('.after_login')
+    config.include('.audit')
     config.include('.models')
+    config.include('.tokens')
     config.include('.catalog')
     config.include('.views')
     config.include('.schemas')
     config.include('.registration_cases')
-    #Check for providers and include them
-    for provider_name in providers:
-        config.include(provider_name)
+    config.include('.metrics')
+    config.include('.profiling')
+    config.include('.avatars')
+    config.include('.decommission')
+    config.include('.export')
+    config.include('.reindex')
+    config.include('.warmup')
+    config.include('.recorder')
+    config.include('.bearer')
+    #Check for providers and include them, once per module
+    included = set()
+    for spec in providers:
+        module_name = spec.split(':', 1)[0]
+        if module_name not in included:
+            included.add(module_name)
+            config.include(module_name)
     #Translations
     config.add_translation_dirs('arche_pas:locale/')
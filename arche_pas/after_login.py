@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+""" Handlers for work that should happen after a login, but doesn't need to
+    block it. Things like syncing groups or sending notifications.
+
+    Add handlers in your own includeme:
+
+        config.add_pas_after_login(sync_groups)
+
+    Handlers are called with an AfterLogin object. By default they run right
+    after WillLoginEvent within the callback request. With
+
+        arche_pas.after_login.workers = 2
+
+    they're instead queued when the transaction commits and run by background
+    threads, so they don't add to the redirect. They won't run at all if the
+    transaction is aborted. Handlers that must be able to stop the login
+    should still subscribe to WillLoginEvent.
+"""
+from __future__ import unicode_literals
+
+from time import time
+
+import transaction
+from zope.interface import implementer
+
+from arche_pas import logger
+from arche_pas.interfaces import IAfterLoginDispatcher
+from arche_pas.metrics import count_outcome
+from arche_pas.metrics import get_timer
+from arche_pas.workers import BackgroundWorker
+
+
+class AfterLogin(object):
+    """ Passed to handlers. Background handlers have no request or database
+        connection, so only plain values are kept.
+    """
+
+    def __init__(self, registry, userid, provider, first_login=False, timestamp=None):
+        self.registry = registry
+        self.userid = userid
+        self.provider = provider
+        self.first_login = first_login
+        self.timestamp = timestamp is None and time() or timestamp
+
+    def __repr__(self):  # pragma: no coverage
+        return "<AfterLogin %r via %r>" % (self.userid, self.provider)
+
+
+@implementer(IAfterLoginDispatcher)
+class AfterLoginDispatcher(object):
+    """ Runs handlers inline when workers is 0, otherwise after commit in
+        workers background threads. At most queue_size logins wait for a
+        worker, more than that are dropped and logged rather than blocking
+        requests.
+    """
+
+    def __init__(self, workers=0, queue_size=1000):
+        self.handlers = []
+        self.workers = workers
+        self.worker = BackgroundWorker(self.run, 'arche_pas after login', threads=workers, queue_size=queue_size)
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def dispatch(self, info):
+        if not self.handlers:
+            return
+        if not self.workers:
+            self.run(info)
+            return
+        transaction.get().addAfterCommitHook(self._after_commit, args=(info,))
+
+    def _after_commit(self, success, info):
+        if success:
+            self.submit(info)
+
+    def submit(self, info):
+        if not self.worker.submit(info):
+            logger.error("After login queue is full, dropping handlers for %r", info.userid)
+            count_outcome(info.registry, info.provider, 'after_login_dropped')
+
+    def run(self, info):
+        """ Call all handlers. One failing handler doesn't stop the others. """
+        for handler in self.handlers:
+            try:
+                with get_timer(info.registry, info.provider, 'after_login'):
+                    handler(info)
+            except Exception:
+                logger.exception("After login handler %r failed for %r", handler, info.userid)
+
+    def join(self):
+        """ Wait until everything queued has been handled. """
+        self.worker.join()
+
+
+def get_after_login_dispatcher(registry):
+    return registry.getUtility(IAfterLoginDispatcher)
+
+
+def add_pas_after_login(config, handler):
+    """ Add a handler, called with an AfterLogin object when a user logs in through PAS. """
+    dispatcher = get_after_login_dispatcher(config.registry)
+    dispatcher.add_handler(config.maybe_dotted(handler))
+
+
+def includeme(config):
+    settings = config.registry.settings
+    dispatcher = AfterLoginDispatcher(
+        workers=int(settings.get('arche_pas.after_login.workers', 0)),
+        queue_size=int(settings.get('arche_pas.after_login.queue_size', 1000)),
+    )
+    config.registry.registerUtility(dispatcher, IAfterLoginDispatcher)
+    config.add_directive('add_pas_after_login', add_pas_after_login)
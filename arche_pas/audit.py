@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+""" Audit log of PAS logins, registrations, links and unlinks, kept outside
+    the database so logging in doesn't cause any writes.
+
+    Records are appended as JSON lines to one file per day (UTC) in a
+    directory, and only after the transaction that caused them commits.
+    Lines are short and written with O_APPEND, so all workers on a node may
+    share the directory. Files older than keep_days are removed.
+
+        arche_pas.audit.directory = %(here)s/../var/pas_audit
+        arche_pas.audit.keep_days = 90
+
+    Each record has time, event, userid and provider. Time is when the
+    transaction committed. Event is one of login, register, link and unlink.
+"""
+from __future__ import unicode_literals
+
+import json
+import os
+import re
+from threading import Lock
+from time import gmtime
+from time import strftime
+from time import time
+
+import transaction
+from arche.interfaces import IUser
+from zope.interface import implementer
+
+from arche_pas import logger
+from arche_pas.interfaces import IPASAuditLog
+
+
+EVENTS = ('login', 'register', 'link', 'unlink')
+#Events that count as a login for last login times
+LOGIN_EVENTS = ('login', 'register')
+_FILE_RE = re.compile(r'^pas_audit-(\d{8})\.jsonl$')
+CHECKPOINT_NAME = 'last_login.checkpoint'
+
+
+def log_files(directory):
+    """ Audit files in the directory, oldest first. """
+    if not os.path.isdir(directory):
+        return []
+    return sorted(x for x in os.listdir(directory) if _FILE_RE.match(x))
+
+
+@implementer(IPASAuditLog)
+class AuditLog(object):
+
+    def __init__(self, directory, keep_days=90, clock=time):
+        self.directory = directory
+        self.keep_days = keep_days
+        self.clock = clock
+        self._lock = Lock()
+        self._pruned = None
+        self.reader = AuditReader(directory)
+
+    def filename(self, timestamp):
+        return 'pas_audit-%s.jsonl' % strftime('%Y%m%d', gmtime(timestamp))
+
+    def write(self, records):
+        """ Append records, one write per file. """
+        by_file = {}
+        for record in records:
+            by_file.setdefault(self.filename(record['time']), []).append(
+                json.dumps(record, separators=(',', ':'), sort_keys=True) + '\n')
+        with self._lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            for (name, lines) in by_file.items():
+                fd = os.open(os.path.join(self.directory, name), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+                try:
+                    os.write(fd, ''.join(lines).encode('utf-8'))
+                finally:
+                    os.close(fd)
+            self.prune()
+
+    def prune(self):
+        """ Remove files older than keep_days, at most once per day. """
+        if not self.keep_days:
+            return
+        today = self.filename(self.clock())
+        if self._pruned == today:
+            return
+        self._pruned = today
+        oldest = self.filename(self.clock() - self.keep_days * 86400)
+        for name in log_files(self.directory):
+            if name < oldest:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    #Another worker may have removed it
+                    pass
+
+
+def audit_event(request, event, userid, provider):
+    """ Record event for userid when the current transaction commits.
+        Does nothing unless the audit log is enabled.
+    """
+    assert event in EVENTS
+    audit_log = request.registry.queryUtility(IPASAuditLog)
+    if audit_log is None:
+        return
+    txn = transaction.get()
+    try:
+        records = txn.data(audit_log)
+    except KeyError:
+        records = []
+        txn.set_data(audit_log, records)
+        txn.addAfterCommitHook(_write_after_commit, (audit_log, records))
+    records.append({'event': event, 'userid': userid, 'provider': provider})
+
+
+def _write_after_commit(success, audit_log, records):
+    if not success or not records:
+        return
+    #Stamped after commit so a reader that checkpointed a later time can't miss them
+    now = round(audit_log.clock(), 3)
+    for record in records:
+        record['time'] = now
+    try:
+        audit_log.write(records)
+    except (IOError, OSError):
+        #The login has already happened, so losing the record is better than failing
+        logger.exception("Couldn't write %s records to the PAS audit log", len(records))
+
+
+class _FileIndex(object):
+    """ Offsets of lines per userid and provider in one file. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.scanned = 0
+        self.users = {}
+        self.providers = {}
+
+    def update(self):
+        with open(self.filename, 'rb') as f:
+            f.seek(self.scanned)
+            offset = self.scanned
+            for line in iter(f.readline, b''):
+                if not line.endswith(b'\n'):
+                    #Still being written, read it next time
+                    break
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    logger.warning("Skipping broken line at %s in %s", offset, self.filename)
+                else:
+                    self.users.setdefault(record.get('userid'), []).append(offset)
+                    self.providers.setdefault(record.get('provider'), []).append(offset)
+                offset += len(line)
+            self.scanned = offset
+
+    def read(self, offsets):
+        with open(self.filename, 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                yield json.loads(f.readline().decode('utf-8'))
+
+
+class AuditReader(object):
+    """ Answers per user and per provider queries from an index of line offsets
+        kept in memory. Each query only reads what's been written since the last one.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._files = {}
+        self._lock = Lock()
+
+    def refresh(self):
+        with self._lock:
+            names = log_files(self.directory)
+            for name in set(self._files) - set(names):
+                del self._files[name]
+            for name in names:
+                if name not in self._files:
+                    self._files[name] = _FileIndex(os.path.join(self.directory, name))
+                self._files[name].update()
+            return [self._files[x] for x in names]
+
+    def _query(self, attr, key, limit):
+        count = 0
+        for file_index in reversed(self.refresh()):
+            offsets = getattr(file_index, attr).get(key, ())
+            for record in file_index.read(reversed(offsets)):
+                yield record
+                count += 1
+                if limit and count >= limit:
+                    return
+
+    def for_user(self, userid, limit=None):
+        """ Records for userid, newest first. """
+        return self._query('users', userid, limit)
+
+    def for_provider(self, provider, limit=None):
+        """ Records for provider, newest first. """
+        return self._query('providers', provider, limit)
+
+    def last_login(self, userid, provider=None):
+        """ Time of the latest login, optionally through provider, or None. """
+        for record in self.for_user(userid):
+            if record['event'] in LOGIN_EVENTS and provider in (None, record['provider']):
+                return record['time']
+
+
+def iter_records(directory, position=None):
+    """ Yield (record, position) for complete lines after position, oldest first.
+        Position is (filename, offset) of the end of that record.
+    """
+    after_name, after_offset = position or (None, 0)
+    for name in log_files(directory):
+        if after_name is not None and name < after_name:
+            continue
+        offset = after_offset if name == after_name else 0
+        with open(os.path.join(directory, name), 'rb') as f:
+            f.seek(offset)
+            for line in iter(f.readline, b''):
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                yield record, (name, offset)
+
+
+def collect_last_logins(records, results=None):
+    """ Latest login time per userid and provider: {userid: {provider: time}}
+        Pass results to add to an existing dict.
+    """
+    if results is None:
+        results = {}
+    for record in records:
+        if record.get('event') not in LOGIN_EVENTS:
+            continue
+        logins = results.setdefault(record['userid'], {})
+        if record['time'] > logins.get(record['provider'], 0):
+            logins[record['provider']] = record['time']
+    return results
+
+
+def get_last_login(user, provider=None):
+    """ Last login time stored on the user by the aggregate script, or None.
+        Without provider it's the latest login through any of them.
+    """
+    logins = getattr(user, '__pas_last_login__', None) or {}
+    if provider is None:
+        return logins and max(logins.values()) or None
+    return logins.get(provider, None)
+
+
+def set_last_logins(user, logins):
+    """ Store newer login times. Returns True if anything changed. """
+    assert IUser.providedBy(user)
+    current = getattr(user, '__pas_last_login__', None) or {}
+    updated = dict(current)
+    for (provider, timestamp) in logins.items():
+        if timestamp > updated.get(provider, 0):
+            updated[provider] = timestamp
+    if updated != current:
+        #Replaced rather than changed, so the user is marked as changed
+        user.__pas_last_login__ = updated
+        return True
+    return False
+
+
+def load_position(directory):
+    filename = os.path.join(directory, CHECKPOINT_NAME)
+    if not os.path.isfile(filename):
+        return None
+    with open(filename) as f:
+        data = json.load(f)
+    return data['file'], data['offset']
+
+
+def save_position(directory, position):
+    filename = os.path.join(directory, CHECKPOINT_NAME)
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'file': position[0], 'offset': position[1], 'saved': time()}, f)
+    os.rename(tmp, filename)
+
+
+def get_audit_reader(registry):
+    """ Shared reader for the configured directory, or None if the audit log is disabled. """
+    audit_log = registry.queryUtility(IPASAuditLog)
+    if audit_log is not None:
+        return audit_log.reader
+
+
+def includeme(config):
+    settings = config.registry.settings
+    directory = settings.get('arche_pas.audit.directory', '')
+    if not directory:
+        return
+    audit_log = AuditLog(directory, keep_days=int(settings.get('arche_pas.audit.keep_days', 90)))
+    config.registry.registerUtility(audit_log, IPASAuditLog)
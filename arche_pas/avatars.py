@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import os
+from contextlib import closing
+from hashlib import sha1
+from io import BytesIO
+from os.path import isdir
+from os.path import isfile
+from os.path import join
+
+from arche.interfaces import IUser
+from arche.security import PERM_VIEW
+from pyramid.httpexceptions import HTTPFound
+from pyramid.httpexceptions import HTTPNotFound
+from six.moves.urllib.parse import urlparse
+
+from arche_pas import logger
+from arche_pas.exceptions import ProviderConfigError
+from arche_pas.interfaces import IPASProvider
+from arche_pas.interfaces import IProviderData
+
+
+DEFAULT_SIZES = (32, 64, 128)
+#Don't download anything larger than this
+MAX_SOURCE_BYTES = 5 * 1024 * 1024
+ONE_YEAR = 365 * 24 * 60 * 60
+
+
+class AvatarCache(object):
+    """ Stores resized variants of provider profile images on disk.
+
+        Images are named by a hash of their content and size, so they never change
+        and can be cached forever. An index file per user and provider keeps track of
+        which source URL the images came from, so they're only fetched again when
+        the URL changes.
+    """
+
+    def __init__(self, directory, sizes=DEFAULT_SIZES, timeout=10):
+        self.directory = directory
+        self.sizes = tuple(sorted(sizes))
+        self.timeout = timeout
+        self.image_dir = join(directory, 'images')
+        self.index_dir = join(directory, 'index')
+        for d in (self.image_dir, self.index_dir):
+            if not isdir(d):
+                os.makedirs(d)
+
+    def closest_size(self, size):
+        for s in self.sizes:
+            if s >= size:
+                return s
+        return self.sizes[-1]
+
+    def filename(self, content_hash, size):
+        return "%s-%s.png" % (content_hash, size)
+
+    def _index_path(self, userid, provider_name):
+        key = "%s:%s" % (userid, provider_name)
+        return join(self.index_dir, sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def _write(self, path, data):
+        """ Write atomically, other workers may read at the same time. """
+        tmp = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def lookup(self, userid, provider_name, source_url):
+        """ Return the content hash if the stored images came from source_url. """
+        try:
+            with open(self._index_path(userid, provider_name)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if entry.get('source') != source_url:
+            return None
+        content_hash = entry.get('hash')
+        if not isfile(join(self.image_dir, self.filename(content_hash, self.sizes[-1]))):
+            return None
+        return content_hash
+
+    def fetch(self, userid, provider_name, source_url):
+        """ Download source_url, store all sizes and return the content hash. """
+        import requests
+        #Redirects could lead anywhere, source_url was checked by image_url_allowed
+        with closing(requests.get(source_url, timeout=self.timeout, stream=True,
+                                  allow_redirects=False)) as response:
+            response.raise_for_status()
+            if response.status_code != 200:
+                raise ValueError("Profile image at %s answered %s" % (source_url, response.status_code))
+            content = response.raw.read(MAX_SOURCE_BYTES + 1, decode_content=True)
+        if len(content) > MAX_SOURCE_BYTES:
+            raise ValueError("Profile image at %s is too large" % source_url)
+        content_hash = sha1(content).hexdigest()
+        if not isfile(join(self.image_dir, self.filename(content_hash, self.sizes[-1]))):
+            for (size, data) in self.resize(content):
+                self._write(join(self.image_dir, self.filename(content_hash, size)), data)
+        entry = json.dumps({'source': source_url, 'hash': content_hash})
+        self._write(self._index_path(userid, provider_name), entry.encode('utf-8'))
+        return content_hash
+
+    def resize(self, content):
+        from PIL import Image
+        from PIL import ImageOps
+        img = Image.open(BytesIO(content))
+        img = img.convert('RGBA')
+        for size in self.sizes:
+            variant = ImageOps.fit(img, (size, size), Image.LANCZOS)
+            out = BytesIO()
+            variant.save(out, 'PNG', optimize=True)
+            yield size, out.getvalue()
+
+    def get(self, userid, provider_name, source_url):
+        content_hash = self.lookup(userid, provider_name, source_url)
+        if content_hash is None:
+            content_hash = self.fetch(userid, provider_name, source_url)
+        return content_hash
+
+
+def image_url_allowed(url, hosts):
+    """ Only https URLs on one of hosts, or a subdomain of them. """
+    parts = urlparse(url)
+    if parts.scheme != 'https' or not parts.hostname:
+        return False
+    hostname = parts.hostname.lower()
+    for host in hosts:
+        if hostname == host or hostname.endswith('.' + host):
+            return True
+    return False
+
+
+def get_profile_image_source(request, user, provider_name=None):
+    """ Return (provider_name, url) of the first linked provider with an image.
+        Images not allowed by the providers image_hosts are skipped.
+    """
+    provider_data = IProviderData(user)
+    names = provider_name and [provider_name] or sorted(provider_data)
+    for name in names:
+        provider = request.registry.queryAdapter(request, IPASProvider, name=name)
+        if provider is None or name not in provider_data:
+            continue
+        url = provider.get_profile_image(provider_data[name])
+        if not url:
+            continue
+        if image_url_allowed(url, provider.image_hosts):
+            return name, url
+        logger.warning("Profile image %r from %s isn't on an allowed host", url, name)
+    return None, None
+
+
+def avatar_url(request, user, size=64, provider_name=None):
+    query = {'size': size}
+    if provider_name:
+        query['provider'] = provider_name
+    return request.resource_url(user, 'pas_avatar', query=query)
+
+
+def avatar_view(context, request):
+    """ Redirect to the cached image of the requested size. The redirect itself
+        is only cached briefly since the image may change.
+    """
+    cache = request.registry.pas_avatar_cache
+    try:
+        size = cache.closest_size(int(request.GET.get('size', 64)))
+    except ValueError:
+        size = cache.closest_size(64)
+    provider_name, source_url = get_profile_image_source(
+        request, context, request.GET.get('provider', None))
+    if source_url is None:
+        raise HTTPNotFound()
+    try:
+        content_hash = cache.get(context.userid, provider_name, source_url)
+    except Exception:
+        logger.exception("Couldn't cache profile image from %s", source_url)
+        #Better than no image at all
+        response = HTTPFound(location=source_url)
+    else:
+        filename = cache.filename(content_hash, size)
+        response = HTTPFound(location=request.static_url(join(cache.image_dir, filename)))
+    response.cache_control.max_age = 300
+    return response
+
+
+def includeme(config):
+    """ Cache profile images on disk. Requires Pillow.
+
+        arche_pas.avatars.directory = %(here)s/../var/pas_avatars
+        arche_pas.avatars.sizes = 32 64 128
+    """
+    settings = config.registry.settings
+    directory = settings.get('arche_pas.avatars.directory', '')
+    if not directory:
+        return
+    try:
+        import PIL
+    except ImportError:  # pragma: no coverage
+        raise ProviderConfigError("arche_pas.avatars.directory is set but Pillow isn't installed.")
+    sizes = [int(x) for x in settings.get('arche_pas.avatars.sizes', '').split()] or DEFAULT_SIZES
+    config.registry.pas_avatar_cache = cache = AvatarCache(directory, sizes=sizes)
+    config.add_static_view('pas_avatars', cache.image_dir, cache_max_age=ONE_YEAR)
+    config.add_view(avatar_view, context=IUser, name='pas_avatar', permission=PERM_VIEW)
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+""" Authentication with access tokens from a provider, sent as 'Authorization: Bearer <token>'.
+
+    The policy wraps the one already configured. Requests without a bearer
+    token are handled by the wrapped policy as before.
+"""
+from __future__ import unicode_literals
+
+import json
+from hashlib import sha256
+from time import time
+
+from pyramid.interfaces import IAuthenticationPolicy
+from pyramid.interfaces import PHASE3_CONFIG
+from pyramid.security import Authenticated
+from pyramid.security import Everyone
+from six import string_types
+from zope.interface import implementer
+
+from arche_pas import logger
+from arche_pas.cache import get_cache
+from arche_pas.exceptions import ProviderConfigError
+from arche_pas.interfaces import IPASProvider
+from arche_pas.interfaces import ITokenValidator
+
+
+#Key in request.environ for the result, the policy is asked several times per request
+_ENVIRON_KEY = 'arche_pas.bearer.userid'
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, string_types):
+        return [value]
+    return list(value)
+
+
+@implementer(ITokenValidator)
+class IntrospectionValidator(object):
+    """ RFC 7662 token introspection, with the providers client credentials.
+        Only tokens issued to the audience are accepted, which is the providers
+        client_id unless arche_pas.bearer.audience is set. Tokens for other
+        clients of the same provider are active too, but mustn't work here.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def __call__(self, provider, token):
+        uri = self.settings.get('introspection_uri', None) or provider.settings.get('introspection_uri', None)
+        if not uri:
+            raise ProviderConfigError("No introspection_uri configured for %r" % provider.name)
+        session = provider.oauth2_session(provider.settings['client_id'])
+        response = session.post(
+            uri,
+            data={'token': token, 'token_type_hint': 'access_token'},
+            auth=(provider.settings['client_id'], provider.settings['client_secret']),
+            timeout=self.settings['timeout'],
+        )
+        response.raise_for_status()
+        data = response.json()
+        if not data.get('active', False):
+            return None
+        audience = self.settings.get('audience', None) or provider.settings['client_id']
+        if audience not in _as_list(data.get('aud', None)) and data.get('client_id', None) != audience:
+            return None
+        issuer = self.settings.get('issuer', None)
+        if issuer and data.get('iss', None) != issuer:
+            return None
+        ident = data.get(provider.id_key, None) or data.get('sub', None)
+        return ident, data.get('exp', None)
+
+
+@implementer(ITokenValidator)
+class JWTValidator(object):
+    """ Verify JWT access tokens locally against the providers published keys.
+        Requires PyJWT and cryptography.
+    """
+    #Refetch keys at most this often, for instance when an unknown key id shows up
+    jwks_max_age = 300
+
+    def __init__(self, settings):
+        self.settings = settings
+        try:
+            import jwt
+        except ImportError:  # pragma: no coverage
+            raise ProviderConfigError("JWT validation requires PyJWT and cryptography.")
+        if not settings.get('jwks_uri', None):
+            raise ProviderConfigError("arche_pas.bearer.jwks_uri must be set for JWT validation")
+        self.keys = {}
+        self.keys_fetched = 0
+
+    def get_key(self, kid):
+        from jwt.algorithms import RSAAlgorithm
+        if kid not in self.keys and time() - self.keys_fetched > self.jwks_max_age:
+            import requests
+            response = requests.get(self.settings['jwks_uri'], timeout=self.settings['timeout'])
+            response.raise_for_status()
+            keys = {}
+            for jwk in response.json().get('keys', ()):
+                keys[jwk.get('kid', None)] = RSAAlgorithm.from_jwk(json.dumps(jwk))
+            #Replace in one go, other threads may be reading
+            self.keys = keys
+            self.keys_fetched = time()
+        return self.keys.get(kid, None)
+
+    def __call__(self, provider, token):
+        import jwt
+        try:
+            kid = jwt.get_unverified_header(token).get('kid', None)
+        except jwt.InvalidTokenError:
+            return None
+        key = self.get_key(kid)
+        if key is None:
+            return None
+        try:
+            claims = jwt.decode(
+                token, key,
+                algorithms=['RS256'],
+                audience=self.settings.get('audience', None) or provider.settings['client_id'],
+                issuer=self.settings.get('issuer', None),
+            )
+        except jwt.InvalidTokenError:
+            return None
+        return claims.get(provider.id_key, None) or claims.get('sub', None), claims.get('exp', None)
+
+
+#There's no profile endpoint mode, a profile response doesn't say which client the token was issued to
+VALIDATORS = {
+    'introspection': IntrospectionValidator,
+    'jwt': JWTValidator,
+}
+
+
+@implementer(IAuthenticationPolicy)
+class BearerAuthenticationPolicy(object):
+    """ Accepts bearer tokens from one provider, and hands everything else to wrapped.
+
+        Results are cached in the PAS cache by a hash of the token. Valid tokens
+        are cached until they expire, or for positive_ttl seconds if the expiry
+        isn't known. Invalid and expired ones for negative_ttl seconds. Failed
+        validations aren't cached.
+    """
+
+    def __init__(self, wrapped, provider_name, validator, positive_ttl=300, negative_ttl=60):
+        self.wrapped = wrapped
+        self.provider_name = provider_name
+        self.validator = validator
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+
+    def get_token(self, request):
+        auth = request.headers.get('Authorization', '')
+        if auth[:7].lower() == 'bearer ':
+            return auth[7:].strip() or None
+
+    def bearer_userid(self, request):
+        """ Userid for the token, or None. Only called when a token was sent. """
+        if _ENVIRON_KEY in request.environ:
+            return request.environ[_ENVIRON_KEY]
+        token = self.get_token(request)
+        cache = get_cache(request.registry)
+        key = 'bearer:%s:%s' % (self.provider_name, sha256(token.encode('utf-8')).hexdigest())
+        cached = cache.get(key, None)
+        if cached is not None:
+            userid = cached['userid']
+        else:
+            userid = self.validate(request, token, cache, key)
+        request.environ[_ENVIRON_KEY] = userid
+        return userid
+
+    def validate(self, request, token, cache, key):
+        provider = request.registry.queryAdapter(request, IPASProvider, name=self.provider_name)
+        if provider is None:
+            raise ProviderConfigError("Bearer tokens are set to use provider %r, "
+                                      "but it isn't configured" % self.provider_name)
+        try:
+            with provider.timer('bearer'):
+                result = self.validator(provider, token)
+        except Exception:
+            logger.exception("Validating bearer token with %s failed", self.provider_name)
+            return None
+        userid = None
+        ttl = self.negative_ttl
+        if result is not None and result[0]:
+            (ident, expires_at) = result
+            #Valid until it expires, positive_ttl is only a fallback when we don't know when that is
+            if expires_at is None:
+                valid_ttl = self.positive_ttl
+            else:
+                #Less than a second left is treated as expired, it can't be cached for less
+                valid_ttl = int(expires_at - time())
+            if valid_ttl > 0:
+                user = provider.get_user(ident)
+                if user is not None:
+                    userid = user.userid
+                    ttl = valid_ttl
+        provider.count(userid and 'bearer_valid' or 'bearer_invalid')
+        #A ttl of 0 would mean no expiry
+        if ttl > 0:
+            cache.set(key, {'userid': userid}, ttl=ttl)
+        return userid
+
+    def unauthenticated_userid(self, request):
+        if self.get_token(request) is None:
+            return self.wrapped.unauthenticated_userid(request)
+        return self.bearer_userid(request)
+
+    def authenticated_userid(self, request):
+        if self.get_token(request) is None:
+            return self.wrapped.authenticated_userid(request)
+        userid = self.bearer_userid(request)
+        if userid is not None and self._groups(userid, request) is not None:
+            return userid
+
+    def _groups(self, userid, request):
+        callback = getattr(self.wrapped, 'callback', None)
+        if callback is None:
+            return []
+        return callback(userid, request)
+
+    def effective_principals(self, request):
+        if self.get_token(request) is None:
+            return self.wrapped.effective_principals(request)
+        principals = [Everyone]
+        userid = self.bearer_userid(request)
+        if userid is not None:
+            groups = self._groups(userid, request)
+            if groups is not None:
+                principals.extend([Authenticated, userid])
+                principals.extend(groups)
+        return principals
+
+    def remember(self, request, userid, **kw):
+        return self.wrapped.remember(request, userid, **kw)
+
+    def forget(self, request):
+        return self.wrapped.forget(request)
+
+
+def includeme(config):
+    """ Accept bearer tokens from a provider. Settings:
+
+        arche_pas.bearer.provider = gamma
+        # introspection or jwt
+        arche_pas.bearer.validation = introspection
+        # Defaults to 'introspection_uri' in the providers settings file
+        arche_pas.bearer.introspection_uri = https://gamma.example.com/oauth2/introspect
+        # For jwt
+        arche_pas.bearer.jwks_uri = https://gamma.example.com/oauth2/jwks
+        arche_pas.bearer.issuer = https://gamma.example.com
+        # Tokens must be issued to this client, defaults to the providers client_id
+        arche_pas.bearer.audience =
+        # Valid tokens are cached until they expire. This is only used when
+        # the provider doesn't say when that is.
+        arche_pas.bearer.positive_ttl = 300
+        arche_pas.bearer.negative_ttl = 60
+        arche_pas.bearer.timeout = 5
+    """
+    settings = config.registry.settings
+    provider_name = settings.get('arche_pas.bearer.provider', '')
+    if not provider_name:
+        return
+    validation = settings.get('arche_pas.bearer.validation', 'introspection')
+    if validation not in VALIDATORS:
+        raise ProviderConfigError("arche_pas.bearer.validation must be one of %s" % ", ".join(VALIDATORS))
+    validator_settings = {'timeout': float(settings.get('arche_pas.bearer.timeout', 5))}
+    for k in ('introspection_uri', 'jwks_uri', 'issuer', 'audience'):
+        validator_settings[k] = settings.get('arche_pas.bearer.%s' % k, None)
+    validator = VALIDATORS[validation](validator_settings)
+
+    def register():
+        wrapped = config.registry.queryUtility(IAuthenticationPolicy)
+        if wrapped is None:
+            raise ProviderConfigError("Bearer tokens need an existing authentication policy to wrap")
+        policy = BearerAuthenticationPolicy(
+            wrapped, provider_name, validator,
+            positive_ttl=int(settings.get('arche_pas.bearer.positive_ttl', 300)),
+            negative_ttl=int(settings.get('arche_pas.bearer.negative_ttl', 60)),
+        )
+        config.registry.registerUtility(policy, IAuthenticationPolicy)
+
+    #After the policy we're wrapping has been set
+    config.action('arche_pas.bearer', register, order=PHASE3_CONFIG + 1)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+""" Import of provider links for existing users, from CSV or JSON lines.
+
+    Each record needs 'userid' or 'email', 'provider' and 'ident'. Any other
+    fields are stored as profile data for that provider. CSV example:
+
+        email,provider,ident,nick
+        jane@example.com,gamma,cid123,jane
+"""
+from __future__ import unicode_literals
+
+import csv
+import io
+import json
+
+from six import PY2
+from six import text_type
+
+from arche_pas.interfaces import IPASProvider
+from arche_pas.interfaces import IProviderData
+
+
+#Fields that aren't stored as profile data
+RECORD_KEYS = ('userid', 'email', 'provider', 'ident')
+
+
+class RecordError(Exception):
+    """ A record couldn't be imported. """
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def iter_csv(fileobj):
+    """ Yield (line number, record) from a CSV file with a header row. """
+    reader = csv.DictReader(fileobj)
+    for row in reader:
+        #Extra columns end up under None, missing ones have None as value
+        yield reader.line_num, dict((_decode(k), _decode(v)) for (k, v) in row.items()
+                                    if k is not None and v is not None)
+
+
+def iter_jsonl(fileobj):
+    """ Yield (line number, record) from a file with one JSON object per line.
+        Broken lines are yielded as a RecordError instead of a record.
+    """
+    for (num, line) in enumerate(fileobj, 1):
+        line = _decode(line).strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            yield num, RecordError("Invalid JSON: %s" % exc)
+            continue
+        if not isinstance(record, dict):
+            yield num, RecordError("Expected a JSON object")
+            continue
+        yield num, record
+
+
+def read_records(filename, fmt=None):
+    """ Stream records from filename. fmt is 'csv' or 'jsonl', guessed from the
+        file extension if it isn't given.
+    """
+    if fmt is None:
+        fmt = filename.lower().endswith('.csv') and 'csv' or 'jsonl'
+    if fmt == 'csv':
+        #The csv module wants bytes on Python 2
+        f = PY2 and open(filename, 'rb') or io.open(filename, 'r', encoding='utf-8', newline='')
+        reader = iter_csv
+    elif fmt == 'jsonl':
+        f = io.open(filename, 'r', encoding='utf-8')
+        reader = iter_jsonl
+    else:
+        raise ValueError("Unknown format %r" % fmt)
+    with f:
+        for item in reader(f):
+            yield item
+
+
+def find_user(users, record):
+    userid = record.get('userid', None)
+    email = record.get('email', None)
+    if userid:
+        user = users.get(userid, None)
+    elif email:
+        user = users.get_user_by_email(email)
+    else:
+        raise RecordError("Either userid or email is required")
+    if user is None:
+        raise RecordError("No user found for %r" % (userid or email))
+    return user
+
+
+def import_batch(request, users, records):
+    """ Link users in a batch of (line number, record) through PASProvider.store.
+        Nothing is committed here.
+
+        Returns (counts, errors), where errors is a list of (line number, message).
+    """
+    counts = {'linked': 0, 'updated': 0, 'unchanged': 0, 'failed': 0}
+    errors = []
+    providers = {}
+    checked = []
+    idents = {}
+    for (num, record) in records:
+        try:
+            if isinstance(record, Exception):
+                raise record
+            provider_name = record.get('provider', None)
+            if provider_name not in providers:
+                providers[provider_name] = request.registry.queryAdapter(
+                    request, IPASProvider, name=provider_name or '')
+            provider = providers[provider_name]
+            if provider is None:
+                raise RecordError("No provider named %r" % provider_name)
+            ident = record.get('ident', None)
+            if ident in (None, ''):
+                raise RecordError("Missing ident")
+            user = find_user(users, record)
+        except RecordError as exc:
+            errors.append((num, text_type(exc)))
+            continue
+        checked.append((num, record, provider, ident, user))
+        idents.setdefault(provider.name, set()).add(ident)
+    #One lookup per provider for links that already exist
+    existing = {}
+    for (name, provider_idents) in idents.items():
+        existing[name] = providers[name].get_users(provider_idents)
+    seen = {}
+    for (num, record, provider, ident, user) in checked:
+        other = seen.setdefault((provider.name, ident), existing[provider.name].get(ident, user))
+        if other is not user:
+            errors.append((num, "%s %r is already linked to %s" % (provider.name, ident, other.userid)))
+            continue
+        current = provider.get_id(user)
+        if current is not None and current != ident:
+            errors.append((num, "%s is already linked to another %s account" % (user.userid, provider.name)))
+            continue
+        provider_data = IProviderData(user)
+        data = provider.name in provider_data and dict(provider_data[provider.name]) or {}
+        data.update((k, v) for (k, v) in record.items() if k not in RECORD_KEYS)
+        data[provider.id_key] = ident
+        if current is None:
+            provider.store(user, data)
+            counts['linked'] += 1
+        elif provider.store(user, data):
+            counts['updated'] += 1
+        else:
+            counts['unchanged'] += 1
+    errors.sort(key=lambda x: x[0])
+    counts['failed'] = len(errors)
+    return counts, errors
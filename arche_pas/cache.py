@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+""" Cache shared between requests, and depending on backend between workers and nodes.
+
+    Values must be JSON serializable. Pick a backend in the paster .ini:
+
+        # In-process only, max number of keys (default)
+        arche_pas.cache = lru:10000
+        # Shared by workers on the same node
+        arche_pas.cache = sqlite:%(here)s/../var/pas_cache.db
+        # Shared by all nodes
+        arche_pas.cache = memcached:10.0.0.1:11211 10.0.0.2:11211
+"""
+from __future__ import unicode_literals
+
+import json
+import math
+import random
+import socket
+import sqlite3
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+from threading import local
+from time import time
+from zlib import crc32
+
+from zope.interface import implementer
+
+from arche_pas import logger
+from arche_pas.exceptions import ProviderConfigError
+from arche_pas.interfaces import IPASCache
+
+
+@implementer(IPASCache)
+class LRUCache(object):
+    """ In-process cache, least recently used keys are dropped when full. """
+
+    def __init__(self, maxsize=10000, clock=time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= self.clock():
+                return default
+            #Reinsert as most recently used
+            self._data[key] = (value, expires)
+        return value
+
+    def _store(self, key, value, ttl):
+        self._data.pop(key, None)
+        self._data[key] = (value, ttl and self.clock() + ttl or None)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            if key in self._data:
+                expires = self._data[key][1]
+                if expires is None or expires > self.clock():
+                    return False
+            self._store(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+@implementer(IPASCache)
+class SQLiteCache(object):
+    """ Cache in a local SQLite file, shared by all workers on the same node. """
+    #Fraction of writes that also purges expired rows
+    purge_ratio = 0.01
+
+    def __init__(self, filename, clock=time):
+        self.filename = filename
+        self.clock = clock
+        self._local = local()
+        self._execute("CREATE TABLE IF NOT EXISTS pas_cache "
+                      "(key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.filename, timeout=5, isolation_level=None)
+        return conn
+
+    def _execute(self, sql, params=()):
+        return self.conn.execute(sql, params)
+
+    def _expires(self, ttl):
+        return ttl and self.clock() + ttl or None
+
+    def get(self, key, default=None):
+        row = self._execute("SELECT value, expires FROM pas_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= self.clock()):
+            return default
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        self._execute("INSERT OR REPLACE INTO pas_cache (key, value, expires) VALUES (?, ?, ?)",
+                      (key, json.dumps(value), self._expires(ttl)))
+        if random.random() < self.purge_ratio:
+            self._execute("DELETE FROM pas_cache WHERE expires <= ?", (self.clock(),))
+
+    def add(self, key, value, ttl=None):
+        self._execute("DELETE FROM pas_cache WHERE key = ? AND expires <= ?", (key, self.clock()))
+        cursor = self._execute("INSERT OR IGNORE INTO pas_cache (key, value, expires) VALUES (?, ?, ?)",
+                               (key, json.dumps(value), self._expires(ttl)))
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        self._execute("DELETE FROM pas_cache WHERE key = ?", (key,))
+
+
+@implementer(IPASCache)
+class MemcachedCache(object):
+    """ Minimal client for the memcached text protocol. Keys are spread over servers
+        by hash. Connection errors are logged and treated as cache misses.
+    """
+    #Memcached treats larger values as timestamps
+    max_relative_ttl = 30 * 24 * 60 * 60
+
+    def __init__(self, servers, timeout=1.0):
+        self.servers = []
+        for server in servers:
+            host, port = server.rsplit(':', 1)
+            self.servers.append((host, int(port)))
+        if not self.servers:
+            raise ProviderConfigError("No memcached servers configured")
+        self.timeout = timeout
+        self._local = local()
+
+    def _key(self, key):
+        key = key.encode('utf-8')
+        if len(key) > 200 or any(c in key for c in (b' ', b'\r', b'\n')):
+            key = b'sha1:' + sha1(key).hexdigest().encode('ascii')
+        return key
+
+    def _server(self, key):
+        return self.servers[(crc32(key) & 0xffffffff) % len(self.servers)]
+
+    def _conn(self, key):
+        server = self._server(key)
+        conns = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = {}
+        if server not in conns:
+            sock = socket.create_connection(server, timeout=self.timeout)
+            conns[server] = (sock, sock.makefile('rb'))
+        return server, conns[server]
+
+    def _command(self, key, line, data=None):
+        """ Send command and return (first response line, reader). """
+        server, (sock, reader) = self._conn(key)
+        try:
+            payload = line + b'\r\n'
+            if data is not None:
+                payload += data + b'\r\n'
+            sock.sendall(payload)
+            return reader.readline().rstrip(b'\r\n'), reader
+        except (socket.error, IOError):
+            self._drop(key)
+            raise
+
+    def _drop(self, key):
+        """ Close the connection for key. Used whenever a response wasn't read completely,
+            since the rest of it would otherwise be read as the response to the next command.
+        """
+        conns = getattr(self._local, 'conns', None) or {}
+        conn = conns.pop(self._server(key), None)
+        if conn is not None:
+            (sock, reader) = conn
+            try:
+                reader.close()
+                sock.close()
+            except (socket.error, IOError):
+                pass
+
+    def _ttl(self, ttl):
+        #Round up, 0 would mean no expiry
+        ttl = int(math.ceil(ttl or 0))
+        if ttl > self.max_relative_ttl:
+            ttl = int(time()) + ttl
+        return ttl
+
+    def get(self, key, default=None):
+        key = self._key(key)
+        try:
+            response, reader = self._command(key, b'get ' + key)
+        except (socket.error, IOError):
+            logger.exception("memcached get failed")
+            return default
+        if response == b'END':
+            return default
+        try:
+            parts = response.split()
+            if len(parts) != 4 or parts[0] != b'VALUE' or parts[1] != key:
+                raise ValueError("Unexpected memcached response: %r" % response)
+            length = int(parts[3])
+            data = reader.read(length + 2)
+            if len(data) != length + 2 or data[length:] != b'\r\n' or reader.readline() != b'END\r\n':
+                raise ValueError("Incomplete memcached response for %r" % key)
+            return json.loads(data[:length].decode('utf-8'))
+        except (socket.error, IOError, ValueError):
+            logger.exception("memcached get failed")
+            self._drop(key)
+            return default
+
+    def _store(self, command, key, value, ttl):
+        key = self._key(key)
+        data = json.dumps(value).encode('utf-8')
+        line = b' '.join((command, key, b'0', str(self._ttl(ttl)).encode('ascii'),
+                          str(len(data)).encode('ascii')))
+        try:
+            response, reader = self._command(key, line, data)
+        except (socket.error, IOError):
+            logger.exception("memcached %s failed", command)
+            return False
+        return response == b'STORED'
+
+    def set(self, key, value, ttl=None):
+        self._store(b'set', key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        return self._store(b'add', key, value, ttl)
+
+    def delete(self, key):
+        key = self._key(key)
+        try:
+            self._command(key, b'delete ' + key)
+        except (socket.error, IOError):
+            logger.exception("memcached delete failed")
+
+
+@implementer(IPASCache)
+class PrefixedCache(object):
+    """ Puts a prefix on all keys, so several sites may share a backend. """
+
+    def __init__(self, backend, prefix):
+        self.backend = backend
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        return self.backend.get(self.prefix + key, default)
+
+    def set(self, key, value, ttl=None):
+        return self.backend.set(self.prefix + key, value, ttl=ttl)
+
+    def add(self, key, value, ttl=None):
+        return self.backend.add(self.prefix + key, value, ttl=ttl)
+
+    def delete(self, key):
+        return self.backend.delete(self.prefix + key)
+
+
+def cache_from_setting(value):
+    """ Create a cache backend from a setting like 'lru:1000', 'sqlite:/path' or 'memcached:host:port'. """
+    value = (value or 'lru').strip()
+    kind, _sep, arg = value.partition(':')
+    arg = arg.strip()
+    if kind == 'lru':
+        return LRUCache(maxsize=int(arg or 10000))
+    if kind == 'sqlite':
+        if not arg:
+            raise ProviderConfigError("The sqlite cache needs a filename, like sqlite:/path/to/cache.db")
+        return SQLiteCache(arg)
+    if kind == 'memcached':
+        return MemcachedCache(arg.split())
+    raise ProviderConfigError("Unknown cache backend '%s' in arche_pas.cache" % kind)
+
+
+def get_cache(registry):
+    return registry.getUtility(IPASCache)
+
+
+def includeme(config):
+    settings = config.registry.settings
+    backend = cache_from_setting(settings.get('arche_pas.cache', ''))
+    prefix = settings.get('arche_pas.cache.prefix', '')
+    if prefix:
+        backend = PrefixedCache(backend, prefix)
+    config.registry.registerUtility(backend, IPASCache)
@@ -1,10 +1,26 @@
+from collections import OrderedDict
+from time import time
+
+import transaction
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from arche.events import ObjectUpdatedEvent
 from arche.interfaces import IUser
+from pyramid.threadlocal import get_current_registry
 from pyramid.threadlocal import get_current_request
+from repoze.catalog.indexes.field import CatalogFieldIndex
 from repoze.catalog.indexes.keyword import CatalogKeywordIndex
+from zope.component.event import objectEventNotify
 
 from arche_pas.interfaces import IPASProvider
 
 
+#Indexes with data from arche_pas
+PAS_INDEXES = ('pas_ident', 'pas_providers')
+#Indexes with data from the token vault
+TOKEN_INDEXES = ('pas_token_expiry', 'pas_tokens')
+
+
 def get_pas_ident(context, default):
     """ For any user object, index identification for pas method.
         This is a keyword index that contains tuples with
@@ -26,7 +42,188 @@ def get_pas_ident(context, default):
     return default
 
 
+def get_pas_providers(context, default):
+    """ For any user object, index the names of linked providers.
+        Names of providers that aren't configured any longer are kept too.
+    """
+    if not IUser.providedBy(context):
+        return default
+    #Don't use IProviderData here, it creates the storage if it's missing
+    provider_data = getattr(context, '__pas_provider_data__', None)
+    if provider_data:
+        return list(provider_data.keys())
+    return default
+
+
+def get_pas_token_expiry(context, default):
+    """ For any user object, index when the first of its stored tokens expires,
+        so tokens due for refresh can be found without loading every user.
+    """
+    if not IUser.providedBy(context):
+        return default
+    #Read directly, the token vault creates the storage if it's missing
+    tokens = getattr(context, '__pas_tokens__', None) or {}
+    expiry = [v[0] for v in tokens.values() if v[0] is not None]
+    if expiry:
+        return min(expiry)
+    return default
+
+
+def get_pas_tokens(context, default):
+    """ For any user object, index the names of providers it has stored tokens for. """
+    if not IUser.providedBy(context):
+        return default
+    tokens = getattr(context, '__pas_tokens__', None)
+    if tokens:
+        return list(tokens.keys())
+    return default
+
+
+class PASProvidersIndex(CatalogKeywordIndex):
+    """ Keyword index that also keeps the number of users for each provider,
+        so they can be read without walking the sets of docids.
+    """
+
+    def clear(self):
+        super(PASProvidersIndex, self).clear()
+        self.counts = OOBTree()
+
+    def index_doc(self, docid, obj):
+        before = self._keywords(docid)
+        #index_doc may unindex the document first, it's counted here instead
+        self._v_indexing = True
+        try:
+            result = super(PASProvidersIndex, self).index_doc(docid, obj)
+        finally:
+            self._v_indexing = False
+        self._update_counts(before, self._keywords(docid))
+        return result
+
+    def unindex_doc(self, docid):
+        before = self._keywords(docid)
+        result = super(PASProvidersIndex, self).unindex_doc(docid)
+        if not getattr(self, '_v_indexing', False):
+            self._update_counts(before, ())
+        return result
+
+    def _keywords(self, docid):
+        return set(self._rev_index.get(docid, ()))
+
+    def _update_counts(self, before, after):
+        for name in set(before) ^ set(after):
+            counter = self.counts.get(name, None)
+            if counter is None:
+                counter = self.counts[name] = Length()
+            #Length resolves conflicts, so concurrent logins don't conflict here
+            counter.change(name in after and 1 or -1)
+
+
+def provider_counts(catalog):
+    """ Number of users linked to each provider, read from the pas_providers index
+        without loading any users.
+
+        Indexes created before PASProvidersIndex don't have counters. For them the
+        sets of docids are counted instead, which loads every bucket of the index.
+        Recreate the index and reindex the catalog to get the counters.
+    """
+    index = catalog['pas_providers']
+    counts = getattr(index, 'counts', None)
+    if counts is None:
+        return dict((name, len(docids)) for (name, docids) in index._fwd_index.items())
+    return dict((name, counter()) for (name, counter) in counts.items() if counter())
+
+
+def queue_pas_reindex(user, changed=PAS_INDEXES, providers=(), data_changed=True):
+    """ Reindex user just before the current transaction commits.
+        Any number of calls for the same user within one transaction
+        cause one ObjectUpdatedEvent.
+
+        :param providers: Names of providers whose data was stored, their
+            time in the PAS summary is updated.
+        :param data_changed: False if only the indexes need updating. The
+            serial and summary are then left alone, unless another call for
+            the same user changed data.
+    """
+    txn = transaction.get()
+    try:
+        queue = txn.data(_flush_pas_reindex)
+    except KeyError:
+        queue = OrderedDict()
+        txn.set_data(_flush_pas_reindex, queue)
+        txn.addBeforeCommitHook(_flush_pas_reindex, (queue,))
+    entry = queue.setdefault(id(user), [user, set(), set(), False])
+    entry[1].update(changed)
+    entry[2].update(providers)
+    entry[3] = entry[3] or data_changed
+
+
+def _flush_pas_reindex(queue):
+    registry = get_current_registry()
+    now = time()
+    #Subscribers may queue more users, they're handled in the same loop
+    while queue:
+        (user, changed, providers, data_changed) = queue.popitem(last=False)[1]
+        if data_changed:
+            user.__pas_serial__ = get_pas_serial(user) + 1
+            update_pas_summary(user, get_id_keys(registry), updated=providers, now=now)
+        objectEventNotify(ObjectUpdatedEvent(user, changed=sorted(changed)))
+
+
+def get_pas_serial(user):
+    """ Counter that changes each time PAS data of the user changes,
+        so clients can tell without loading any provider data.
+    """
+    return getattr(user, '__pas_serial__', 0)
+
+
+def get_id_keys(registry):
+    """ Name of the id field for each configured provider. """
+    return dict((ar.name, ar.factory.id_key) for ar in registry.registeredAdapters()
+                if ar.provided == IPASProvider)
+
+
+def get_pas_summary(user):
+    """ Linked providers of the user as a dict, without loading any provider data:
+        {provider name: {'ident': ..., 'updated': timestamp or None}}
+
+        Returns None if the summary hasn't been created for this user yet.
+    """
+    return getattr(user, '__pas_summary__', None)
+
+
+def update_pas_summary(user, id_keys, updated=(), now=None):
+    """ Rebuild the summary from the provider data and store it on the user. """
+    #A plain dict, stored with the user object itself
+    user.__pas_summary__ = summary = build_pas_summary(user, id_keys, updated=updated, now=now)
+    return summary
+
+
+def build_pas_summary(user, id_keys, updated=(), now=None):
+    """ Summary from the provider data.
+
+        :param id_keys: Provider name -> id key, see get_id_keys.
+        :param updated: Names of providers to set updated time for. Others keep
+            their current time.
+    """
+    old = get_pas_summary(user) or {}
+    summary = {}
+    provider_data = getattr(user, '__pas_provider_data__', None) or {}
+    for (name, data) in provider_data.items():
+        if name in updated or name not in old:
+            timestamp = name in updated and (now or time()) or None
+        else:
+            timestamp = old[name]['updated']
+        summary[name] = {'ident': data.get(id_keys.get(name, None), None), 'updated': timestamp}
+    return summary
+
+
 def includeme(config):
-    indexes = {'pas_ident': CatalogKeywordIndex(get_pas_ident),}
+    indexes = {
+        'pas_ident': CatalogKeywordIndex(get_pas_ident),
+        'pas_providers': PASProvidersIndex(get_pas_providers),
+        'pas_token_expiry': CatalogFieldIndex(get_pas_token_expiry),
+        'pas_tokens': CatalogKeywordIndex(get_pas_tokens),
+    }
     config.add_catalog_indexes(__name__, indexes)
-    config.update_index_info('pas_ident', type_names = 'User')
+    for name in PAS_INDEXES + TOKEN_INDEXES:
+        config.update_index_info(name, type_names = 'User')
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+""" Remove data for retired providers from all users. """
+from __future__ import unicode_literals
+
+from arche.interfaces import IRoot
+from arche.interfaces import IUser
+from arche.security import PERM_MANAGE_SYSTEM
+from arche.views.base import BaseView
+from pyramid.httpexceptions import HTTPBadRequest
+from repoze.catalog.query import Any
+try:
+    from pyramid.csrf import check_csrf_token
+except ImportError:  # pragma: no coverage
+    #Pyramid < 1.9
+    from pyramid.session import check_csrf_token
+
+from arche_pas import _
+from arche_pas import logger
+from arche_pas.audit import audit_event
+from arche_pas.catalog import provider_counts
+from arche_pas.catalog import queue_pas_reindex
+from arche_pas.exceptions import PASIndexEmpty
+from arche_pas.interfaces import IPASProvider
+from arche_pas.interfaces import IProviderData
+from arche_pas.interfaces import ITokenVault
+
+
+def configured_providers(request):
+    return set(name for (name, provider) in request.registry.getAdapters((request,), IPASProvider))
+
+
+def unconfigured_providers(request):
+    """ Names of providers that users are still linked to, but that aren't configured. """
+    return set(provider_counts(request.root.catalog)) - configured_providers(request)
+
+
+def find_linked_docids(root, names):
+    """ Sorted docids of users linked to any of these providers.
+
+        Raises PASIndexEmpty if the pas_providers index has no users at all,
+        but there are users with provider data. That happens when the index
+        was added but the catalog was never reindexed, and would otherwise look
+        like nobody was linked.
+    """
+    index = root.catalog['pas_providers']
+    if not index.documentCount():
+        #Stops at the first linked user, so this only loads everyone when nobody is linked
+        for user in root['users'].values():
+            if getattr(user, '__pas_provider_data__', None):
+                raise PASIndexEmpty("The pas_providers index is empty but users have provider data. "
+                                    "Reindex the catalog first.")
+        return []
+    docids = root.catalog.query(Any('pas_providers', list(names)))[1]
+    return list(docids)
+
+
+def remove_provider_data(request, docids, names):
+    """ Remove stored data and tokens for names from the users with these docids.
+        Users are reindexed when the transaction commits.
+        Returns the number of users that changed.
+    """
+    count = 0
+    for user in request.resolve_docids(docids, perm = None):
+        if not IUser.providedBy(user):
+            continue
+        provider_data = IProviderData(user)
+        tokens = ITokenVault(user)
+        changed = False
+        for name in names:
+            if name in provider_data:
+                del provider_data[name]
+                audit_event(request, 'unlink', user.userid, name)
+                changed = True
+            if name in tokens:
+                del tokens[name]
+        if changed:
+            queue_pas_reindex(user)
+            count += 1
+    return count
+
+
+class RemoveProvidersView(BaseView):
+    """ Remove provider data from one batch of users per POST. The batch is
+        committed with the request, and the response reports how many users
+        are left so the browser can continue with another POST.
+        Use arche_pas_remove_providers for large sites.
+    """
+    batch_size = 200
+
+    def __call__(self):
+        counts = provider_counts(self.request.root.catalog)
+        configured = configured_providers(self.request)
+        response = {
+            'title': _("Remove provider data"),
+            'counts': sorted(counts.items()),
+            'configured': configured,
+            'names': (),
+            'removed': 0,
+            'remaining': 0,
+        }
+        if self.request.method == 'POST':
+            check_csrf_token(self.request)
+            names = self.request.POST.getall('name')
+            if not names:
+                raise HTTPBadRequest("No providers selected")
+            response.update(self.remove(names))
+        return response
+
+    def remove(self, names):
+        try:
+            docids = find_linked_docids(self.request.root, names)
+        except PASIndexEmpty as exc:
+            raise HTTPBadRequest("%s" % exc)
+        batch = docids[:self.batch_size]
+        removed = remove_provider_data(self.request, batch, names)
+        #The index is updated when the request commits, users in this batch are done by then
+        remaining = len(docids) - len(batch)
+        logger.info("Removed %s from %s users, %s left", ", ".join(names), removed, remaining)
+        return {'names': names, 'removed': removed, 'remaining': remaining}
+
+
+def includeme(config):
+    config.add_view(RemoveProvidersView, context=IRoot, name='pas_remove_providers',
+                    renderer='arche_pas:templates/remove_providers.pt', permission=PERM_MANAGE_SYSTEM)
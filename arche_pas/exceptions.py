@@ -7,3 +7,9 @@ class ProviderConfigError(Exception):
 class RegistrationCaseMissmatch(Exception):
     """ Raised when fetching registration cases if they don't match.
     """
+
+
+class PASIndexEmpty(Exception):
+    """ Raised when the PAS catalog indexes are empty, but users have provider data.
+        The catalog needs to be reindexed first.
+    """
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+""" Streaming export of linked providers and stored profile data.
+
+    One row per linked provider and user, with the fields userid, email,
+    provider, ident and data. Data is all stored profile fields for that
+    provider, as a JSON string in CSV.
+"""
+from __future__ import unicode_literals
+
+import csv
+import io
+import json
+
+import transaction
+from arche.interfaces import IRoot
+from arche.interfaces import IUser
+from arche.security import PERM_MANAGE_SYSTEM
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.response import Response
+from six import PY2
+from six import text_type
+
+from arche_pas.catalog import get_id_keys
+from arche_pas.decommission import find_linked_docids
+
+
+FIELDS = ('userid', 'email', 'provider', 'ident', 'data')
+FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def select_userids(request, providers=None, userids=None, batch_size=500):
+    """ Userids to export in order, or None for everyone.
+        Users linked to providers are found through the pas_providers index.
+    """
+    if not providers:
+        return userids and sorted(set(userids)) or None
+    wanted = userids and set(userids) or None
+    docids = find_linked_docids(request.root, providers)
+    results = []
+    for i in range(0, len(docids), batch_size):
+        for user in request.resolve_docids(docids[i:i + batch_size], perm = None):
+            if IUser.providedBy(user) and (wanted is None or user.userid in wanted):
+                results.append(user.userid)
+        _release(request.root)
+    return sorted(results)
+
+
+def _release(obj):
+    jar = getattr(obj, '_p_jar', None)
+    if jar is not None:
+        jar.cacheMinimize()
+
+
+def iter_export(users, userids=None, providers=None, id_keys=None, batch_size=500):
+    """ Yield one dict per linked provider and user. Users are loaded in batches
+        and released from the ZODB cache after each batch.
+
+        :param users: The users folder.
+        :param userids: Userids to export, or None for all users.
+        :param providers: Provider names to export, or None for all.
+    """
+    id_keys = id_keys or {}
+    providers = providers and set(providers) or None
+    if userids is None:
+        userids = users.keys()
+    count = 0
+    for userid in userids:
+        user = users.get(userid, None)
+        provider_data = getattr(user, '__pas_provider_data__', None)
+        if provider_data:
+            for (name, data) in provider_data.items():
+                if providers is not None and name not in providers:
+                    continue
+                data = dict(data)
+                yield {
+                    'userid': userid,
+                    'email': getattr(user, 'email', ''),
+                    'provider': name,
+                    'ident': data.get(id_keys.get(name, None), None),
+                    'data': data,
+                }
+        count += 1
+        if count % batch_size == 0:
+            _release(users)
+    _release(users)
+
+
+def format_jsonl(rows):
+    for row in rows:
+        yield json.dumps(row, default=text_type) + "\n"
+
+
+def format_csv(rows):
+    yield _csv_line(FIELDS)
+    for row in rows:
+        values = [row[k] for k in FIELDS[:-1]]
+        values.append(json.dumps(row['data'], default=text_type))
+        yield _csv_line(values)
+
+
+def _csv_line(values):
+    values = ['' if x is None else text_type(x) for x in values]
+    if PY2:
+        #The csv module wants bytes on Python 2
+        out = io.BytesIO()
+        csv.writer(out).writerow([x.encode('utf-8') for x in values])
+        return out.getvalue().decode('utf-8')
+    out = io.StringIO()
+    csv.writer(out).writerow(values)
+    return out.getvalue()
+
+
+FORMATTERS = {'jsonl': format_jsonl, 'csv': format_csv}
+
+
+def export_view(context, request):
+    """ Stream the export. Query params: format (jsonl or csv), and any number of
+        provider and userid to filter on.
+
+        The response is iterated after the request is done, so users are read
+        through a separate connection to the database.
+    """
+    fmt = request.GET.get('format', 'jsonl')
+    if fmt not in FORMATTERS:
+        raise HTTPBadRequest("format must be one of %s" % ", ".join(FORMATTERS))
+    providers = request.GET.getall('provider') or None
+    userids = select_userids(request, providers, request.GET.getall('userid'))
+    id_keys = get_id_keys(request.registry)
+    db = context._p_jar.db()
+    users_oid = context['users']._p_oid
+    formatter = FORMATTERS[fmt]
+
+    def app_iter():
+        tm = transaction.TransactionManager()
+        conn = db.open(transaction_manager=tm)
+        try:
+            users = conn.get(users_oid)
+            for line in formatter(iter_export(users, userids, providers, id_keys)):
+                yield line.encode('utf-8')
+        finally:
+            tm.abort()
+            conn.close()
+
+    response = Response(app_iter=app_iter(), content_type=str(FORMATS[fmt]), charset=str('utf-8'))
+    response.content_disposition = str('attachment; filename="pas_export.%s"' % fmt)
+    return response
+
+
+def includeme(config):
+    config.add_view(export_view, context=IRoot, name='pas_export', permission=PERM_MANAGE_SYSTEM)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+""" A local fake OAuth2 / OpenID Connect identity provider for load testing.
+
+    Approves every authorization request without asking anything. The identity
+    is picked from the 'login_hint' parameter, or a random one is created.
+    Use together with the provider arche_pas.providers.fake.
+
+    Run it with:
+        python -m arche_pas.fake_idp --port 8081 --latency 0.05 --error-rate 0.01
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import random
+import sys
+from threading import Lock
+from time import sleep
+from time import time
+from uuid import uuid4
+
+from six.moves.urllib.parse import urlencode
+from webob import Request
+from webob import Response
+
+
+class FakeIdP(object):
+    """ WSGI application serving /authorize, /token and /userinfo.
+
+        :param latency: Seconds added to every response.
+        :param jitter: Random extra seconds, between 0 and jitter.
+        :param error_rate: Fraction of /token and /userinfo responses that fail.
+        :param token_lifetime: Seconds until access tokens expire.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, token_lifetime=3600, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.token_lifetime = token_lifetime
+        self.random = random.Random(seed)
+        self._lock = Lock()
+        self.codes = {}
+        self.access_tokens = {}
+        self.refresh_tokens = {}
+        self.stats = {'authorize': 0, 'token': 0, 'userinfo': 0, 'errors': 0}
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        handler = {
+            '/authorize': self.authorize,
+            '/token': self.token,
+            '/userinfo': self.userinfo,
+        }.get(request.path_info, None)
+        if handler is None:
+            response = Response(status=404)
+        else:
+            self.delay()
+            response = handler(request)
+        return response(environ, start_response)
+
+    def delay(self):
+        seconds = self.latency
+        if self.jitter:
+            seconds += self.random.uniform(0, self.jitter)
+        if seconds > 0:
+            sleep(seconds)
+
+    def should_fail(self):
+        return self.error_rate and self.random.random() < self.error_rate
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def json_response(self, data, status=200):
+        response = Response(status=status, content_type=str('application/json'), charset=str('utf-8'))
+        response.text = json.dumps(data)
+        response.cache_control = 'no-store'
+        return response
+
+    def error_response(self, error, status=400):
+        self.count('errors')
+        return self.json_response({'error': error}, status=status)
+
+    def new_token(self, ident):
+        token = {
+            'access_token': uuid4().hex,
+            'refresh_token': uuid4().hex,
+            'token_type': 'Bearer',
+            'expires_in': self.token_lifetime,
+        }
+        with self._lock:
+            self.access_tokens[token['access_token']] = (ident, time() + self.token_lifetime)
+            self.refresh_tokens[token['refresh_token']] = ident
+        return token
+
+    def authorize(self, request):
+        self.count('authorize')
+        redirect_uri = request.GET.get('redirect_uri', '')
+        if not redirect_uri:
+            return self.error_response('invalid_request')
+        ident = request.GET.get('login_hint') or uuid4().hex
+        code = uuid4().hex
+        with self._lock:
+            self.codes[code] = ident
+        query = {'code': code}
+        if request.GET.get('state'):
+            query['state'] = request.GET['state']
+        sep = '?' in redirect_uri and '&' or '?'
+        response = Response(status=302)
+        response.location = redirect_uri + sep + urlencode(query)
+        return response
+
+    def token(self, request):
+        self.count('token')
+        if self.should_fail():
+            return self.error_response('server_error', status=500)
+        grant_type = request.POST.get('grant_type', '')
+        if grant_type == 'authorization_code':
+            codes, key = self.codes, request.POST.get('code', '')
+        elif grant_type == 'refresh_token':
+            codes, key = self.refresh_tokens, request.POST.get('refresh_token', '')
+        else:
+            return self.error_response('unsupported_grant_type')
+        with self._lock:
+            ident = codes.pop(key, None)
+        if ident is None:
+            return self.error_response('invalid_grant')
+        return self.json_response(self.new_token(ident))
+
+    def userinfo(self, request):
+        self.count('userinfo')
+        if self.should_fail():
+            return self.error_response('server_error', status=500)
+        auth = request.headers.get('Authorization', '')
+        if not auth.startswith('Bearer '):
+            return self.error_response('invalid_token', status=401)
+        with self._lock:
+            ident, expires = self.access_tokens.get(auth[7:], (None, 0))
+        if ident is None or expires < time():
+            return self.error_response('invalid_token', status=401)
+        return self.json_response(self.profile(ident))
+
+    def profile(self, ident):
+        return {
+            'sub': ident,
+            'email': '%s@fake.example' % ident,
+            'email_verified': True,
+            'name': 'Fake %s' % ident,
+            'given_name': 'Fake',
+            'family_name': ident,
+        }
+
+
+def make_threaded_server(app, host='127.0.0.1', port=8081):
+    """ Return a threaded wsgiref server for app. Call serve_forever() on it. """
+    from wsgiref.simple_server import WSGIServer
+    from wsgiref.simple_server import WSGIRequestHandler
+    from wsgiref.simple_server import make_server
+    from six.moves.socketserver import ThreadingMixIn
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    return make_server(host, port, app, server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description="Fake OAuth2 identity provider")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to each response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Random extra seconds up to this")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of failing responses")
+    parser.add_argument('--token-lifetime', type=int, default=3600)
+    args = parser.parse_args(argv[1:])
+    app = FakeIdP(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                  token_lifetime=args.token_lifetime)
+    server = make_threaded_server(app, args.host, args.port)
+    print("Fake IdP serving on http://%s:%s" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -39,6 +39,20 @@ class IPASProvider(Interface):
             Known as redirect_uri in OAuth2.
         """
 
+    def refresh_token(token):
+        """ Fetch a new token with the refresh token.
+
+        :param token: Token dict as returned by the provider
+        :return: New token dict or None if it can't be refreshed
+        """
+
+    def fetch_profile(token):
+        """ Fetch profile data from the provider without user interaction.
+
+        :param token: Token dict with at least access_token
+        :return: Profile data, same as callback returns
+        """
+
     def get_id(user):
         """
         Get the providers unique identifier for this user.
@@ -53,6 +67,14 @@ class IPASProvider(Interface):
         :return: User object or None
         """
 
+    def get_users(user_idents):
+        """ Get users for many identifiers at once. Only matching users are loaded.
+
+        :param user_idents: Iterable with unique identifiers.
+        :return: Dict with identifier as key and User object as value.
+            Identifiers without a user are left out.
+        """
+
     def prepare_register(data):
         """
         Either tie an existing user with the same validated email address
@@ -95,5 +117,123 @@ class IPASProvider(Interface):
         """
 
 
+class ITokenVault(IContextAdapter):
+    """ Adapts an IUser object and stores encrypted OAuth tokens, one per provider.
+    """
+
+    def get(provider_name, default=None):
+        """ Return the decrypted token dict or default. """
+
+    def due(before):
+        """ Names of providers with tokens expiring before the timestamp. """
+
+
+class ITokenCipher(Interface):
+    """ Encrypts and decrypts token dicts. Registered when the vault is enabled. """
+
+    def encrypt(token):
+        """ Return token as an encrypted string. """
+
+    def decrypt(value):
+        """ Return the token dict or None if it couldn't be decrypted. """
+
+
+class ITokenValidator(Interface):
+    """ Validates bearer tokens for BearerAuthenticationPolicy. """
+
+    def __call__(provider, token):
+        """ Return (ident, expires_at) for a valid token issued to this site,
+            where expires_at may be None if it isn't known. Return None for
+            invalid tokens, and raise an exception if validation itself failed.
+        """
+
+
+class IPASCache(Interface):
+    """ Cache for state that should be shared between requests, workers or nodes.
+        Values must be JSON serializable. A ttl of None or 0 means no expiry.
+    """
+
+    def get(key, default=None):
+        """ Return cached value or default. """
+
+    def set(key, value, ttl=None):
+        """ Store value. """
+
+    def add(key, value, ttl=None):
+        """ Store value only if key doesn't exist. Return True if it was stored. """
+
+    def delete(key):
+        """ Remove key if it exists. """
+
+
+class IPASMetrics(Interface):
+    """ In-process timings and counters for the login pipeline.
+        Only registered when 'arche_pas.metrics' is enabled.
+    """
+
+    def timer(provider, phase):
+        """ Return a context manager that records the time spent as phase. """
+
+    def observe(provider, phase, seconds):
+        """ Record a timing. """
+
+    def incr(provider, outcome, amount=1):
+        """ Increase outcome counter. """
+
+    def render():
+        """ Return everything in Prometheus text format. """
+
+
 class IRegistrationCase(Interface):
     """ Figure out how to handle different registration conditions. """
+
+
+class IAfterLoginDispatcher(Interface):
+    """ Runs handlers added with config.add_pas_after_login when a user logs in.
+        Handlers are called with an AfterLogin object.
+    """
+
+    def add_handler(handler):
+        """ Add a callable. """
+
+    def dispatch(info):
+        """ Run handlers for info, or queue them to run after commit. """
+
+
+class IPASAuditLog(Interface):
+    """ Append only log of logins and changes to linked providers.
+        Only registered when 'arche_pas.audit.directory' is set.
+    """
+    directory = Attribute("Where the log files are kept")
+    reader = Attribute("AuditReader for the directory")
+
+    def write(records):
+        """ Append a list of record dicts. """
+
+
+class IPASWarmup(Interface):
+    """ Warms up a worker before it gets traffic. Only registered when
+        'arche_pas.warmup' is set.
+    """
+    ready = Attribute("True when done")
+
+    def run(request, blocking=True):
+        """ Run all steps unless already done. """
+
+    def start(registry):
+        """ Run in a background thread, unless already started. """
+
+    def status():
+        """ Return a copy of ready, timings and results per step and the names of failed steps. """
+
+
+class ICallbackRecorder(Interface):
+    """ Records anonymised provider callbacks. Only registered when
+        'arche_pas.record.directory' is set.
+    """
+
+    def record(request, provider, profile_data, case, state):
+        """ Maybe record this callback, depending on the sample rate.
+            case is the registration case that was picked or 'login', and state
+            a dict with the local state that decided it.
+        """
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+from timeit import default_timer
+
+from arche.interfaces import IRoot
+from arche.security import PERM_MANAGE_SYSTEM
+from pyramid.response import Response
+from pyramid.settings import asbool
+from zope.interface import implementer
+
+from arche_pas.interfaces import IPASMetrics
+
+
+#Upper bounds in seconds, Prometheus style
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class NullTimer(object):
+    """ Does nothing. Used when metrics are disabled. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+null_timer = NullTimer()
+
+
+class Timer(object):
+    __slots__ = ('metrics', 'provider', 'phase', 'start')
+
+    def __init__(self, metrics, provider, phase):
+        self.metrics = metrics
+        self.provider = provider
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe(self.provider, self.phase, default_timer() - self.start)
+        if exc_type is not None:
+            self.metrics.incr(self.provider, "%s_error" % self.phase)
+        return False
+
+
+@implementer(IPASMetrics)
+class PASMetrics(object):
+    """ In-process histograms of phase timings and counters of outcomes,
+        kept per provider. Buckets are stored non-cumulative and summed on render.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def timer(self, provider, phase):
+        return Timer(self, provider, phase)
+
+    def observe(self, provider, phase, seconds):
+        key = (provider, phase)
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            try:
+                hist = self._histograms[key]
+            except KeyError:
+                #Last slot is +Inf
+                hist = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            hist[0][index] += 1
+            hist[1] += seconds
+            hist[2] += 1
+
+    def incr(self, provider, outcome, amount=1):
+        key = (provider, outcome)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def get_count(self, provider, outcome):
+        return self._counters.get((provider, outcome), 0)
+
+    def get_histogram(self, provider, phase):
+        """ Returns a tuple with cumulative bucket counts, sum and count. """
+        with self._lock:
+            hist = self._histograms.get((provider, phase))
+            if hist is None:
+                return None
+            counts, total, count = list(hist[0]), hist[1], hist[2]
+        return _cumulative(counts), total, count
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render(self):
+        """ Render everything in Prometheus text exposition format. """
+        lines = [
+            "# HELP arche_pas_phase_seconds Time spent in each phase of the PAS login pipeline.",
+            "# TYPE arche_pas_phase_seconds histogram",
+        ]
+        bounds = ["%g" % b for b in self.buckets] + ["+Inf"]
+        #Copy everything at once, so the output is consistent and other threads can keep observing
+        with self._lock:
+            histograms = sorted((k, list(v[0]), v[1], v[2]) for (k, v) in self._histograms.items())
+            counters = sorted(self._counters.items())
+        for ((provider, phase), counts, total, count) in histograms:
+            cumulative = _cumulative(counts)
+            labels = 'provider="%s",phase="%s"' % (_escape(provider), _escape(phase))
+            for (le, value) in zip(bounds, cumulative):
+                lines.append('arche_pas_phase_seconds_bucket{%s,le="%s"} %d' % (labels, le, value))
+            lines.append('arche_pas_phase_seconds_sum{%s} %.6f' % (labels, total))
+            lines.append('arche_pas_phase_seconds_count{%s} %d' % (labels, count))
+        lines.append("# HELP arche_pas_outcomes_total Outcomes of PAS requests.")
+        lines.append("# TYPE arche_pas_outcomes_total counter")
+        for ((provider, outcome), value) in counters:
+            lines.append('arche_pas_outcomes_total{provider="%s",outcome="%s"} %d' % (
+                _escape(provider), _escape(outcome), value))
+        return "\n".join(lines) + "\n"
+
+
+def _cumulative(counts):
+    cumulative = []
+    running = 0
+    for c in counts:
+        running += c
+        cumulative.append(running)
+    return tuple(cumulative)
+
+
+def _escape(value):
+    return ("%s" % value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def get_timer(registry, provider, phase):
+    """ Return a context manager timing phase. Costs a utility lookup if metrics are disabled. """
+    metrics = registry.queryUtility(IPASMetrics)
+    if metrics is None:
+        return null_timer
+    return metrics.timer(provider, phase)
+
+
+def count_outcome(registry, provider, outcome):
+    metrics = registry.queryUtility(IPASMetrics)
+    if metrics is not None:
+        metrics.incr(provider, outcome)
+
+
+def timed(phase):
+    """ Decorator for PASProvider methods. Records the time spent within the method as phase. """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kw):
+            with self.timer(phase):
+                return method(self, *args, **kw)
+        return wrapper
+    return decorator
+
+
+def metrics_view(context, request):
+    metrics = request.registry.getUtility(IPASMetrics)
+    return Response(text=metrics.render(), content_type=str('text/plain'), charset=str('utf-8'))
+
+
+def includeme(config):
+    settings = config.registry.settings
+    if not asbool(settings.get('arche_pas.metrics', False)):
+        return
+    config.registry.registerUtility(PASMetrics())
+    config.add_view(metrics_view, context=IRoot, name='pas_metrics', permission=PERM_MANAGE_SYSTEM)
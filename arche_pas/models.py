@@ -2,27 +2,42 @@
 from __future__ import unicode_literals
 
 from UserDict import IterableUserDict
+from json import loads
+from os.path import getmtime
+from threading import Lock
+from time import time
 
 from BTrees.OOBTree import OOBTree
-from arche.events import ObjectUpdatedEvent
 from arche.events import WillLoginEvent
 from arche.interfaces import IUser
 from pyramid.httpexceptions import HTTPFound
 from pyramid.interfaces import IRequest
 from pyramid.security import remember
 from pyramid.threadlocal import get_current_registry
+from repoze.catalog.query import Any
 from six import string_types
 from zope.component import adapter
-from zope.component.event import objectEventNotify
 from zope.interface import implementer
 
 from arche_pas import _
 from arche_pas import logger
+from arche_pas.after_login import AfterLogin
+from arche_pas.audit import audit_event
+from arche_pas.catalog import queue_pas_reindex
 from arche_pas.exceptions import ProviderConfigError
 from arche_pas.exceptions import RegistrationCaseMissmatch
+from arche_pas.interfaces import IAfterLoginDispatcher
 from arche_pas.interfaces import IPASProvider
 from arche_pas.interfaces import IProviderData
 from arche_pas.interfaces import IRegistrationCase
+from arche_pas.metrics import count_outcome
+from arche_pas.metrics import get_timer
+from arche_pas.metrics import timed
+from arche_pas.recorder import record_callback
+from arche_pas.tokens import save_token
+
+
+_load_lock = Lock()
 
 
 class UnknownProvider(object):
@@ -130,31 +145,109 @@ class PASProvider(object):
     title = ''
     id_key = ''
     image_key = ''
+    #Profile images are only fetched over https from these hosts or their subdomains
+    image_hosts = ()
     settings = None
+    #Settings are read from this file when the configuration is committed
+    settings_file = None
+    settings_mtime = None
+    #Check settings_file for changes at most this often, in seconds. 0 disables.
+    reload_interval = 0
+    next_settings_check = 0
     default_settings = {}
     paster_config_ns = ''
     trust_email = False
+    #Token from the provider fetched during this request, if any
+    token = None
     ProviderConfigError = ProviderConfigError
     logger = logger
 
     def __init__(self, request):
         self.request = request
+        if self.settings_file:
+            if self.settings is None:
+                self.load_settings()
+            elif self.reload_interval and time() >= self.next_settings_check:
+                self.check_settings_file()
 
     @classmethod
     def update_settings(cls, dictobj=None, **kw):
+        #Build a new dict and replace settings in one go, so other threads never see a half-updated one
         if cls.settings is None:
-            cls.settings = cls.default_settings.copy()
+            settings = cls.default_settings.copy()
+        else:
+            settings = dict(cls.settings)
         if dictobj:
-            cls.settings.update(dictobj)
+            settings.update(dictobj)
         if kw:
-            cls.settings.update(kw)
+            settings.update(kw)
         #Update own attributes from the 'provider' key
-        provider_settings = cls.settings.pop('provider', {})
+        provider_settings = settings.pop('provider', {})
         for (k, v) in provider_settings.items():
             if hasattr(cls, k):
                 setattr(cls, k ,v)
             else: #pragma: no coverage
                 raise cls.ProviderConfigError("%s has no attribute %s" % (cls, k))
+        cls.settings = settings
+
+    @classmethod
+    def read_settings(cls):
+        """ Read and validate settings_file without touching this class.
+            Returns a throwaway subclass with the new settings applied.
+        """
+        with open(cls.settings_file, 'r') as f:
+            pas_settings = loads(f.read())
+        candidate = type(cls.__name__, (cls,), {'settings': None, '__module__': cls.__module__})
+        candidate.update_settings(pas_settings)
+        candidate.validate_settings()
+        return candidate
+
+    @classmethod
+    def apply_settings(cls, candidate):
+        """ Copy settings from a candidate created by read_settings. """
+        for (k, v) in candidate.__dict__.items():
+            if not k.startswith('__') and k != 'settings':
+                setattr(cls, k, v)
+        cls.settings = candidate.settings
+
+    @classmethod
+    def load_settings(cls):
+        """ Read and validate settings_file. Called when the configuration is committed,
+            or on first use for providers registered without add_pas.
+        """
+        with _load_lock:
+            if cls.settings is not None:
+                #Another thread got here first
+                return
+            mtime = getmtime(cls.settings_file)
+            cls.apply_settings(cls.read_settings())
+            cls.settings_mtime = mtime
+            cls.next_settings_check = time() + cls.reload_interval
+
+    @classmethod
+    def check_settings_file(cls):
+        """ Reload settings_file if its mtime changed. If the new settings are broken,
+            the current ones are kept until the file changes again.
+            Returns True if settings were reloaded.
+        """
+        cls.next_settings_check = time() + cls.reload_interval
+        try:
+            mtime = getmtime(cls.settings_file)
+        except OSError:
+            logger.warning("Can't find settings for provider %r at %s", cls.name, cls.settings_file)
+            return False
+        if mtime == cls.settings_mtime:
+            return False
+        cls.settings_mtime = mtime
+        try:
+            candidate = cls.read_settings()
+        except (IOError, ValueError, cls.ProviderConfigError) as exc:
+            logger.error("Changed settings for provider %r in %s are invalid, keeping the current ones: %s",
+                         cls.name, cls.settings_file, exc)
+            return False
+        cls.apply_settings(candidate)
+        logger.info("Reloaded settings for provider %r from %s", cls.name, cls.settings_file)
+        return True
 
     @classmethod
     def validate_settings(cls):
@@ -165,7 +258,38 @@ class PASProvider(object):
                 assert isinstance(cls.settings.get(str_k, None), string_types), \
                     "Missing config key %r for provider %r" % (str_k, cls.name)
         except AssertionError as exc:
-            raise cls.ProviderConfigError(exc.message)
+            raise cls.ProviderConfigError("%s" % exc)
+
+    def timer(self, phase):
+        """ Context manager recording the time spent in phase, if metrics are enabled. """
+        return get_timer(self.request.registry, self.name, phase)
+
+    def count(self, outcome):
+        """ Increase the counter for outcome, if metrics are enabled. """
+        count_outcome(self.request.registry, self.name, outcome)
+
+    def oauth2_session(self, *args, **kw):
+        """ Return a requests_oauthlib.OAuth2Session. The OAuth libraries are
+            imported on first use rather than at startup.
+        """
+        from requests_oauthlib import OAuth2Session
+        session = OAuth2Session(*args, **kw)
+        adapter = self.http_adapter()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @classmethod
+    def http_adapter(cls):
+        """ Connection pool shared by all sessions of this provider, but not
+            with other providers or other instances of the same provider class.
+        """
+        #Don't use one inherited from a base class
+        adapter = cls.__dict__.get('_http_adapter', None)
+        if adapter is None:
+            from requests.adapters import HTTPAdapter
+            adapter = cls._http_adapter = HTTPAdapter()
+        return adapter
 
     def begin(self): #pragma: no coverage
         return ""
@@ -180,6 +304,25 @@ class PASProvider(object):
     def callback(self): #pragma: no coverage
         return {}
 
+    def refresh_token(self, token):
+        if not token.get('refresh_token'):
+            return None
+        session = self.oauth2_session(self.settings['client_id'], token=token)
+        new_token = session.refresh_token(
+            self.settings['token_uri'],
+            client_id=self.settings['client_id'],
+            client_secret=self.settings['client_secret'],
+        )
+        #Refresh tokens may be reused
+        new_token.setdefault('refresh_token', token['refresh_token'])
+        return new_token
+
+    def fetch_profile(self, token):
+        session = self.oauth2_session(self.settings['client_id'], token=token)
+        response = session.get(self.settings['profile_uri'])
+        response.raise_for_status()
+        return response.json()
+
     def callback_url(self):
         """ Same as redirect_uri for some providers """
         return self.request.route_url('pas_callback', provider=self.name)
@@ -188,6 +331,7 @@ class PASProvider(object):
         provider_data = IProviderData(user)
         return provider_data.get(self.name, {}).get(self.id_key, None)
 
+    @timed('get_user')
     def get_user(self, user_ident):
         query = "pas_ident == %s and type_name == 'User'" % str((self.name, user_ident))
         docids = self.request.root.catalog.query(query)[1]
@@ -195,6 +339,20 @@ class PASProvider(object):
             if IUser.providedBy(obj):
                 return obj
 
+    @timed('get_users')
+    def get_users(self, user_idents):
+        wanted = set(user_idents)
+        #One query for all idents instead of parsing a query per ident
+        query = Any('pas_ident', [(self.name, user_ident) for user_ident in wanted])
+        docids = self.request.root.catalog.query(query)[1]
+        results = {}
+        for obj in self.request.resolve_docids(docids, perm = None):
+            if IUser.providedBy(obj):
+                user_ident = self.get_id(obj)
+                if user_ident in wanted:
+                    results[user_ident] = obj
+        return results
+
     def build_reg_case_params(self, data):
         """ Get the result params to map a reg case against """
         validated_email = self.get_email(data, validated=True)
@@ -223,9 +381,16 @@ class PASProvider(object):
         :return: reg_id or non-error HTTPException (usually redirect)
         """
         self.logger.debug("prepare_register called with data %s", data)
-        reg_case_params = self.build_reg_case_params(data)
-        reg_case = get_register_case(registry=self.request.registry, **reg_case_params)
+        with self.timer('register_case'):
+            reg_case_params = self.build_reg_case_params(data)
+            reg_case = get_register_case(registry=self.request.registry, **reg_case_params)
         self.logger.debug("Got registration case util: %s", reg_case.name)
+        record_callback(self.request, self, data, reg_case.name, {
+            'authenticated': reg_case_params.get('require_authenticated', False),
+            'linked': False,
+            'user_exist_locally': reg_case_params.get('user_exist_locally', False),
+            'email_validated_locally': reg_case_params.get('email_validated_locally', False),
+        })
         #Really returned?
         email = self.get_email(data)
         if email:
@@ -240,11 +405,18 @@ class PASProvider(object):
         url = came_from and came_from or self.request.resource_url(self.request.root)
         return HTTPFound(url, headers = headers)
 
+    @timed('notify_login')
     def notify_login(self, user, first_login=False):
         event = WillLoginEvent(
             user, request=self.request, first_login=first_login, provider=self.name)
         self.request.registry.notify(event)
+        audit_event(self.request, first_login and 'register' or 'login', user.userid, self.name)
+        dispatcher = self.request.registry.queryUtility(IAfterLoginDispatcher)
+        if dispatcher is not None:
+            dispatcher.dispatch(AfterLogin(
+                self.request.registry, user.userid, self.name, first_login=first_login))
 
+    @timed('store')
     def store(self, user, data):
         assert IUser.providedBy(user)
         assert isinstance(data, dict)
@@ -265,10 +437,11 @@ class PASProvider(object):
         else:
             provider_data[self.name] = data
             stored_keys.update(data)
+            audit_event(self.request, 'link', user.userid, self.name)
+        save_token(self, user)
         if stored_keys:
             self.logger.debug("provider %s data changed for user %s", self.name, user.userid)
-            event = ObjectUpdatedEvent(user, changed = ['pas_ident'])
-            objectEventNotify(event)
+            queue_pas_reindex(user, providers=[self.name])
         return stored_keys
 
     def get_email(self, response, validated=False): #pragma: no coverage
@@ -284,23 +457,45 @@ class PASProvider(object):
 
 def add_pas(config, factory):
     """
+    Register a provider. Its settings file is read and validated when the
+    configuration is committed, so a broken file stops the application from
+    starting instead of breaking every page that lists the providers.
+
+    The same factory may be configured several times under different names,
+    like 'arche_pas.providers.gamma:gamma_it'. Each name gets a subclass of
+    the factory with its own settings.
+
     :param config: Instance of a Pyramid configuration object.
     :param factory: The PasProvider factory.
     """
     from os.path import isfile
-    from json import loads
     assert IPASProvider.implementedBy(factory)
     assert factory.name, "Factory must have a name"
-    provider_name = factory.__module__
-    filename = config.registry.settings['arche_pas.providers'][provider_name]
-    if not isfile(filename):
-        raise IOError("Can't find any file at: '%s'" % filename)
-    with open(filename, 'r') as f:
-        config_data = f.read()
-    pas_settings = loads(config_data)
-    factory.update_settings(pas_settings)
-    factory.validate_settings()
-    config.registry.registerAdapter(factory, name = factory.name)
+    settings = config.registry.settings
+    found = False
+    for (spec, filename) in settings['arche_pas.providers'].items():
+        module_name, _sep, name = spec.partition(':')
+        if module_name != factory.__module__:
+            continue
+        found = True
+        if not isfile(filename):
+            raise IOError("Can't find any file at: '%s'" % filename)
+        if name:
+            provider = type(factory.__name__, (factory,), {
+                '__module__': factory.__module__,
+                'name': name,
+                'settings': None,
+            })
+        else:
+            provider = factory
+        if config.registry.adapters.lookup((IRequest,), IPASProvider, name=provider.name) is not None:
+            raise ProviderConfigError("A provider named %r is already registered" % provider.name)
+        provider.settings_file = filename
+        provider.reload_interval = settings.get('arche_pas.reload_interval', 0)
+        config.registry.registerAdapter(provider, name = provider.name)
+        config.action(('arche_pas.settings', provider.name), provider.load_settings)
+    if not found:
+        raise ProviderConfigError("No settings file configured for %s" % factory.__module__)
 
 
 def get_register_case(registry=None, as_scores = False, **kw):
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import cProfile
+import hmac
+import os
+import random
+from datetime import datetime
+from os.path import basename
+from os.path import getmtime
+from os.path import getsize
+from os.path import isdir
+from os.path import join
+
+from arche.interfaces import IRoot
+from arche.security import PERM_MANAGE_SYSTEM
+from arche.views.base import BaseView
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.response import FileResponse
+from pyramid.settings import asbool
+from six import text_type
+
+from arche_pas import _
+from arche_pas import logger
+
+
+PAS_PATHS = ('/pas_begin/', '/pas_callback/', '/pas_register/', '/pas_link/')
+PROFILE_HEADER = 'X-PAS-Profile'
+SUFFIX = '.pstats'
+
+
+class ProfileStore(object):
+    """ A bounded ring of profile stat files in a directory. The oldest are removed. """
+
+    def __init__(self, directory, keep=20):
+        self.directory = directory
+        self.keep = keep
+
+    def filenames(self):
+        """ Newest first. Names start with a timestamp so sorting by name is enough. """
+        return sorted((x for x in os.listdir(self.directory) if x.endswith(SUFFIX)), reverse=True)
+
+    def save(self, profile, path_info):
+        name = "%s-%s-%s%s" % (
+            datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f'),
+            os.getpid(),
+            path_info.strip('/').split('/', 1)[0],
+            SUFFIX,
+        )
+        profile.dump_stats(join(self.directory, name))
+        for old in self.filenames()[self.keep:]:
+            try:
+                os.remove(join(self.directory, old))
+            except OSError:  # pragma: no coverage
+                #Another worker got there first
+                pass
+        return name
+
+    def get_path(self, name):
+        name = basename(name)
+        if name not in self.filenames():
+            return None
+        return join(self.directory, name)
+
+
+def _token_matches(value, token):
+    """ Constant time comparison, so the token can't be guessed from response times. """
+    if not value:
+        return False
+    #compare_digest wants the same type on both sides, and only ASCII if it's text
+    if isinstance(value, text_type):
+        value = value.encode('utf-8')
+    if isinstance(token, text_type):
+        token = token.encode('utf-8')
+    return hmac.compare_digest(value, token)
+
+
+def profiling_tween_factory(handler, registry):
+    settings = registry.settings
+    store = registry.pas_profile_store
+    sample_rate = float(settings.get('arche_pas.profiling.sample_rate', 0))
+    header_token = settings.get('arche_pas.profiling.header_token', '')
+
+    def profiling_tween(request):
+        if not request.path_info.startswith(PAS_PATHS):
+            return handler(request)
+        wanted = header_token and _token_matches(request.headers.get(PROFILE_HEADER, None), header_token)
+        if not wanted and not (sample_rate and random.random() < sample_rate):
+            return handler(request)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(handler, request)
+        finally:
+            try:
+                name = store.save(profile, request.path_info)
+                logger.debug("Saved profile of %s as %s", request.path_info, name)
+            except (IOError, OSError):
+                logger.exception("Couldn't save profile for %s", request.path_info)
+
+    return profiling_tween
+
+
+class ProfilesView(BaseView):
+    """ List and download stored profiles. """
+
+    @property
+    def store(self):
+        return self.request.registry.pas_profile_store
+
+    def __call__(self):
+        profiles = []
+        for name in self.store.filenames():
+            fn = join(self.store.directory, name)
+            try:
+                profiles.append({'name': name, 'size': getsize(fn),
+                                 'modified': datetime.fromtimestamp(getmtime(fn))})
+            except OSError:  # pragma: no coverage
+                #Removed while listing
+                continue
+        return {'profiles': profiles, 'title': _("PAS request profiles")}
+
+    def download(self):
+        fn = self.store.get_path(self.request.GET.get('name', ''))
+        if fn is None:
+            raise HTTPNotFound()
+        response = FileResponse(fn, request=self.request, content_type=str('application/octet-stream'))
+        response.content_disposition = str('attachment; filename="%s"' % basename(fn))
+        return response
+
+
+def includeme(config):
+    """ Profile PAS requests. Settings:
+
+        arche_pas.profiling = true
+        arche_pas.profiling.directory = %(here)s/../var/pas_profiles
+        # Fraction of PAS requests to profile
+        arche_pas.profiling.sample_rate = 0.01
+        # Profile requests that have the header X-PAS-Profile set to this value
+        arche_pas.profiling.header_token = some-secret
+        # Number of profiles to keep
+        arche_pas.profiling.keep = 20
+    """
+    settings = config.registry.settings
+    if not asbool(settings.get('arche_pas.profiling', False)):
+        return
+    directory = settings.get('arche_pas.profiling.directory', '')
+    if not isdir(directory):
+        raise IOError("arche_pas.profiling.directory must be an existing directory, got: '%s'" % directory)
+    keep = int(settings.get('arche_pas.profiling.keep', 20))
+    config.registry.pas_profile_store = ProfileStore(directory, keep=keep)
+    config.add_tween('arche_pas.profiling.profiling_tween_factory')
+    config.add_view(ProfilesView, context=IRoot, name='pas_profiles',
+                    renderer='arche_pas:templates/profiles.pt', permission=PERM_MANAGE_SYSTEM)
+    config.add_view(ProfilesView, context=IRoot, name='pas_profile_download', attr='download',
+                    permission=PERM_MANAGE_SYSTEM)
@@ -1,8 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from requests_oauthlib import OAuth2Session
-from requests_oauthlib.compliance_fixes import facebook_compliance_fix
 from six import string_types
 
 from arche_pas.models import PASProvider
@@ -14,6 +12,7 @@ class FacebookOAuth2(PASProvider):
     title = "Facebook"
     id_key = 'id'
     image_key = 'picture'
+    image_hosts = ('fbcdn.net', 'fbsbx.com')
     trust_email = True
 
     default_settings = {
@@ -38,11 +37,12 @@ class FacebookOAuth2(PASProvider):
             raise cls.ProviderConfigError(exc.message)
 
     def get_session(self):
-        fb = OAuth2Session(
+        fb = self.oauth2_session(
             self.settings['client_id'],
             scope=self.settings['scope'],
             redirect_uri=self.callback_url()
         )
+        from requests_oauthlib.compliance_fixes import facebook_compliance_fix
         facebook_compliance_fix(fb)
         return fb
 
@@ -56,12 +56,15 @@ class FacebookOAuth2(PASProvider):
 
     def callback(self):
         fb = self.get_session()
-        res = fb.fetch_token(
-            self.settings['token_uri'],
-            client_secret=self.settings['client_secret'],
-            authorization_response=self.request.url
-        )
-        profile_response = fb.get(self.settings['profile_uri'])
+        with self.timer('fetch_token'):
+            res = fb.fetch_token(
+                self.settings['token_uri'],
+                client_secret=self.settings['client_secret'],
+                authorization_response=self.request.url
+            )
+        self.token = res
+        with self.timer('profile'):
+            profile_response = fb.get(self.settings['profile_uri'])
         profile_data = profile_response.json()
         self.logger.debug("FB profile data: %s", profile_data)
         return profile_data
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+
+from arche_pas.models import PASProvider
+
+
+class FakeOAuth2(PASProvider):
+    """ Provider for the local fake identity provider in arche_pas.fake_idp.
+        Only meant for load testing - never enable this on a real site!
+    """
+    name = "fake"
+    title = "Fake"
+    id_key = 'sub'
+    paster_config_ns = __name__
+    default_settings = {
+        "client_id": "fake",
+        "client_secret": "fake",
+        "auth_uri": "http://127.0.0.1:8081/authorize",
+        "token_uri": "http://127.0.0.1:8081/token",
+        "profile_uri": "http://127.0.0.1:8081/userinfo",
+    }
+    trust_email = True
+
+    def begin(self):
+        auth_session = self.oauth2_session(
+            client_id=self.settings['client_id'],
+            redirect_uri=self.callback_url()
+        )
+        kw = {}
+        #Let load drivers pick identity
+        login_hint = self.request.GET.get('login_hint', None)
+        if login_hint:
+            kw['login_hint'] = login_hint
+        authorization_url, state = auth_session.authorization_url(
+            self.settings['auth_uri'], **kw
+        )
+        return authorization_url
+
+    def callback(self):
+        auth_session = self.oauth2_session(
+            client_id=self.settings['client_id'],
+            redirect_uri=self.callback_url()
+        )
+        with self.timer('fetch_token'):
+            res = auth_session.fetch_token(
+                self.settings['token_uri'],
+                code=self.request.GET.get('code', ''),
+                client_secret=self.settings['client_secret'],
+            )
+        self.token = res
+        with self.timer('profile'):
+            profile_response = auth_session.get(self.settings['profile_uri'])
+        profile_data = profile_response.json()
+        return profile_data
+
+    def get_email(self, response, validated=False):
+        email = response.get('email', None)
+        if email:
+            if validated:
+                if response.get('email_verified', False):
+                    return email
+            else:
+                return email
+
+    def registration_appstruct(self, response):
+        return dict(
+            first_name=response.get('given_name', ''),
+            last_name=response.get('family_name', ''),
+        )
+
+
+def includeme(config):
+    config.add_pas(FakeOAuth2)
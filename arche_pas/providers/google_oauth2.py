@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from requests_oauthlib import OAuth2Session
 from six import string_types
 
 from arche_pas.models import PASProvider
@@ -13,6 +12,7 @@ class GoogleOAuth2(PASProvider):
     title = "Google"
     id_key = 'sub'
     image_key = 'picture'
+    image_hosts = ('googleusercontent.com',)
     trust_email = True
     default_settings = {
         "auth_uri":"https://accounts.google.com/o/oauth2/auth",
@@ -37,9 +37,9 @@ class GoogleOAuth2(PASProvider):
             raise cls.ProviderConfigError(exc.message)
 
     def get_session(self):
-        return OAuth2Session(self.settings['client_id'],
-                             scope=self.settings['scope'],
-                             redirect_uri=self.callback_url())
+        return self.oauth2_session(self.settings['client_id'],
+                                   scope=self.settings['scope'],
+                                   redirect_uri=self.callback_url())
 
     def begin(self):
         # OAuth endpoints given in the Google API documentation
@@ -52,12 +52,15 @@ class GoogleOAuth2(PASProvider):
 
     def callback(self):
         google = self.get_session()
-        #Should we do anything with the token response? Auth is handled by Arche anyway.
+        #The token is kept in the token vault if it's enabled
         #We should probably store the image url
-        res = google.fetch_token(self.settings['token_uri'],
-                                  client_secret=self.settings['client_secret'],
-                                  authorization_response=self.request.url)
-        profile_response = google.get(self.settings['profile_uri'])
+        with self.timer('fetch_token'):
+            res = google.fetch_token(self.settings['token_uri'],
+                                      client_secret=self.settings['client_secret'],
+                                      authorization_response=self.request.url)
+        self.token = res
+        with self.timer('profile'):
+            profile_response = google.get(self.settings['profile_uri'])
         profile_data = profile_response.json()
         return profile_data
 
@@ -1,5 +1,3 @@
-from requests_oauthlib import OAuth2Session
-
 from arche_pas.models import PASProvider
 from arche_pas import _
 
@@ -13,7 +11,7 @@ class WPOauth2(PASProvider):
     trust_email = False
 
     def begin(self):
-        auth_session = OAuth2Session(
+        auth_session = self.oauth2_session(
             client_id=self.settings['client_id'],
             #scope=self.settings['scope'],
             redirect_uri=self.callback_url()
@@ -24,17 +22,19 @@ class WPOauth2(PASProvider):
         return authorization_url
 
     def callback(self):
-        auth_session = OAuth2Session(
+        auth_session = self.oauth2_session(
             client_id=self.settings['client_id'],
             redirect_uri=self.callback_url()
         )
-        #Use token response any other way?
-        res = auth_session.fetch_token(
-            self.settings['token_uri'],
-            code=self.request.GET.get('code', ''),
-            client_secret=self.settings['client_secret'],
-        )
-        profile_response = auth_session.get(self.settings['profile_uri'])
+        with self.timer('fetch_token'):
+            res = auth_session.fetch_token(
+                self.settings['token_uri'],
+                code=self.request.GET.get('code', ''),
+                client_secret=self.settings['client_secret'],
+            )
+        self.token = res
+        with self.timer('profile'):
+            profile_response = auth_session.get(self.settings['profile_uri'])
         profile_data = profile_response.json()
         return profile_data
 
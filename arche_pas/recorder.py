@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+""" Record anonymised provider callbacks, to replay them against a local
+    database with arche_pas_replay.
+
+        arche_pas.record.directory = %(here)s/../var/pas_recordings
+        # Secret used to create pseudonyms. Keep it the same on all workers,
+        # otherwise the same email will get different pseudonyms.
+        arche_pas.record.salt = <random string>
+        # Share of callbacks to record, 1 records all of them
+        arche_pas.record.sample = 0.1
+
+    Profile data is kept with the same structure, but every string is replaced
+    by a pseudonym. Emails stay emails, under example.invalid. Booleans,
+    numbers and None are kept as they are, since they're things like
+    'email_verified'. The registration case that was picked and the local
+    state that decided it are recorded along with it, so the state can be
+    recreated when replaying.
+"""
+from __future__ import unicode_literals
+
+import hmac
+import json
+import os
+import random
+from copy import deepcopy
+from hashlib import sha256
+from time import gmtime
+from time import strftime
+from time import time
+
+from six import string_types
+from zope.interface import implementer
+
+from arche_pas import logger
+from arche_pas.exceptions import ProviderConfigError
+from arche_pas.interfaces import ICallbackRecorder
+from arche_pas.workers import BackgroundWorker
+
+
+class Anonymiser(object):
+    """ Replaces strings with keyed pseudonyms. The same value always gets the same pseudonym. """
+
+    def __init__(self, salt):
+        self.salt = salt.encode('utf-8')
+
+    def pseudonym(self, value):
+        return hmac.new(self.salt, value.encode('utf-8'), sha256).hexdigest()[:16]
+
+    def __call__(self, value):
+        if isinstance(value, dict):
+            return dict((k, self(v)) for (k, v) in value.items())
+        if isinstance(value, (list, tuple)):
+            return [self(x) for x in value]
+        if isinstance(value, string_types):
+            if '@' in value:
+                #Case doesn't matter for email lookups
+                return '%s@example.invalid' % self.pseudonym(value.lower())
+            return 'anon-%s' % self.pseudonym(value)
+        return value
+
+
+@implementer(ICallbackRecorder)
+class CallbackRecorder(object):
+    """ Callbacks are queued by the request and anonymised and written by a
+        background thread, so recording adds next to nothing to the login.
+        If the queue is full, callbacks aren't recorded.
+    """
+
+    def __init__(self, directory, salt, sample=1.0, queue_size=1000):
+        self.directory = directory
+        self.anonymise = Anonymiser(salt)
+        self.sample = sample
+        self.worker = BackgroundWorker(self._write_item, 'arche_pas callback recorder', queue_size=queue_size)
+
+    def build_record(self, provider_name, id_key, profile_data, case, state, timestamp):
+        profile = self.anonymise(profile_data)
+        ident = profile_data.get(id_key, None)
+        if ident is not None and not isinstance(ident, string_types):
+            #Numeric ids would otherwise be kept as they are
+            profile[id_key] = self.anonymise('%s' % ident)
+        record = dict(state)
+        record.update({
+            'time': round(timestamp, 3),
+            'provider': provider_name,
+            'profile': profile,
+            'case': case,
+        })
+        return record
+
+    def record(self, request, provider, profile_data, case, state):
+        if self.sample < 1 and random.random() >= self.sample:
+            return
+        item = (provider.name, provider.id_key, deepcopy(profile_data), case, dict(state), time())
+        if not self.worker.submit(item):
+            logger.warning("Callback recorder queue is full, skipping callback")
+
+    def _write_item(self, item):
+        self.write(self.build_record(*item))
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        filename = os.path.join(self.directory, 'callbacks-%s.jsonl' % strftime('%Y%m%d', gmtime(record['time'])))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def join(self):
+        """ Wait until everything queued has been written. """
+        self.worker.join()
+
+
+def record_callback(request, provider, profile_data, case, state):
+    """ Record the callback if recording is enabled. Never fails the login.
+
+        :param case: Name of the registration case that was picked, or 'login'.
+        :param state: Local state that decided the case, see CallbackRecorder.
+    """
+    recorder = request.registry.queryUtility(ICallbackRecorder)
+    if recorder is None:
+        return
+    try:
+        recorder.record(request, provider, profile_data, case, state)
+    except Exception:
+        logger.exception("Couldn't record callback for provider %r", provider.name)
+
+
+def read_recordings(filenames):
+    """ Yield (record id, record) from recording files. The id is a hash of the line,
+        so results from different runs can be compared.
+    """
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield sha256(line).hexdigest()[:16], json.loads(line.decode('utf-8'))
+
+
+def includeme(config):
+    settings = config.registry.settings
+    directory = settings.get('arche_pas.record.directory', '')
+    if not directory:
+        return
+    salt = settings.get('arche_pas.record.salt', '')
+    if not salt:
+        raise ProviderConfigError("arche_pas.record.salt must be set when recording callbacks")
+    recorder = CallbackRecorder(directory, salt, sample=float(settings.get('arche_pas.record.sample', 1)))
+    config.registry.registerUtility(recorder, ICallbackRecorder)
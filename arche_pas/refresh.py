@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import os
+from threading import Lock
+from time import sleep
+from time import time
+
+from arche.interfaces import IUser
+from repoze.catalog.query import Any
+
+from arche_pas import logger
+from arche_pas.interfaces import IPASProvider
+from arche_pas.interfaces import ITokenVault
+from arche_pas.tokens import commit_tokens
+
+
+class RateLimiter(object):
+    """ Token bucket allowing rate calls per second with bursts up to burst calls.
+        Thread safe, wait() blocks until a call is allowed.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.allowance = float(burst)
+        self.last = time()
+        self._lock = Lock()
+
+    def wait(self):
+        while True:
+            with self._lock:
+                now = time()
+                self.allowance = min(self.burst, self.allowance + (now - self.last) * self.rate)
+                self.last = now
+                if self.allowance >= 1:
+                    self.allowance -= 1
+                    return
+                delay = (1 - self.allowance) / self.rate
+            sleep(delay)
+
+
+class Checkpoint(object):
+    """ Remembers the docid of the last user that was completely processed, in a JSON file. """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self):
+        if not self.filename or not os.path.isfile(self.filename):
+            return None
+        with open(self.filename) as f:
+            return json.load(f).get('last_docid', None)
+
+    def save(self, docid):
+        if not self.filename:
+            return
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'last_docid': docid, 'saved': time()}, f)
+        os.rename(tmp, self.filename)
+
+    def clear(self):
+        if self.filename and os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+
+def iter_userids(users, after=None):
+    """ Userids in order, starting after the checkpoint. Doesn't load any users. """
+    for userid in users.keys():
+        if after is None or userid > after:
+            yield userid
+
+
+def iter_token_docids(request, after=None):
+    """ Docids of users with stored tokens for configured providers, in order and
+        starting after the checkpoint. Read from the pas_tokens index, so no users
+        are loaded.
+    """
+    names = [name for (name, provider) in request.registry.getAdapters((request,), IPASProvider)]
+    if not names:
+        return iter(())
+    docids = request.root.catalog.query(Any('pas_tokens', names))[1]
+    if after is None:
+        return iter(docids)
+    return iter(docids.keys(min=after, excludemin=True))
+
+
+def fetch_profiles(request, docids, limiters=None, pool=None):
+    """ Fetch profiles for all stored tokens of the users with these docids.
+        Expired tokens are refreshed first. Requests are made concurrently if a
+        thread pool is passed, and each provider is throttled by its RateLimiter
+        in limiters. All database access happens in this thread.
+
+        Returns (tokens, profiles, failed). tokens are the refreshed tokens as
+        [(userid, provider_name, token)], profiles [(userid, provider_name, profile_data)].
+        Nothing is stored, see refresh_profiles.
+    """
+    limiters = limiters or {}
+    failed = 0
+    jobs = []
+    for user in request.resolve_docids(docids, perm = None):
+        if not IUser.providedBy(user):
+            continue
+        vault = ITokenVault(user)
+        for provider_name in vault:
+            provider = request.registry.queryAdapter(request, IPASProvider, name=provider_name)
+            if provider is None:
+                continue
+            token = vault.get(provider_name)
+            if token is None:
+                failed += 1
+                continue
+            jobs.append((user.userid, provider, token))
+
+    def _call(limiter, method, *args):
+        if limiter is not None:
+            limiter.wait()
+        return method(*args)
+
+    def _fetch(job):
+        userid, provider, token = job
+        limiter = limiters.get(provider.name, None)
+        new_token = None
+        try:
+            expires_at = token.get('expires_at', None)
+            if expires_at is not None and expires_at <= time():
+                new_token = _call(limiter, provider.refresh_token, token)
+                if new_token is None:
+                    return None, None
+                token = new_token
+            return new_token, _call(limiter, provider.fetch_profile,
+                                    {'access_token': token['access_token'], 'token_type': 'Bearer'})
+        except Exception:
+            logger.exception("Fetching %s profile for %s failed", provider.name, userid)
+            #A refreshed token must be kept even if the profile couldn't be fetched
+            return new_token, None
+
+    if pool is None:
+        results = [_fetch(x) for x in jobs]
+    else:
+        results = pool.map(_fetch, jobs)
+    tokens = []
+    profiles = []
+    for ((userid, provider, token), (new_token, profile_data)) in zip(jobs, results):
+        if new_token is not None:
+            tokens.append((userid, provider.name, new_token))
+        if profile_data:
+            profiles.append((userid, provider.name, profile_data))
+        else:
+            failed += 1
+    return tokens, profiles, failed
+
+
+def store_profiles(request, profiles):
+    """ Store [(userid, provider_name, profile_data)]. Profiles for a different
+        account than the one linked are skipped. Returns a dict with counts.
+    """
+    users = request.root['users']
+    counts = {'fetched': 0, 'changed': 0, 'failed': 0}
+    for (userid, provider_name, profile_data) in profiles:
+        user = users.get(userid, None)
+        provider = request.registry.queryAdapter(request, IPASProvider, name=provider_name)
+        if user is None or provider is None or \
+                profile_data.get(provider.id_key, None) != provider.get_id(user):
+            counts['failed'] += 1
+            continue
+        counts['fetched'] += 1
+        if provider.store(user, profile_data):
+            counts['changed'] += 1
+    return counts
+
+
+def refresh_profiles(request, docids, limiters=None, pool=None):
+    """ Fetch and store profiles for the users with these docids and commit,
+        together with any tokens that were refreshed on the way. See commit_tokens
+        for how conflicts are handled.
+
+        Returns (counts, pending), pending are refreshed tokens that couldn't be
+        committed.
+    """
+    tokens, profiles, failed = fetch_profiles(request, docids, limiters=limiters, pool=pool)
+    counts = {}
+
+    def apply(request):
+        #Stored again on each attempt, with users loaded in the new transaction
+        counts.update(store_profiles(request, profiles))
+
+    pending = commit_tokens(request, tokens, apply=apply)
+    counts['failed'] += failed
+    return counts, pending
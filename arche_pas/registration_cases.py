@@ -8,6 +8,7 @@ from pyramid.httpexceptions import HTTPFound
 
 from arche_pas import _
 from arche_pas.models import register_case
+from arche_pas.tokens import stash_token
 
 
 def callback_case_1(provider, user, data):
@@ -47,6 +48,7 @@ def callback_must_be_logged_in(provider, user, data):
 def callback_register(provider, user, data):
     reg_id = str(uuid4())
     provider.request.session[reg_id] = data
+    stash_token(provider, reg_id)
     # Register this user
     return reg_id
 
@@ -55,6 +57,7 @@ def callback_maybe_attach_account(provider, user, data):
     """ Only for logged in users."""
     reg_id = str(uuid4())
     provider.request.session[reg_id] = data
+    stash_token(provider, reg_id)
     raise HTTPFound(location=provider.request.route_url('pas_link', provider=provider.name, reg_id=reg_id))
 
 
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+""" Reindex users when the configured providers change.
+
+    The name and id key of each configured provider is stored on the root.
+    The arche_pas_reindex_providers script compares it with the current
+    configuration, or a background thread does when the application starts
+    if arche_pas.auto_reindex is enabled. Users linked to providers that were added, removed
+    or had their id key changed are reindexed in committed batches. Users are
+    found through the pas_providers index, so nobody else is loaded.
+
+    Only one worker does the reindex. The others see that it has been claimed,
+    unless the claim is older than arche_pas.auto_reindex.lease seconds, in
+    which case the worker that claimed it is assumed to have died.
+"""
+from __future__ import unicode_literals
+
+from threading import Thread
+from time import time
+
+import transaction
+from pyramid.interfaces import IApplicationCreated
+from pyramid.scripting import prepare
+from pyramid.settings import asbool
+from ZODB.POSException import ConflictError
+
+from arche_pas import logger
+from arche_pas.catalog import get_id_keys
+from arche_pas.catalog import queue_pas_reindex
+from arche_pas.decommission import find_linked_docids
+
+
+def get_stored_providers(root):
+    """ {provider name: id key} as of the last start, or None before the first one. """
+    return getattr(root, '__pas_providers__', None)
+
+
+def changed_providers(old, new):
+    """ Names of providers that were added, removed or got a different id key. """
+    if old is None:
+        return []
+    return sorted(name for name in set(old) | set(new) if old.get(name) != new.get(name))
+
+
+def claim_reindex(root, current, now=None, lease=3600):
+    """ Record the current providers on root, and return the names of providers
+        whose users should be reindexed by this worker, or an empty list.
+        Must be committed before the reindex starts, a ConflictError on commit
+        means another worker got there first.
+    """
+    now = now is None and time() or now
+    changed = changed_providers(get_stored_providers(root), current)
+    if changed or get_stored_providers(root) is None:
+        root.__pas_providers__ = dict(current)
+    pending = getattr(root, '__pas_reindex_pending__', None)
+    names = set(changed)
+    if pending is not None:
+        (pending_names, claimed) = pending
+        if not changed and now - claimed < lease:
+            #Someone else is working on it
+            return []
+        names.update(pending_names)
+    if names:
+        root.__pas_reindex_pending__ = (tuple(sorted(names)), now)
+    return sorted(names)
+
+
+def finish_reindex(root):
+    root.__pas_reindex_pending__ = None
+
+
+def reindex_linked_users(request, names, batch_size=500):
+    """ Reindex users linked to any of names, committing after each batch.
+        Returns the number of users.
+    """
+    root = request.root
+    docids = find_linked_docids(root, names)
+    count = 0
+    for i in range(0, len(docids), batch_size):
+        batch = docids[i:i + batch_size]
+        for attempt in range(3):
+            users = list(request.resolve_docids(batch, perm = None))
+            for user in users:
+                queue_pas_reindex(user, changed=['pas_ident'], data_changed=False)
+            try:
+                transaction.commit()
+            except ConflictError:
+                transaction.abort()
+                logger.info("Conflict while reindexing, retrying batch")
+            else:
+                break
+        else:
+            raise ConflictError("Gave up reindexing after repeated conflicts")
+        count += len(users)
+        root._p_jar.cacheMinimize()
+    return count
+
+
+def run_reindex(registry, batch_size=500, lease=3600):
+    """ Check for changed providers and reindex their users. """
+    env = prepare(registry=registry)
+    try:
+        root = env['root']
+        names = claim_reindex(root, get_id_keys(registry), lease=lease)
+        try:
+            transaction.commit()
+        except ConflictError:
+            transaction.abort()
+            logger.info("Another worker is checking for changed providers")
+            return
+        if not names:
+            return
+        logger.info("Providers %s changed, reindexing linked users", ", ".join(names))
+        start = time()
+        count = reindex_linked_users(env['request'], names, batch_size=batch_size)
+        finish_reindex(root)
+        transaction.commit()
+        logger.info("Reindexed %s users in %.1f seconds", count, time() - start)
+    except Exception:
+        transaction.abort()
+        logger.exception("Reindex after provider changes failed, it will be retried on next start")
+    finally:
+        env['closer']()
+
+
+_auto_reindex_disabled = False
+
+
+def disable_auto_reindex():
+    """ Don't start the reindex thread in this process, for console scripts.
+        pyramid.paster.bootstrap creates the application too, and the thread
+        would be killed when the script exits, leaving its claim behind.
+    """
+    global _auto_reindex_disabled
+    _auto_reindex_disabled = True
+
+
+def start_reindex(event):
+    if _auto_reindex_disabled:
+        return
+    registry = event.app.registry
+    settings = registry.settings
+    thread = Thread(
+        target=run_reindex,
+        args=(registry,),
+        kwargs={'batch_size': int(settings.get('arche_pas.auto_reindex.batch_size', 500)),
+                'lease': int(settings.get('arche_pas.auto_reindex.lease', 3600))},
+        name='arche_pas reindex',
+    )
+    thread.daemon = True
+    thread.start()
+
+
+def includeme(config):
+    if asbool(config.registry.settings.get('arche_pas.auto_reindex', False)):
+        config.add_subscriber(start_reindex, IApplicationCreated)
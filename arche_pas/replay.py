@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+""" Replay recorded provider callbacks through the registration case matching
+    and store(), to measure throughput and to see if the outcome changes
+    between versions.
+
+    Each record is replayed in its own transaction, which is always aborted.
+    The local state from the recording (a linked user, a user with the same
+    email, an authenticated user) is created first, so the database is never
+    changed and may be any local test database.
+"""
+from __future__ import unicode_literals
+
+from collections import Counter
+from timeit import default_timer
+
+import transaction
+from arche.api import User
+from pyramid.interfaces import IAuthenticationPolicy
+from pyramid.security import Authenticated
+from pyramid.security import Everyone
+from zope.interface import implementer
+
+from arche_pas.interfaces import IPASProvider
+from arche_pas.interfaces import IProviderData
+from arche_pas.models import get_register_case
+
+
+PHASES = ('setup', 'match', 'store')
+
+
+@implementer(IAuthenticationPolicy)
+class ReplayAuthenticationPolicy(object):
+    """ Authenticated as userid, which is set for each record. """
+    userid = None
+
+    def unauthenticated_userid(self, request):
+        return self.userid
+
+    def authenticated_userid(self, request):
+        return self.userid
+
+    def effective_principals(self, request):
+        if self.userid is None:
+            return [Everyone]
+        return [Everyone, Authenticated, self.userid]
+
+    def remember(self, request, userid, **kw):
+        return []
+
+    def forget(self, request):
+        return []
+
+
+class Replayer(object):
+
+    def __init__(self, request):
+        self.request = request
+        self.policy = ReplayAuthenticationPolicy()
+        request.registry.registerUtility(self.policy, IAuthenticationPolicy)
+        self.timings = dict((x, 0.0) for x in PHASES)
+        self.count = 0
+
+    def setup_state(self, provider, record):
+        users = self.request.root['users']
+        profile = record['profile']
+        self.policy.userid = None
+        if record.get('authenticated'):
+            users['replay-authenticated'] = User()
+            self.policy.userid = 'replay-authenticated'
+        if record.get('linked'):
+            #Data must be there before the user is added, that's when it's indexed
+            user = User()
+            IProviderData(user)[provider.name] = {provider.id_key: profile.get(provider.id_key)}
+            users['replay-linked'] = user
+        if record.get('user_exist_locally'):
+            email = provider.get_email(profile, validated=True) or provider.get_email(profile)
+            user = users['replay-email'] = User(email=email)
+            user.email_validated = record.get('email_validated_locally', False)
+
+    def replay(self, record):
+        """ Returns the name of the matched case, 'login' or an error string. """
+        provider = self.request.registry.queryAdapter(self.request, IPASProvider, name=record['provider'])
+        if provider is None:
+            return 'error: unknown provider'
+        profile = record['profile']
+        try:
+            start = default_timer()
+            self.setup_state(provider, record)
+            setup_done = default_timer()
+            user = provider.get_user(profile.get(provider.id_key))
+            if user is not None:
+                case = 'login'
+            else:
+                params = provider.build_reg_case_params(profile)
+                case = get_register_case(registry=self.request.registry, **params).name
+                user = User()
+            stored = default_timer()
+            provider.store(user, profile)
+            end = default_timer()
+        except Exception as exc:
+            return 'error: %s' % exc.__class__.__name__
+        finally:
+            transaction.abort()
+        self.timings['setup'] += setup_done - start
+        self.timings['match'] += stored - setup_done
+        self.timings['store'] += end - stored
+        self.count += 1
+        return case
+
+
+def replay_all(request, recordings):
+    """ Replay (record id, record) pairs. Returns (results, report) where results
+        is {record id: replayed case}.
+    """
+    replayer = Replayer(request)
+    results = {}
+    differences = Counter()
+    start = default_timer()
+    for (record_id, record) in recordings:
+        case = results[record_id] = replayer.replay(record)
+        if case != record.get('case'):
+            differences[(record.get('case'), case)] += 1
+    elapsed = default_timer() - start
+    report = {
+        'records': len(results),
+        'seconds': round(elapsed, 3),
+        'per_second': elapsed and round(len(results) / elapsed, 1) or None,
+        'phases': dict((k, round(v, 3)) for (k, v) in replayer.timings.items()),
+        'cases': dict(Counter(results.values())),
+        'differences': [{'recorded': k[0], 'replayed': k[1], 'count': v}
+                        for (k, v) in differences.most_common()],
+    }
+    return results, report
+
+
+def compare_results(old, new):
+    """ Records with different cases in two runs: [(record id, old case, new case)] """
+    return sorted((k, old[k], new[k]) for k in set(old) & set(new) if old[k] != new[k])
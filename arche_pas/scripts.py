@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+""" Console scripts. All of them take the paster .ini file of the site as first argument. """
+from __future__ import unicode_literals
+
+import argparse
+import io
+import sys
+from multiprocessing.pool import ThreadPool
+from time import sleep
+from time import time
+
+import transaction
+from pyramid.paster import bootstrap
+from pyramid.paster import setup_logging
+from ZODB.POSException import ConflictError
+
+from arche_pas import logger
+
+
+def get_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('config_uri', help="Paster .ini file, like etc/production.ini")
+    return parser
+
+
+def get_env(args):
+    from arche_pas.reindex import disable_auto_reindex
+    setup_logging(args.config_uri)
+    #Scripts exit before a reindex in a background thread would be done
+    disable_auto_reindex()
+    return bootstrap(args.config_uri)
+
+
+def batched(iterable, size):
+    """ Yield lists of at most size items. """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def commit_batch(root):
+    """ Commit and release cached objects. Returns False on conflicts. """
+    try:
+        transaction.commit()
+    except ConflictError:
+        logger.warning("Conflict while committing batch, it will be retried on the next run.")
+        transaction.abort()
+        return False
+    finally:
+        root._p_jar.cacheMinimize()
+    return True
+
+
+def refresh_tokens_script(argv=sys.argv):
+    from arche_pas.tokens import commit_tokens
+    from arche_pas.tokens import iter_due_tokens
+    from arche_pas.tokens import refresh_tokens
+
+    parser = get_parser("Refresh stored OAuth tokens that are about to expire.")
+    parser.add_argument('--margin', type=int, default=600,
+                        help="Refresh tokens expiring within this many seconds.")
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help="Tokens per commit.")
+    parser.add_argument('--threads', type=int, default=4,
+                        help="Concurrent requests to the providers.")
+    parser.add_argument('--loop', type=int, default=0,
+                        help="Keep running and check again after this many seconds.")
+    args = parser.parse_args(argv[1:])
+    env = get_env(args)
+    root = env['root']
+    pool = ThreadPool(args.threads)
+    #Refreshed tokens that couldn't be committed yet, the old ones may already be invalid
+    pending = []
+    try:
+        while True:
+            count = 0
+            due = iter_due_tokens(env['request'], time() + args.margin)
+            for batch in batched(due, args.batch_size):
+                tokens = pending + refresh_tokens(env['request'], batch, pool=pool)
+                pending = commit_tokens(env['request'], tokens)
+                count += len(tokens) - len(pending)
+            if pending:
+                retried = len(pending)
+                pending = commit_tokens(env['request'], pending)
+                count += retried - len(pending)
+            logger.info("Refreshed %s tokens", count)
+            if not args.loop:
+                break
+            sleep(args.loop)
+        if pending:
+            logger.error("Gave up storing refreshed tokens for: %s",
+                         ", ".join("%s (%s)" % (userid, name) for (userid, name, token) in pending))
+            return 1
+    finally:
+        pool.close()
+        env['closer']()
+
+
+def refresh_profiles_script(argv=sys.argv):
+    from arche_pas.refresh import Checkpoint
+    from arche_pas.refresh import RateLimiter
+    from arche_pas.refresh import iter_token_docids
+    from arche_pas.interfaces import IPASProvider
+    from arche_pas.refresh import refresh_profiles
+
+    parser = get_parser("Fetch profiles from the providers for all users with a stored token.")
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help="Users per commit.")
+    parser.add_argument('--threads', type=int, default=4,
+                        help="Concurrent requests to the providers.")
+    parser.add_argument('--rate', action='append', default=[], metavar='PROVIDER=N',
+                        help="Max requests per second for a provider, like gamma=5. May be repeated.")
+    parser.add_argument('--default-rate', type=float, default=10,
+                        help="Max requests per second for providers without --rate.")
+    parser.add_argument('--checkpoint', default='',
+                        help="File to store progress in. The run resumes from it if it exists.")
+    parser.add_argument('--restart', action='store_true',
+                        help="Ignore existing checkpoint.")
+    args = parser.parse_args(argv[1:])
+    rates = dict(x.split('=', 1) for x in args.rate)
+    env = get_env(args)
+    request = env['request']
+    limiters = {}
+    for (name, provider) in request.registry.getAdapters((request,), IPASProvider):
+        limiters[name] = RateLimiter(float(rates.get(name, args.default_rate)))
+    checkpoint = Checkpoint(args.checkpoint)
+    if args.restart:
+        checkpoint.clear()
+    after = checkpoint.load()
+    if after is not None:
+        logger.info("Resuming after docid %s", after)
+    totals = {'fetched': 0, 'changed': 0, 'failed': 0}
+    pool = ThreadPool(args.threads)
+    try:
+        for docids in batched(iter_token_docids(request, after), args.batch_size):
+            counts, pending = refresh_profiles(request, docids, limiters=limiters, pool=pool)
+            if pending:
+                #Stop here so the batch is retried from the checkpoint
+                logger.error("Gave up storing refreshed tokens for: %s",
+                             ", ".join("%s (%s)" % (userid, name) for (userid, name, token) in pending))
+                return 1
+            checkpoint.save(docids[-1])
+            for k in totals:
+                totals[k] += counts[k]
+            logger.info("Processed %s users: %s", len(docids), totals)
+        checkpoint.clear()
+    finally:
+        pool.close()
+        env['closer']()
+    logger.info("Done: %s", totals)
+
+
+def import_links_script(argv=sys.argv):
+    from arche_pas.bulk import import_batch
+    from arche_pas.bulk import read_records
+
+    parser = get_parser("Link existing users to provider accounts, from CSV or JSON lines.")
+    parser.add_argument('filename',
+                        help="Records with 'userid' or 'email', 'provider' and 'ident'. "
+                             "Other fields are stored as profile data.")
+    parser.add_argument('--format', choices=('csv', 'jsonl'), default=None,
+                        help="Guessed from the file extension if not given.")
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help="Records per commit.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Check and process everything, but don't commit.")
+    parser.add_argument('--errors', default='',
+                        help="Write failed rows to this file instead of stderr.")
+    args = parser.parse_args(argv[1:])
+    env = get_env(args)
+    root = env['root']
+    request = env['request']
+    users = root['users']
+    totals = {'linked': 0, 'updated': 0, 'unchanged': 0, 'failed': 0}
+    error_out = args.errors and io.open(args.errors, 'w', encoding='utf-8') or sys.stderr
+    try:
+        for batch in batched(read_records(args.filename, args.format), args.batch_size):
+            counts, errors = import_batch(request, users, batch)
+            for (num, msg) in errors:
+                error_out.write("line %s: %s\n" % (num, msg))
+            if args.dry_run:
+                transaction.abort()
+                root._p_jar.cacheMinimize()
+            elif not commit_batch(root):
+                logger.error("Stopped at line %s. Rows already imported are skipped when run again.",
+                             batch[0][0])
+                return 1
+            for k in totals:
+                totals[k] += counts[k]
+            logger.info("Processed up to line %s: %s", batch[-1][0], totals)
+    finally:
+        if error_out is not sys.stderr:
+            error_out.close()
+        env['closer']()
+    logger.info("Done%s: %s", args.dry_run and " (dry run, nothing saved)" or "", totals)
+
+
+def remove_providers_script(argv=sys.argv):
+    from arche_pas.decommission import find_linked_docids
+    from arche_pas.decommission import remove_provider_data
+    from arche_pas.decommission import unconfigured_providers
+    from arche_pas.exceptions import PASIndexEmpty
+
+    parser = get_parser("Remove stored data and tokens for providers from all users.")
+    parser.add_argument('names', nargs='*', metavar='PROVIDER',
+                        help="Provider names to remove.")
+    parser.add_argument('--unconfigured', action='store_true',
+                        help="Remove all providers that aren't configured.")
+    parser.add_argument('--batch-size', type=int, default=200,
+                        help="Users per commit.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Only report how many users are linked.")
+    args = parser.parse_args(argv[1:])
+    if not args.names and not args.unconfigured:
+        parser.error("Give provider names or --unconfigured")
+    env = get_env(args)
+    root = env['root']
+    request = env['request']
+    try:
+        names = set(args.names)
+        if args.unconfigured:
+            names.update(unconfigured_providers(request))
+        if not names:
+            logger.info("Nothing to remove")
+            return
+        names = sorted(names)
+        try:
+            docids = find_linked_docids(root, names)
+        except PASIndexEmpty as exc:
+            logger.error("%s", exc)
+            return 1
+        logger.info("%s users linked to %s", len(docids), ", ".join(names))
+        if args.dry_run:
+            return
+        removed = 0
+        for (i, batch) in enumerate(batched(docids, args.batch_size)):
+            count = remove_provider_data(request, batch, names)
+            if not commit_batch(root):
+                return 1
+            removed += count
+            logger.info("Processed %s of %s users, removed data from %s",
+                        min((i + 1) * args.batch_size, len(docids)), len(docids), removed)
+    finally:
+        env['closer']()
+
+
+def export_script(argv=sys.argv):
+    from arche_pas.export import FORMATTERS
+    from arche_pas.catalog import get_id_keys
+    from arche_pas.export import iter_export
+    from arche_pas.export import select_userids
+
+    parser = get_parser("Export linked providers and stored profile data.")
+    parser.add_argument('--format', choices=sorted(FORMATTERS), default='jsonl')
+    parser.add_argument('--provider', action='append', default=[],
+                        help="Only export this provider. May be repeated.")
+    parser.add_argument('--userid', action='append', default=[],
+                        help="Only export this user. May be repeated.")
+    parser.add_argument('--output', default='',
+                        help="Write to this file instead of stdout.")
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help="Users to load before releasing them from the cache.")
+    args = parser.parse_args(argv[1:])
+    env = get_env(args)
+    root = env['root']
+    request = env['request']
+    if args.output:
+        out = io.open(args.output, 'w', encoding='utf-8')
+    else:
+        out = io.open(sys.stdout.fileno(), 'w', encoding='utf-8', closefd=False)
+    try:
+        providers = args.provider or None
+        userids = select_userids(request, providers, args.userid, batch_size=args.batch_size)
+        rows = iter_export(root['users'], userids, providers, get_id_keys(request.registry),
+                           batch_size=args.batch_size)
+        for line in FORMATTERS[args.format](rows):
+            out.write(line)
+    finally:
+        out.close()
+        env['closer']()
+
+
+def backfill_summary_script(argv=sys.argv):
+    from arche_pas.catalog import get_id_keys
+    from arche_pas.catalog import get_pas_summary
+    from arche_pas.catalog import update_pas_summary
+    from arche_pas.refresh import iter_userids
+
+    parser = get_parser("Create the PAS summary on users that don't have one.")
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help="Users per commit.")
+    parser.add_argument('--force', action='store_true',
+                        help="Rebuild the summary for all users.")
+    args = parser.parse_args(argv[1:])
+    env = get_env(args)
+    root = env['root']
+    users = root['users']
+    id_keys = get_id_keys(env['registry'])
+    count = 0
+    try:
+        for userids in batched(iter_userids(users), args.batch_size):
+            changed = 0
+            for userid in userids:
+                user = users[userid]
+                if args.force or get_pas_summary(user) is None:
+                    update_pas_summary(user, id_keys)
+                    changed += 1
+            if not commit_batch(root):
+                return 1
+            count += changed
+            logger.info("Processed up to %s, %s summaries created", userids[-1], count)
+    finally:
+        env['closer']()
+
+
+def reindex_providers_script(argv=sys.argv):
+    from arche_pas.reindex import run_reindex
+
+    parser = get_parser("Reindex users linked to providers that were added, removed or changed id key.")
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help="Users per commit.")
+    parser.add_argument('--lease', type=int, default=3600,
+                        help="Take over a reindex claimed by someone else after this many seconds.")
+    args = parser.parse_args(argv[1:])
+    env = get_env(args)
+    try:
+        run_reindex(env['registry'], batch_size=args.batch_size, lease=args.lease)
+    finally:
+        env['closer']()
+
+
+def aggregate_logins_script(argv=sys.argv):
+    from arche_pas.audit import collect_last_logins
+    from arche_pas.audit import iter_records
+    from arche_pas.audit import load_position
+    from arche_pas.audit import save_position
+    from arche_pas.audit import set_last_logins
+    from arche_pas.interfaces import IPASAuditLog
+
+    parser = get_parser("Store last login times from the PAS audit log on users. "
+                        "Run it periodically, it continues where it stopped last time.")
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help="Users per commit.")
+    args = parser.parse_args(argv[1:])
+    env = get_env(args)
+    root = env['root']
+    users = root['users']
+    try:
+        audit_log = env['registry'].queryUtility(IPASAuditLog)
+        if audit_log is None:
+            logger.error("arche_pas.audit.directory isn't set")
+            return 2
+        position = load_position(audit_log.directory)
+        last_logins = {}
+        count = 0
+        for (record, position) in iter_records(audit_log.directory, position):
+            collect_last_logins([record], last_logins)
+            count += 1
+        changed = 0
+        for userids in batched(sorted(last_logins), args.batch_size):
+            for userid in userids:
+                user = users.get(userid, None)
+                if user is not None and set_last_logins(user, last_logins[userid]):
+                    changed += 1
+            if not commit_batch(root):
+                #Times are only ever increased, so the whole run is safe to repeat
+                return 1
+        if position is not None:
+            save_position(audit_log.directory, position)
+        logger.info("Read %s records, updated %s users", count, changed)
+    finally:
+        env['closer']()
+
+
+def audit_query_script(argv=sys.argv):
+    import json
+    from arche_pas.audit import get_audit_reader
+
+    parser = get_parser("Show PAS audit log records for a user or provider, newest first.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--userid')
+    group.add_argument('--provider')
+    parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args(argv[1:])
+    env = get_env(args)
+    try:
+        reader = get_audit_reader(env['registry'])
+        if reader is None:
+            logger.error("arche_pas.audit.directory isn't set")
+            return 2
+        if args.userid:
+            records = reader.for_user(args.userid, limit=args.limit)
+        else:
+            records = reader.for_provider(args.provider, limit=args.limit)
+        for record in records:
+            print(json.dumps(record, sort_keys=True))
+    finally:
+        env['closer']()
+
+
+def replay_script(argv=sys.argv):
+    import json
+    from arche_pas.recorder import read_recordings
+    from arche_pas.replay import compare_results
+    from arche_pas.replay import replay_all
+
+    parser = get_parser("Replay recorded provider callbacks against a local database and report "
+                        "throughput and changed registration cases. Nothing is committed. "
+                        "Don't run it against a live site, it replaces the authentication policy "
+                        "within this process.")
+    parser.add_argument('recordings', nargs='+', help="Files written by the callback recorder.")
+    parser.add_argument('--results', default='',
+                        help="Save the replayed case of each record to this file.")
+    parser.add_argument('--compare', default='',
+                        help="Compare with results saved by an earlier run, for instance "
+                             "with another version of the code.")
+    args = parser.parse_args(argv[1:])
+    env = get_env(args)
+    try:
+        results, report = replay_all(env['request'], read_recordings(args.recordings))
+        if args.compare:
+            with open(args.compare) as f:
+                old = json.load(f)
+            report['changed_since_compare'] = [
+                {'record': k, 'before': a, 'after': b} for (k, a, b) in compare_results(old, results)]
+        if args.results:
+            with open(args.results, 'w') as f:
+                json.dump(results, f, sort_keys=True)
+        print(json.dumps(report, indent=2, sort_keys=True))
+    finally:
+        env['closer']()
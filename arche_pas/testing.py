@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+""" Helpers for tests. """
+from __future__ import unicode_literals
+
+from threading import Lock
+from threading import Thread
+from time import sleep
+from time import time
+
+from six.moves.socketserver import StreamRequestHandler
+from six.moves.socketserver import ThreadingTCPServer
+
+
+class LocalMemcachedServer(ThreadingTCPServer):
+    """ Stand-in for memcached that speaks the part of the text protocol
+        arche_pas.cache.MemcachedCache uses. Listens on a random local port.
+
+        server = LocalMemcachedServer()
+        server.start()
+        cache = MemcachedCache([server.address])
+        ...
+        server.stop()
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    #Pause this many seconds in the middle of each value sent, to test clients timing out
+    value_delay = 0
+
+    def __init__(self, host='127.0.0.1', port=0):
+        ThreadingTCPServer.__init__(self, (host, port), MemcachedHandler)
+        self.data = {}
+        self.lock = Lock()
+
+    @property
+    def address(self):
+        return "%s:%s" % self.server_address
+
+    def start(self):
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MemcachedHandler(StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                continue
+            command = parts[0]
+            now = time()
+            if command == b'get':
+                with server.lock:
+                    value, expires = server.data.get(parts[1], (None, None))
+                if value is not None and (not expires or expires > now):
+                    self.wfile.write(b'VALUE ' + parts[1] + b' 0 ' + str(len(value)).encode('ascii') + b'\r\n')
+                    if server.value_delay:
+                        half = len(value) // 2
+                        self.wfile.write(value[:half])
+                        self.wfile.flush()
+                        sleep(server.value_delay)
+                        value = value[half:]
+                    self.wfile.write(value + b'\r\n')
+                self.wfile.write(b'END\r\n')
+            elif command in (b'set', b'add'):
+                key, exptime, length = parts[1], int(parts[3]), int(parts[4])
+                value = self.rfile.read(length + 2)[:length]
+                expires = exptime and now + exptime or None
+                with server.lock:
+                    current, current_expires = server.data.get(key, (None, None))
+                    exists = current is not None and (not current_expires or current_expires > now)
+                    if command == b'add' and exists:
+                        self.wfile.write(b'NOT_STORED\r\n')
+                        continue
+                    server.data[key] = (value, expires)
+                self.wfile.write(b'STORED\r\n')
+            elif command == b'delete':
+                with server.lock:
+                    found = server.data.pop(parts[1], None) is not None
+                self.wfile.write(found and b'DELETED\r\n' or b'NOT_FOUND\r\n')
+            else:
+                self.wfile.write(b'ERROR\r\n')
@@ -0,0 +1,78 @@
+import unittest
+
+import transaction
+from pyramid import testing
+
+
+class AfterLoginDispatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        transaction.abort()
+        testing.tearDown()
+
+    @property
+    def _cut(self):
+        from arche_pas.after_login import AfterLoginDispatcher
+        return AfterLoginDispatcher
+
+    def _info(self, userid='jane'):
+        from arche_pas.after_login import AfterLogin
+        return AfterLogin(self.config.registry, userid, 'gamma')
+
+    def test_inline(self):
+        L = []
+        obj = self._cut()
+        obj.add_handler(lambda info: L.append(info.userid))
+        obj.dispatch(self._info())
+        self.assertEqual(L, ['jane'])
+
+    def test_failing_handler_isolated(self):
+        L = []
+
+        def fail(info):
+            raise ValueError()
+
+        obj = self._cut()
+        obj.add_handler(fail)
+        obj.add_handler(lambda info: L.append(info.userid))
+        obj.dispatch(self._info())
+        self.assertEqual(L, ['jane'])
+
+    def test_after_commit(self):
+        L = []
+        obj = self._cut(workers=2)
+        obj.add_handler(lambda info: L.append(info.userid))
+        obj.dispatch(self._info())
+        self.assertEqual(L, [])
+        transaction.commit()
+        obj.join()
+        self.assertEqual(L, ['jane'])
+
+    def test_abort(self):
+        L = []
+        obj = self._cut(workers=1)
+        obj.add_handler(lambda info: L.append(info.userid))
+        obj.dispatch(self._info())
+        transaction.abort()
+        transaction.commit()
+        obj.join()
+        self.assertEqual(L, [])
+
+
+class AddPASAfterLoginTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_directive(self):
+        from arche_pas.after_login import get_after_login_dispatcher
+        self.config.include('arche_pas.after_login')
+        handler = lambda info: None
+        self.config.add_pas_after_login(handler)
+        self.assertEqual(get_after_login_dispatcher(self.config.registry).handlers, [handler])
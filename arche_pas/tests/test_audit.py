@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+from arche.api import User
+from pyramid import testing
+
+from arche_pas.interfaces import IPASAuditLog
+
+
+DAY = 86400
+
+
+class AuditTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        transaction.abort()
+        testing.tearDown()
+        shutil.rmtree(self.directory)
+
+    def _log(self, **kw):
+        from arche_pas.audit import AuditLog
+        return AuditLog(self.directory, **kw)
+
+    def _record(self, t, event='login', userid='jane', provider='gamma'):
+        return {'time': t, 'event': event, 'userid': userid, 'provider': provider}
+
+
+class AuditLogTests(AuditTestCase):
+
+    def test_file_per_day(self):
+        from arche_pas.audit import log_files
+        obj = self._log(keep_days=0)
+        obj.write([self._record(10), self._record(DAY + 10), self._record(20)])
+        self.assertEqual(log_files(self.directory), ['pas_audit-19700101.jsonl', 'pas_audit-19700102.jsonl'])
+
+    def test_prune(self):
+        from arche_pas.audit import log_files
+        obj = self._log(keep_days=2, clock=lambda: 5 * DAY)
+        obj.write([self._record(10), self._record(4 * DAY)])
+        self.assertEqual(log_files(self.directory), ['pas_audit-19700105.jsonl'])
+
+    def test_audit_event_after_commit(self):
+        from arche_pas.audit import audit_event
+        obj = self._log()
+        self.config.registry.registerUtility(obj, IPASAuditLog)
+        request = testing.DummyRequest()
+        audit_event(request, 'link', 'jane', 'gamma')
+        audit_event(request, 'login', 'jane', 'gamma')
+        self.assertEqual(list(obj.reader.for_user('jane')), [])
+        transaction.commit()
+        self.assertEqual([x['event'] for x in obj.reader.for_user('jane')], ['login', 'link'])
+
+    def test_audit_event_stamped_at_commit(self):
+        from arche_pas.audit import audit_event
+        from arche_pas.audit import log_files
+        now = [DAY - 1]
+        obj = self._log(keep_days=0, clock=lambda: now[0])
+        self.config.registry.registerUtility(obj, IPASAuditLog)
+        audit_event(testing.DummyRequest(), 'login', 'jane', 'gamma')
+        #Commit after midnight
+        now[0] = DAY + 1
+        transaction.commit()
+        self.assertEqual(log_files(self.directory), ['pas_audit-19700102.jsonl'])
+        self.assertEqual([x['time'] for x in obj.reader.for_user('jane')], [DAY + 1])
+
+    def test_audit_event_abort(self):
+        from arche_pas.audit import audit_event
+        obj = self._log()
+        self.config.registry.registerUtility(obj, IPASAuditLog)
+        audit_event(testing.DummyRequest(), 'login', 'jane', 'gamma')
+        transaction.abort()
+        transaction.commit()
+        self.assertEqual(list(obj.reader.for_user('jane')), [])
+
+
+class AuditReaderTests(AuditTestCase):
+
+    def test_queries(self):
+        obj = self._log(keep_days=0)
+        obj.write([self._record(10), self._record(20, userid='john', provider='github'),
+                   self._record(DAY, event='unlink')])
+        reader = obj.reader
+        self.assertEqual([x['time'] for x in reader.for_user('jane')], [DAY, 10])
+        self.assertEqual([x['userid'] for x in reader.for_provider('github')], ['john'])
+        self.assertEqual(reader.last_login('jane'), 10)
+        self.assertEqual(reader.last_login('jane', 'github'), None)
+        #Only new lines are read
+        obj.write([self._record(30)])
+        self.assertEqual([x['time'] for x in reader.for_user('jane', limit=2)], [DAY, 30])
+
+    def test_partial_line(self):
+        obj = self._log(keep_days=0)
+        obj.write([self._record(10)])
+        filename = os.path.join(self.directory, 'pas_audit-19700101.jsonl')
+        with open(filename, 'ab') as f:
+            f.write(b'{"time": 20, "event": "lo')
+        self.assertEqual(len(list(obj.reader.for_user('jane'))), 1)
+        with open(filename, 'ab') as f:
+            f.write(b'gin", "userid": "jane", "provider": "gamma"}\n')
+        self.assertEqual(len(list(obj.reader.for_user('jane'))), 2)
+
+
+class LastLoginTests(AuditTestCase):
+
+    def test_iter_records_resume(self):
+        from arche_pas.audit import iter_records
+        obj = self._log(keep_days=0)
+        obj.write([self._record(10), self._record(20)])
+        results = list(iter_records(self.directory))
+        self.assertEqual(len(results), 2)
+        position = results[0][1]
+        obj.write([self._record(DAY)])
+        self.assertEqual([x[0]['time'] for x in iter_records(self.directory, position)], [20, DAY])
+
+    def test_collect_and_store(self):
+        from arche_pas.audit import collect_last_logins
+        from arche_pas.audit import get_last_login
+        from arche_pas.audit import set_last_logins
+        logins = collect_last_logins([self._record(20), self._record(10), self._record(30, event='link'),
+                                      self._record(5, provider='github')])
+        self.assertEqual(logins, {'jane': {'gamma': 20, 'github': 5}})
+        user = User()
+        self.assertEqual(get_last_login(user), None)
+        self.assertTrue(set_last_logins(user, logins['jane']))
+        self.assertEqual(get_last_login(user), 20)
+        self.assertEqual(get_last_login(user, 'github'), 5)
+        #Older times are ignored
+        self.assertFalse(set_last_logins(user, {'gamma': 15}))
@@ -0,0 +1,110 @@
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no coverage
+    Image = None
+
+
+@unittest.skipIf(Image is None, "Pillow not installed")
+class AvatarCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @property
+    def _cut(self):
+        from arche_pas.avatars import AvatarCache
+        return AvatarCache
+
+    def _image(self):
+        out = BytesIO()
+        Image.new('RGB', (300, 200), 'red').save(out, 'JPEG')
+        return out.getvalue()
+
+    def _fake_fetch(self, obj, content, status=200):
+        import requests
+
+        class DummyRaw(object):
+            def read(self, amount, decode_content=False):
+                return content[:amount]
+
+        class DummyResponse(object):
+            raw = DummyRaw()
+            status_code = status
+            closed = False
+
+            def raise_for_status(self):
+                pass
+
+            def close(self):
+                self.closed = True
+
+        L = []
+        orig = requests.get
+
+        def _get(url, **kw):
+            self.assertFalse(kw['allow_redirects'])
+            response = DummyResponse()
+            L.append(response)
+            return response
+
+        requests.get = _get
+        self.addCleanup(setattr, requests, 'get', orig)
+        return L
+
+    def test_closest_size(self):
+        obj = self._cut(self.directory, sizes=(32, 64))
+        self.assertEqual(obj.closest_size(10), 32)
+        self.assertEqual(obj.closest_size(40), 64)
+        self.assertEqual(obj.closest_size(400), 64)
+
+    def test_resize(self):
+        obj = self._cut(self.directory, sizes=(32, 64))
+        results = dict(obj.resize(self._image()))
+        self.assertEqual(Image.open(BytesIO(results[32])).size, (32, 32))
+        self.assertEqual(Image.open(BytesIO(results[64])).size, (64, 64))
+
+    def test_get_fetches_once_per_source(self):
+        obj = self._cut(self.directory, sizes=(32,))
+        L = self._fake_fetch(obj, self._image())
+        first = obj.get('jane', 'gamma', 'http://img/1')
+        self.assertEqual(obj.get('jane', 'gamma', 'http://img/1'), first)
+        self.assertEqual(len(L), 1)
+        self.assertTrue(L[0].closed)
+        self.assertEqual(obj.lookup('jane', 'gamma', 'http://img/2'), None)
+
+    def test_redirect_not_followed(self):
+        obj = self._cut(self.directory, sizes=(32,))
+        L = self._fake_fetch(obj, self._image(), status=302)
+        self.assertRaises(ValueError, obj.get, 'jane', 'gamma', 'https://img/1')
+        self.assertTrue(L[0].closed)
+
+
+class ImageURLAllowedTests(unittest.TestCase):
+
+    @property
+    def _fut(self):
+        from arche_pas.avatars import image_url_allowed
+        return image_url_allowed
+
+    def test_allowed(self):
+        self.assertTrue(self._fut('https://lh3.googleusercontent.com/a/x', ('googleusercontent.com',)))
+        self.assertTrue(self._fut('https://googleusercontent.com/x', ('googleusercontent.com',)))
+
+    def test_not_https(self):
+        self.assertFalse(self._fut('http://lh3.googleusercontent.com/a/x', ('googleusercontent.com',)))
+        self.assertFalse(self._fut('file:///etc/passwd', ('googleusercontent.com',)))
+
+    def test_other_host(self):
+        hosts = ('googleusercontent.com',)
+        self.assertFalse(self._fut('https://169.254.169.254/latest/meta-data/', hosts))
+        self.assertFalse(self._fut('https://evilgoogleusercontent.com/x', hosts))
+        self.assertFalse(self._fut('https://googleusercontent.com.evil.example/x', hosts))
+        self.assertFalse(self._fut('https://lh3.googleusercontent.com/x', ()))
@@ -0,0 +1,231 @@
+import unittest
+from time import time
+
+from pyramid import testing
+from pyramid.interfaces import IRequest
+from pyramid.security import Authenticated
+from pyramid.security import Everyone
+
+from arche_pas.cache import LRUCache
+from arche_pas.interfaces import IPASCache
+from arche_pas.interfaces import IPASProvider
+from arche_pas.metrics import null_timer
+
+
+class _User(object):
+
+    def __init__(self, userid):
+        self.userid = userid
+
+
+class _Provider(object):
+    name = 'gamma'
+
+    def __init__(self, request):
+        self.request = request
+
+    def timer(self, phase):
+        return null_timer
+
+    def count(self, outcome):
+        pass
+
+    def get_user(self, user_ident):
+        if user_ident == 'cid-jane':
+            return _User('jane')
+
+
+class _RecordingCache(LRUCache):
+
+    def __init__(self):
+        super(_RecordingCache, self).__init__()
+        self.ttls = []
+
+    def set(self, key, value, ttl=None):
+        self.ttls.append(ttl)
+        return super(_RecordingCache, self).set(key, value, ttl=ttl)
+
+
+class _CookiePolicy(object):
+
+    def callback(self, userid, request):
+        return ['role:Owner']
+
+    def authenticated_userid(self, request):
+        return 'cookie_user'
+
+    def effective_principals(self, request):
+        return [Everyone, Authenticated, 'cookie_user', 'role:Viewer']
+
+
+class _Validator(object):
+
+    def __init__(self, result=None, exc=None):
+        self.result = result
+        self.exc = exc
+        self.calls = 0
+
+    def __call__(self, provider, token):
+        self.calls += 1
+        if self.exc is not None:
+            raise self.exc
+        return self.result
+
+
+class BearerAuthenticationPolicyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.config.registry.registerUtility(LRUCache(), IPASCache)
+        self.config.registry.registerAdapter(_Provider, (IRequest,), IPASProvider, name='gamma')
+        self.wrapped = _CookiePolicy()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    @property
+    def _cut(self):
+        from arche_pas.bearer import BearerAuthenticationPolicy
+        return BearerAuthenticationPolicy
+
+    def _request(self, token=None):
+        request = testing.DummyRequest()
+        if token:
+            request.headers['Authorization'] = 'Bearer %s' % token
+        return request
+
+    def test_no_token_delegates(self):
+        obj = self._cut(self.wrapped, 'gamma', _Validator())
+        request = self._request()
+        self.assertEqual(obj.authenticated_userid(request), 'cookie_user')
+        self.assertIn('role:Viewer', obj.effective_principals(request))
+
+    def test_valid_token(self):
+        validator = _Validator(result=('cid-jane', None))
+        obj = self._cut(self.wrapped, 'gamma', validator)
+        request = self._request('abc')
+        self.assertEqual(obj.authenticated_userid(request), 'jane')
+        self.assertEqual(obj.effective_principals(request), [Everyone, Authenticated, 'jane', 'role:Owner'])
+        self.assertEqual(validator.calls, 1)
+
+    def test_cached_between_requests(self):
+        validator = _Validator(result=('cid-jane', time() + 100))
+        obj = self._cut(self.wrapped, 'gamma', validator)
+        self.assertEqual(obj.authenticated_userid(self._request('abc')), 'jane')
+        self.assertEqual(obj.authenticated_userid(self._request('abc')), 'jane')
+        self.assertEqual(validator.calls, 1)
+
+    def test_expired(self):
+        validator = _Validator(result=('cid-jane', time() - 1))
+        obj = self._cut(self.wrapped, 'gamma', validator)
+        self.assertIsNone(obj.authenticated_userid(self._request('abc')))
+        self.assertIsNone(obj.authenticated_userid(self._request('abc')))
+        self.assertEqual(validator.calls, 1)
+
+    def test_less_than_a_second_left(self):
+        cache = _RecordingCache()
+        self.config.registry.registerUtility(cache, IPASCache)
+        obj = self._cut(self.wrapped, 'gamma', _Validator(result=('cid-jane', time() + 0.5)), positive_ttl=300)
+        self.assertIsNone(obj.authenticated_userid(self._request('abc')))
+        self.assertEqual(cache.ttls, [obj.negative_ttl])
+
+    def test_cached_until_expiry(self):
+        cache = _RecordingCache()
+        self.config.registry.registerUtility(cache, IPASCache)
+        obj = self._cut(self.wrapped, 'gamma', _Validator(result=('cid-jane', time() + 3600)), positive_ttl=300)
+        obj.authenticated_userid(self._request('abc'))
+        self.assertGreater(cache.ttls[-1], 3500)
+
+    def test_positive_ttl_without_expiry(self):
+        cache = _RecordingCache()
+        self.config.registry.registerUtility(cache, IPASCache)
+        obj = self._cut(self.wrapped, 'gamma', _Validator(result=('cid-jane', None)), positive_ttl=300)
+        obj.authenticated_userid(self._request('abc'))
+        self.assertEqual(cache.ttls, [300])
+
+    def test_invalid_token_cached(self):
+        validator = _Validator(result=None)
+        obj = self._cut(self.wrapped, 'gamma', validator)
+        request = self._request('abc')
+        self.assertEqual(obj.authenticated_userid(request), None)
+        self.assertEqual(obj.effective_principals(request), [Everyone])
+        obj.authenticated_userid(self._request('abc'))
+        self.assertEqual(validator.calls, 1)
+
+    def test_unlinked_ident(self):
+        obj = self._cut(self.wrapped, 'gamma', _Validator(result=('cid-unknown', None)))
+        self.assertEqual(obj.authenticated_userid(self._request('abc')), None)
+
+    def test_validation_error_not_cached(self):
+        validator = _Validator(exc=IOError("Connection refused"))
+        obj = self._cut(self.wrapped, 'gamma', validator)
+        self.assertEqual(obj.authenticated_userid(self._request('abc')), None)
+        obj.authenticated_userid(self._request('abc'))
+        self.assertEqual(validator.calls, 2)
+
+
+class _Response(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class _Session(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def post(self, uri, **kw):
+        return _Response(self.data)
+
+
+class _IntrospectionProvider(object):
+    name = 'gamma'
+    id_key = 'cid'
+    settings = {'client_id': 'this_site', 'client_secret': 'secret',
+                'introspection_uri': 'https://gamma.example.com/introspect'}
+
+    def __init__(self, data):
+        self.data = data
+
+    def oauth2_session(self, *args, **kw):
+        return _Session(self.data)
+
+
+class IntrospectionValidatorTests(unittest.TestCase):
+
+    def _validate(self, data, **settings):
+        from arche_pas.bearer import IntrospectionValidator
+        settings.setdefault('timeout', 5)
+        return IntrospectionValidator(settings)(_IntrospectionProvider(data), 'token')
+
+    def test_own_client(self):
+        self.assertEqual(self._validate({'active': True, 'cid': 'jane', 'aud': 'this_site', 'exp': 10}),
+                         ('jane', 10))
+        self.assertEqual(self._validate({'active': True, 'cid': 'jane', 'client_id': 'this_site'}),
+                         ('jane', None))
+
+    def test_foreign_client(self):
+        self.assertEqual(self._validate({'active': True, 'cid': 'jane', 'aud': ['other_site'],
+                                         'client_id': 'other_site'}), None)
+        self.assertEqual(self._validate({'active': True, 'cid': 'jane'}), None)
+
+    def test_configured_audience(self):
+        data = {'active': True, 'cid': 'jane', 'aud': ['api', 'other']}
+        self.assertEqual(self._validate(data, audience='api'), ('jane', None))
+        self.assertEqual(self._validate(data), None)
+
+    def test_issuer(self):
+        data = {'active': True, 'cid': 'jane', 'aud': 'this_site', 'iss': 'https://evil.example.com'}
+        self.assertEqual(self._validate(data, issuer='https://gamma.example.com'), None)
+        data['iss'] = 'https://gamma.example.com'
+        self.assertEqual(self._validate(data, issuer='https://gamma.example.com'), ('jane', None))
+
+    def test_inactive(self):
+        self.assertEqual(self._validate({'active': False, 'aud': 'this_site', 'cid': 'jane'}), None)
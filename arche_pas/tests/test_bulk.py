@@ -0,0 +1,101 @@
+import os
+import tempfile
+import unittest
+
+import transaction
+from arche.api import User
+from arche.testing import barebone_fixture
+from pyramid import testing
+from pyramid.request import apply_request_extensions
+
+from arche_pas.interfaces import IProviderData
+
+
+class ReadRecordsTests(unittest.TestCase):
+
+    def _write(self, suffix, data):
+        fd, filename = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        self.addCleanup(os.remove, filename)
+        return filename
+
+    @property
+    def _fut(self):
+        from arche_pas.bulk import read_records
+        return read_records
+
+    def test_csv(self):
+        fn = self._write('.csv', b"userid,provider,ident,nick\njane,dummy,1,J\xc3\xa4ne\njohn,dummy\n")
+        records = list(self._fut(fn))
+        self.assertEqual(records[0], (2, {'userid': 'jane', 'provider': 'dummy', 'ident': '1', 'nick': u'J\xe4ne'}))
+        self.assertEqual(records[1], (3, {'userid': 'john', 'provider': 'dummy'}))
+
+    def test_jsonl(self):
+        from arche_pas.bulk import RecordError
+        fn = self._write('.jsonl', b'{"userid": "jane", "provider": "dummy", "ident": 1}\n\nbroken\n[]\n')
+        records = list(self._fut(fn))
+        self.assertEqual(records[0], (1, {'userid': 'jane', 'provider': 'dummy', 'ident': 1}))
+        self.assertEqual([x[0] for x in records], [1, 3, 4])
+        self.assertIsInstance(records[1][1], RecordError)
+        self.assertIsInstance(records[2][1], RecordError)
+
+
+class ImportBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        transaction.abort()
+        testing.tearDown()
+
+    @property
+    def _fut(self):
+        from arche_pas.bulk import import_batch
+        return import_batch
+
+    def _fixture(self):
+        from arche_pas.models import PASProvider
+
+        class DummyProvider(PASProvider):
+            name = 'dummy'
+            id_key = 'id'
+
+        self.config.include('arche.testing')
+        self.config.include('arche.testing.catalog')
+        self.config.include('arche_pas.catalog')
+        self.config.include('arche_pas.models')
+        root = barebone_fixture(self.config)
+        request = testing.DummyRequest()
+        self.config.begin(request)
+        apply_request_extensions(request)
+        request.root = root
+        self.config.registry.registerAdapter(DummyProvider, name=DummyProvider.name)
+        for name in ('jane', 'john'):
+            root['users'][name] = User()
+        return root, request
+
+    def test_import(self):
+        root, request = self._fixture()
+        records = [
+            (1, {'userid': 'jane', 'provider': 'dummy', 'ident': 'j1', 'nick': 'jane'}),
+            (2, {'userid': 'john', 'provider': 'dummy', 'ident': 'j1'}),
+            (3, {'userid': 'nobody', 'provider': 'dummy', 'ident': 'n1'}),
+            (4, {'userid': 'john', 'provider': 'other', 'ident': 'j2'}),
+        ]
+        counts, errors = self._fut(request, root['users'], records)
+        self.assertEqual(counts, {'linked': 1, 'updated': 0, 'unchanged': 0, 'failed': 3})
+        self.assertEqual([x[0] for x in errors], [2, 3, 4])
+        self.assertEqual(dict(IProviderData(root['users']['jane'])['dummy']), {'id': 'j1', 'nick': 'jane'})
+
+    def test_import_again(self):
+        root, request = self._fixture()
+        records = [(1, {'userid': 'jane', 'provider': 'dummy', 'ident': 'j1'})]
+        self._fut(request, root['users'], records)
+        transaction.commit()
+        counts, errors = self._fut(request, root['users'], records)
+        self.assertEqual(counts['unchanged'], 1)
+        records = [(1, {'userid': 'jane', 'provider': 'dummy', 'ident': 'j2'})]
+        counts, errors = self._fut(request, root['users'], records)
+        self.assertEqual(counts['failed'], 1)
@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+import unittest
+from time import sleep
+
+from zope.interface.verify import verifyObject
+
+from arche_pas.interfaces import IPASCache
+
+
+class _CacheTests(object):
+    """ Shared tests for all backends. Subclasses define _mk, returning a new cache. """
+
+    def test_verify_object(self):
+        self.failUnless(verifyObject(IPASCache, self._mk()))
+
+    def test_get_set(self):
+        obj = self._mk()
+        self.assertEqual(obj.get('a'), None)
+        self.assertEqual(obj.get('a', 1), 1)
+        obj.set('a', {'hello': ['world']})
+        self.assertEqual(obj.get('a'), {'hello': ['world']})
+
+    def test_add(self):
+        obj = self._mk()
+        self.assertTrue(obj.add('a', 1))
+        self.assertFalse(obj.add('a', 2))
+        self.assertEqual(obj.get('a'), 1)
+
+    def test_delete(self):
+        obj = self._mk()
+        obj.set('a', 1)
+        obj.delete('a')
+        obj.delete('a')
+        self.assertEqual(obj.get('a'), None)
+
+    def test_long_key(self):
+        obj = self._mk()
+        key = 'key with spaces ' * 20
+        obj.set(key, 1)
+        self.assertEqual(obj.get(key), 1)
+
+
+class LRUCacheTests(_CacheTests, unittest.TestCase):
+
+    def _mk(self, **kw):
+        from arche_pas.cache import LRUCache
+        return LRUCache(**kw)
+
+    def test_evicts_least_recently_used(self):
+        obj = self._mk(maxsize=2)
+        obj.set('a', 1)
+        obj.set('b', 2)
+        obj.get('a')
+        obj.set('c', 3)
+        self.assertEqual(obj.get('b'), None)
+        self.assertEqual(obj.get('a'), 1)
+
+    def test_ttl(self):
+        now = [100]
+        obj = self._mk(clock=lambda: now[0])
+        obj.set('a', 1, ttl=10)
+        self.assertEqual(obj.get('a'), 1)
+        now[0] = 111
+        self.assertEqual(obj.get('a'), None)
+        self.assertTrue(obj.add('a', 2))
+
+
+class SQLiteCacheTests(_CacheTests, unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _mk(self, **kw):
+        from arche_pas.cache import SQLiteCache
+        return SQLiteCache(os.path.join(self.directory, 'cache.db'), **kw)
+
+    def test_shared_between_instances(self):
+        self._mk().set('a', 1)
+        self.assertEqual(self._mk().get('a'), 1)
+
+    def test_ttl(self):
+        now = [100]
+        obj = self._mk(clock=lambda: now[0])
+        obj.set('a', 1, ttl=10)
+        now[0] = 111
+        self.assertEqual(obj.get('a'), None)
+        self.assertTrue(obj.add('a', 2))
+
+
+class MemcachedCacheTests(_CacheTests, unittest.TestCase):
+
+    def setUp(self):
+        from arche_pas.testing import LocalMemcachedServer
+        self.server = LocalMemcachedServer()
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _mk(self):
+        from arche_pas.cache import MemcachedCache
+        return MemcachedCache([self.server.address])
+
+    def test_stalled_response(self):
+        from arche_pas.cache import MemcachedCache
+        obj = MemcachedCache([self.server.address], timeout=0.2)
+        obj.set('a', 'value of a')
+        obj.set('b', 'value of b')
+        self.server.value_delay = 0.5
+        self.assertEqual(obj.get('a', 'default'), 'default')
+        self.server.value_delay = 0
+        #Let the rest of the stalled response arrive
+        sleep(0.5)
+        self.assertEqual(obj.get('b'), 'value of b')
+
+    def test_ttl_rounded_up(self):
+        obj = self._mk()
+        self.assertEqual(obj._ttl(0.2), 1)
+        self.assertEqual(obj._ttl(1.5), 2)
+        self.assertEqual(obj._ttl(None), 0)
+
+    def test_server_down_is_a_miss(self):
+        from arche_pas.cache import MemcachedCache
+        obj = MemcachedCache(['127.0.0.1:1'])
+        self.assertEqual(obj.get('a', 'default'), 'default')
+        self.assertFalse(obj.add('a', 1))
+
+
+class CacheFromSettingTests(unittest.TestCase):
+
+    @property
+    def _fut(self):
+        from arche_pas.cache import cache_from_setting
+        return cache_from_setting
+
+    def test_default(self):
+        from arche_pas.cache import LRUCache
+        obj = self._fut('')
+        self.assertIsInstance(obj, LRUCache)
+        self.assertEqual(obj.maxsize, 10000)
+
+    def test_memcached(self):
+        from arche_pas.cache import MemcachedCache
+        obj = self._fut('memcached:10.0.0.1:11211 10.0.0.2:11212')
+        self.assertIsInstance(obj, MemcachedCache)
+        self.assertEqual(obj.servers, [('10.0.0.1', 11211), ('10.0.0.2', 11212)])
+
+    def test_bad(self):
+        from arche_pas.exceptions import ProviderConfigError
+        self.assertRaises(ProviderConfigError, self._fut, 'redis:localhost')
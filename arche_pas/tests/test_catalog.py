@@ -0,0 +1,195 @@
+import unittest
+
+import transaction
+from arche.api import User
+from arche.interfaces import IObjectUpdatedEvent
+from arche.interfaces import IUser
+from pyramid import testing
+
+from arche_pas.interfaces import IProviderData
+
+
+class GetPASProvidersTests(unittest.TestCase):
+
+    @property
+    def _fut(self):
+        from arche_pas.catalog import get_pas_providers
+        return get_pas_providers
+
+    def test_linked(self):
+        user = User()
+        provider_data = IProviderData(user)
+        provider_data['one'] = {'id': 1}
+        provider_data['two'] = {'id': 2}
+        self.assertEqual(sorted(self._fut(user, None)), ['one', 'two'])
+
+    def test_nothing_linked(self):
+        user = User()
+        self.assertEqual(self._fut(user, None), None)
+        self.assertFalse(hasattr(user, '__pas_provider_data__'))
+
+    def test_not_user(self):
+        self.assertEqual(self._fut(testing.DummyModel(), None), None)
+
+
+class GetPASTokenExpiryTests(unittest.TestCase):
+
+    @property
+    def _fut(self):
+        from arche_pas.catalog import get_pas_token_expiry
+        return get_pas_token_expiry
+
+    def test_first_expiry(self):
+        user = User()
+        user.__pas_tokens__ = {'one': (200, 'x'), 'two': (100, 'y'), 'three': (None, 'z')}
+        self.assertEqual(self._fut(user, None), 100)
+
+    def test_no_tokens(self):
+        user = User()
+        self.assertEqual(self._fut(user, None), None)
+        user.__pas_tokens__ = {'one': (None, 'x')}
+        self.assertEqual(self._fut(user, None), None)
+
+
+class GetPASTokensTests(unittest.TestCase):
+
+    @property
+    def _fut(self):
+        from arche_pas.catalog import get_pas_tokens
+        return get_pas_tokens
+
+    def test_tokens(self):
+        user = User()
+        self.assertEqual(self._fut(user, None), None)
+        user.__pas_tokens__ = {'one': (None, 'x'), 'two': (100, 'y')}
+        self.assertEqual(sorted(self._fut(user, None)), ['one', 'two'])
+
+
+class ProviderCountsTests(unittest.TestCase):
+
+    @property
+    def _fut(self):
+        from arche_pas.catalog import provider_counts
+        return provider_counts
+
+    def _index(self, cls, *linked):
+        from arche_pas.catalog import get_pas_providers
+        index = cls(get_pas_providers)
+        for (docid, names) in enumerate(linked):
+            index.index_doc(docid, self._user(docid, names))
+        return index
+
+    def _user(self, docid, names):
+        user = User()
+        provider_data = IProviderData(user)
+        for name in names:
+            provider_data[name] = {'id': docid}
+        return user
+
+    def test_counts(self):
+        from arche_pas.catalog import PASProvidersIndex
+        index = self._index(PASProvidersIndex, ['one'], ['one', 'two'], [])
+        self.assertEqual(self._fut({'pas_providers': index}), {'one': 2, 'two': 1})
+
+    def test_counts_follow_changes(self):
+        from arche_pas.catalog import PASProvidersIndex
+        index = self._index(PASProvidersIndex, ['one'], ['one', 'two'])
+        index.reindex_doc(1, self._user(1, ['two', 'three']))
+        self.assertEqual(self._fut({'pas_providers': index}), {'one': 1, 'two': 1, 'three': 1})
+        #No provider data left unindexes the user
+        index.reindex_doc(0, self._user(0, []))
+        index.unindex_doc(1)
+        index.unindex_doc(1)
+        self.assertEqual(self._fut({'pas_providers': index}), {})
+
+    def test_counts_without_counters(self):
+        from repoze.catalog.indexes.keyword import CatalogKeywordIndex
+        index = self._index(CatalogKeywordIndex, ['one'], ['one', 'two'], [])
+        self.assertEqual(self._fut({'pas_providers': index}), {'one': 2, 'two': 1})
+
+
+class QueuePASReindexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        transaction.abort()
+        testing.tearDown()
+
+    @property
+    def _fut(self):
+        from arche_pas.catalog import queue_pas_reindex
+        return queue_pas_reindex
+
+    def test_once_per_user_on_commit(self):
+        L = []
+
+        def subsc(obj, event):
+            L.append(event)
+
+        self.config.add_subscriber(subsc, [IUser, IObjectUpdatedEvent])
+        one = User()
+        two = User()
+        self._fut(one)
+        self._fut(one, changed=['pas_ident'])
+        self._fut(two)
+        self.assertEqual(L, [])
+        transaction.commit()
+        self.assertEqual([x.object for x in L], [one, two])
+        self.assertEqual(L[0].changed, ['pas_ident', 'pas_providers'])
+
+    def test_serial(self):
+        from arche_pas.catalog import get_pas_serial
+        user = User()
+        self.assertEqual(get_pas_serial(user), 0)
+        self._fut(user)
+        self._fut(user)
+        transaction.commit()
+        self.assertEqual(get_pas_serial(user), 1)
+
+    def test_index_only(self):
+        from arche_pas.catalog import get_pas_serial
+        L = []
+        self.config.add_subscriber(lambda obj, event: L.append(event), [IUser, IObjectUpdatedEvent])
+        one = User()
+        two = User()
+        self._fut(one, changed=['pas_ident'], data_changed=False)
+        self._fut(two, changed=['pas_ident'], data_changed=False)
+        self._fut(two)
+        transaction.commit()
+        self.assertEqual(len(L), 2)
+        self.assertEqual(get_pas_serial(one), 0)
+        self.assertEqual(getattr(one, '__pas_summary__', None), None)
+        self.assertEqual(get_pas_serial(two), 1)
+
+    def test_abort(self):
+        L = []
+        self.config.add_subscriber(lambda obj, event: L.append(event), [IUser, IObjectUpdatedEvent])
+        self._fut(User())
+        transaction.abort()
+        transaction.commit()
+        self.assertEqual(L, [])
+
+
+class PASSummaryTests(unittest.TestCase):
+
+    @property
+    def _fut(self):
+        from arche_pas.catalog import update_pas_summary
+        return update_pas_summary
+
+    def test_summary(self):
+        from arche_pas.catalog import get_pas_summary
+        user = User()
+        self.assertEqual(get_pas_summary(user), None)
+        provider_data = IProviderData(user)
+        provider_data['one'] = {'cid': 'a'}
+        provider_data['two'] = {'id': 'b'}
+        self._fut(user, {'one': 'cid', 'two': 'id'}, updated=['one'], now=10)
+        self.assertEqual(get_pas_summary(user), {'one': {'ident': 'a', 'updated': 10},
+                                                 'two': {'ident': 'b', 'updated': None}})
+        del provider_data['two']
+        self._fut(user, {'one': 'cid'}, now=20)
+        self.assertEqual(get_pas_summary(user), {'one': {'ident': 'a', 'updated': 10}})
+
@@ -0,0 +1,78 @@
+import unittest
+
+import transaction
+from arche.api import User
+from arche.testing import barebone_fixture
+from pyramid import testing
+from pyramid.request import apply_request_extensions
+
+from arche_pas.interfaces import IProviderData
+
+
+class RemoveProviderDataTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        transaction.abort()
+        testing.tearDown()
+
+    def _fixture(self):
+        self.config.include('arche.testing')
+        self.config.include('arche.testing.catalog')
+        self.config.include('arche_pas.catalog')
+        self.config.include('arche_pas.models')
+        self.config.include('arche_pas.tokens')
+        root = barebone_fixture(self.config)
+        request = testing.DummyRequest()
+        self.config.begin(request)
+        apply_request_extensions(request)
+        request.root = root
+        for (name, providers) in (('jane', ['old', 'gamma']), ('john', ['old']), ('jim', ['gamma'])):
+            user = User()
+            for provider_name in providers:
+                IProviderData(user)[provider_name] = {'id': name}
+            root['users'][name] = user
+        return root, request
+
+    def test_find_linked_docids(self):
+        from arche_pas.decommission import find_linked_docids
+        root, request = self._fixture()
+        docids = find_linked_docids(root, ['old'])
+        self.assertEqual(len(docids), 2)
+        self.assertEqual(len(find_linked_docids(root, ['old', 'gamma'])), 3)
+
+    def test_remove(self):
+        from arche_pas.decommission import find_linked_docids
+        from arche_pas.decommission import remove_provider_data
+        root, request = self._fixture()
+        docids = find_linked_docids(root, ['old'])
+        self.assertEqual(remove_provider_data(request, docids, ['old']), 2)
+        transaction.commit()
+        self.assertEqual(find_linked_docids(root, ['old']), [])
+        self.assertEqual(list(IProviderData(root['users']['jane'])), ['gamma'])
+        self.assertEqual(len(find_linked_docids(root, ['gamma'])), 2)
+
+    def test_find_linked_docids_index_empty(self):
+        from arche_pas.decommission import find_linked_docids
+        from arche_pas.exceptions import PASIndexEmpty
+        root, request = self._fixture()
+        root.catalog['pas_providers'].clear()
+        self.assertRaises(PASIndexEmpty, find_linked_docids, root, ['old'])
+        for user in root['users'].values():
+            IProviderData(user).clear()
+        self.assertEqual(find_linked_docids(root, ['old']), [])
+
+    def test_view_one_batch(self):
+        from arche_pas.decommission import RemoveProvidersView
+        root, request = self._fixture()
+        request.method = 'POST'
+        view = RemoveProvidersView(root, request)
+        view.batch_size = 1
+        result = view.remove(['old'])
+        self.assertEqual(result['removed'], 1)
+        self.assertEqual(result['remaining'], 1)
+        transaction.commit()
+        result = view.remove(['old'])
+        self.assertEqual((result['removed'], result['remaining']), (1, 0))
@@ -0,0 +1,54 @@
+import json
+import unittest
+
+from arche.api import User
+
+from arche_pas.interfaces import IProviderData
+
+
+class IterExportTests(unittest.TestCase):
+
+    @property
+    def _fut(self):
+        from arche_pas.export import iter_export
+        return iter_export
+
+    def _users(self):
+        users = {}
+        for (name, providers) in (('jane', ['gamma', 'old']), ('john', []), ('jim', ['gamma'])):
+            user = User(email='%s@example.com' % name)
+            for provider_name in providers:
+                IProviderData(user)[provider_name] = {'cid': name, 'nick': name.title()}
+            users[name] = user
+        return users
+
+    def test_all(self):
+        rows = list(self._fut(self._users(), sorted(['jane', 'john', 'jim']), id_keys={'gamma': 'cid'}))
+        self.assertEqual([(x['userid'], x['provider']) for x in rows],
+                         [('jane', 'gamma'), ('jane', 'old'), ('jim', 'gamma')])
+        self.assertEqual(rows[0]['ident'], 'jane')
+        self.assertEqual(rows[0]['email'], 'jane@example.com')
+        self.assertEqual(rows[1]['ident'], None)
+        self.assertEqual(rows[1]['data'], {'cid': 'jane', 'nick': 'Jane'})
+
+    def test_filter_provider(self):
+        rows = list(self._fut(self._users(), ['jane', 'missing'], providers=['old']))
+        self.assertEqual([(x['userid'], x['provider']) for x in rows], [('jane', 'old')])
+
+
+class FormatTests(unittest.TestCase):
+
+    def _rows(self):
+        return [{'userid': 'jane', 'email': 'jane@example.com', 'provider': 'gamma',
+                 'ident': 'cid', 'data': {'nick': u'J\xe4ne'}}]
+
+    def test_jsonl(self):
+        from arche_pas.export import format_jsonl
+        lines = list(format_jsonl(self._rows()))
+        self.assertEqual(json.loads(lines[0]), self._rows()[0])
+
+    def test_csv(self):
+        from arche_pas.export import format_csv
+        lines = list(format_csv(self._rows()))
+        self.assertEqual(lines[0].strip(), 'userid,email,provider,ident,data')
+        self.assertIn(u'jane,jane@example.com,gamma,cid', lines[1])
@@ -0,0 +1,54 @@
+import json
+import unittest
+
+from webob import Request
+
+
+class FakeIdPTests(unittest.TestCase):
+
+    @property
+    def _cut(self):
+        from arche_pas.fake_idp import FakeIdP
+        return FakeIdP
+
+    def _authorize(self, app, ident='jane'):
+        request = Request.blank('/authorize?redirect_uri=http://localhost/cb&state=abc&login_hint=%s' % ident)
+        response = request.get_response(app)
+        self.assertEqual(response.status_int, 302)
+        self.assertIn('state=abc', response.location)
+        return response.location.split('code=')[1].split('&')[0]
+
+    def _token(self, app, **post):
+        response = Request.blank('/token', POST=post).get_response(app)
+        return response.status_int, json.loads(response.text)
+
+    def test_full_flow(self):
+        app = self._cut()
+        code = self._authorize(app)
+        status, token = self._token(app, grant_type='authorization_code', code=code)
+        self.assertEqual(status, 200)
+        request = Request.blank('/userinfo', headers={'Authorization': str('Bearer ' + token['access_token'])})
+        response = request.get_response(app)
+        self.assertEqual(json.loads(response.text)['sub'], 'jane')
+
+    def test_code_only_valid_once(self):
+        app = self._cut()
+        code = self._authorize(app)
+        self._token(app, grant_type='authorization_code', code=code)
+        status, data = self._token(app, grant_type='authorization_code', code=code)
+        self.assertEqual(status, 400)
+        self.assertEqual(data['error'], 'invalid_grant')
+
+    def test_refresh(self):
+        app = self._cut()
+        code = self._authorize(app)
+        status, token = self._token(app, grant_type='authorization_code', code=code)
+        status, token = self._token(app, grant_type='refresh_token', refresh_token=token['refresh_token'])
+        self.assertEqual(status, 200)
+
+    def test_error_injection(self):
+        app = self._cut(error_rate=1.0)
+        code = self._authorize(app)
+        status, data = self._token(app, grant_type='authorization_code', code=code)
+        self.assertEqual(status, 500)
+        self.assertEqual(app.stats['errors'], 1)
@@ -0,0 +1,114 @@
+import unittest
+from threading import Thread
+
+from pyramid import testing
+from zope.interface.verify import verifyObject
+from zope.interface.verify import verifyClass
+
+from arche_pas.interfaces import IPASMetrics
+
+
+class PASMetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    @property
+    def _cut(self):
+        from arche_pas.metrics import PASMetrics
+        return PASMetrics
+
+    def test_verify_object(self):
+        self.failUnless(verifyObject(IPASMetrics, self._cut()))
+
+    def test_verify_class(self):
+        self.failUnless(verifyClass(IPASMetrics, self._cut))
+
+    def test_observe(self):
+        obj = self._cut(buckets=(0.1, 1.0))
+        obj.observe('gamma', 'get_user', 0.05)
+        obj.observe('gamma', 'get_user', 0.5)
+        obj.observe('gamma', 'get_user', 5)
+        buckets, total, count = obj.get_histogram('gamma', 'get_user')
+        self.assertEqual(buckets, (1, 2, 3))
+        self.assertAlmostEqual(total, 5.55)
+        self.assertEqual(count, 3)
+
+    def test_timer_counts_errors(self):
+        obj = self._cut()
+
+        def _fail():
+            with obj.timer('gamma', 'store'):
+                raise ValueError()
+
+        self.assertRaises(ValueError, _fail)
+        self.assertEqual(obj.get_histogram('gamma', 'store')[2], 1)
+        self.assertEqual(obj.get_count('gamma', 'store_error'), 1)
+
+    def test_render(self):
+        obj = self._cut(buckets=(1.0,))
+        obj.observe('gamma', 'store', 0.5)
+        obj.incr('gamma', 'login')
+        text = obj.render()
+        self.assertIn('arche_pas_phase_seconds_bucket{provider="gamma",phase="store",le="1"} 1', text)
+        self.assertIn('arche_pas_phase_seconds_bucket{provider="gamma",phase="store",le="+Inf"} 1', text)
+        self.assertIn('arche_pas_phase_seconds_count{provider="gamma",phase="store"} 1', text)
+        self.assertIn('arche_pas_outcomes_total{provider="gamma",outcome="login"} 1', text)
+
+
+    def test_render_while_observing(self):
+        obj = self._cut()
+        done = []
+
+        def observe():
+            for i in range(2000):
+                obj.observe('gamma', 'phase%s' % i, 0.1)
+            done.append(True)
+
+        thread = Thread(target=observe)
+        thread.start()
+        try:
+            while not done:
+                obj.render()
+        finally:
+            thread.join()
+        self.assertIn('phase="phase1999"', obj.render())
+
+    def test_render_after_clear(self):
+        obj = self._cut()
+        obj.observe('gamma', 'store', 0.5)
+        obj.clear()
+        self.assertNotIn('gamma', obj.render())
+
+
+class GetTimerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    @property
+    def _fut(self):
+        from arche_pas.metrics import get_timer
+        return get_timer
+
+    def test_disabled(self):
+        from arche_pas.metrics import null_timer
+        self.assertIs(self._fut(self.config.registry, 'gamma', 'store'), null_timer)
+
+    def test_enabled(self):
+        from arche_pas.metrics import PASMetrics
+        metrics = PASMetrics()
+        self.config.registry.registerUtility(metrics)
+        with self._fut(self.config.registry, 'gamma', 'store'):
+            pass
+        self.assertEqual(metrics.get_histogram('gamma', 'store')[2], 1)
+
+    def test_include_disabled_by_default(self):
+        self.config.include('arche_pas.metrics')
+        self.assertIsNone(self.config.registry.queryUtility(IPASMetrics))
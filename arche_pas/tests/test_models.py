@@ -1,5 +1,8 @@
+import os
+import time
 import unittest
 
+import transaction
 from BTrees.OOBTree import OOBTree
 from arche.interfaces import IObjectUpdatedEvent
 from arche.interfaces import IWillLoginEvent
@@ -11,12 +14,17 @@ from zope.interface.verify import verifyClass
 from arche.api import User
 from pyramid.request import apply_request_extensions
 from pyramid.request import Request
+from pyramid.interfaces import IRequest
 
 from arche_pas.interfaces import IProviderData
 from arche_pas.interfaces import IPASProvider
 from arche_pas.exceptions import ProviderConfigError
 
 
+here_path = os.path.dirname(os.path.realpath(__file__))
+dummy_file = os.path.join(here_path, "provider_dummy.json")
+
+
 class ProviderDataTests(unittest.TestCase):
     def setUp(self):
         self.config = testing.setUp()
@@ -48,6 +56,7 @@ class PASProviderTests(unittest.TestCase):
         self.config = testing.setUp()
 
     def tearDown(self):
+        transaction.abort()
         testing.tearDown()
 
     @property
@@ -99,6 +108,77 @@ class PASProviderTests(unittest.TestCase):
         })
         self.assertEqual(factory.validate_settings(), None)
 
+    def _settings_file(self, data):
+        import json
+        from tempfile import NamedTemporaryFile
+        f = NamedTemporaryFile(mode='w', suffix='.json', delete=False)
+        json.dump(data, f)
+        f.close()
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def test_settings_loaded_on_first_use(self):
+        factory = self._dummy_provider()
+        factory.settings_file = self._settings_file({
+            'client_id': 'client_id',
+            'auth_uri': 'auth_uri',
+            'token_uri': 'token_uri',
+            'client_secret': 'client_secret'
+        })
+        self.assertEqual(factory.settings, None)
+        obj = factory(testing.DummyRequest())
+        self.assertEqual(obj.settings['client_id'], 'client_id')
+        self.assertEqual(obj.settings['one'], 1)
+
+    def test_settings_load_error(self):
+        factory = self._dummy_provider()
+        factory.settings_file = self._settings_file({'client_id': 'client_id'})
+        self.assertRaises(ProviderConfigError, factory, testing.DummyRequest())
+        self.assertEqual(factory.settings, None)
+
+    def _reloading_provider(self):
+        factory = self._dummy_provider()
+        factory.reload_interval = 1
+        factory.settings_file = self._settings_file(self._valid_settings)
+        factory(testing.DummyRequest())
+        return factory
+
+    _valid_settings = {
+        'client_id': 'client_id',
+        'auth_uri': 'auth_uri',
+        'token_uri': 'token_uri',
+        'client_secret': 'client_secret'
+    }
+
+    def _change_settings_file(self, factory, **kw):
+        import json
+        data = dict(self._valid_settings, **kw)
+        with open(factory.settings_file, 'w') as f:
+            json.dump(data, f)
+        os.utime(factory.settings_file, (factory.settings_mtime + 10, factory.settings_mtime + 10))
+        factory.next_settings_check = 0
+
+    def test_settings_reloaded(self):
+        factory = self._reloading_provider()
+        self._change_settings_file(factory, client_secret='rotated', provider={'title': 'Changed'})
+        obj = factory(testing.DummyRequest())
+        self.assertEqual(obj.settings['client_secret'], 'rotated')
+        self.assertEqual(obj.title, 'Changed')
+
+    def test_settings_reload_waits_for_interval(self):
+        factory = self._reloading_provider()
+        self._change_settings_file(factory, client_secret='rotated')
+        factory.next_settings_check = time.time() + 60
+        obj = factory(testing.DummyRequest())
+        self.assertEqual(obj.settings['client_secret'], 'client_secret')
+
+    def test_settings_reload_keeps_last_good(self):
+        factory = self._reloading_provider()
+        self._change_settings_file(factory, client_secret=None)
+        obj = factory(testing.DummyRequest())
+        self.assertEqual(obj.settings['client_secret'], 'client_secret')
+        self.assertFalse(factory.check_settings_file())
+
     def test_callback_url(self):
         self.config.include('betahaus.viewcomponent')
         self.config.include('arche_pas.views')
@@ -137,6 +217,27 @@ class PASProviderTests(unittest.TestCase):
         obj = provider(request)
         self.assertEqual(obj.get_user('very_secret'), user)
 
+    def test_get_users(self):
+        self.config.include('arche.testing')
+        self.config.include('arche.testing.catalog')
+        self.config.include('arche_pas.catalog')
+        self.config.include('arche_pas.models')
+        root = barebone_fixture(self.config)
+        request = testing.DummyRequest()
+        self.config.begin(request)
+        apply_request_extensions(request)
+        request.root = root
+        provider = self._dummy_provider()
+        self.config.registry.registerAdapter(provider, name=provider.name)
+        for name in ('jane', 'john'):
+            user = User()
+            IProviderData(user)['dummy'] = {'dummy_key': name + '_secret'}
+            root['users'][name] = user
+        obj = provider(request)
+        results = obj.get_users(['jane_secret', 'john_secret', 'nobody'])
+        self.assertEqual(results, {'jane_secret': root['users']['jane'],
+                                   'john_secret': root['users']['john']})
+
     # def test_build_reg_case_params(self):
     #     request = testing.DummyRequest()
     #     factory = self._dummy_provider()
@@ -191,8 +292,37 @@ class PASProviderTests(unittest.TestCase):
 
         self.config.add_subscriber(subsc, [IUser, IObjectUpdatedEvent])
         obj.store(user, {'hello': 'world', 1: 2})
+        #Reindex is queued until commit
+        self.assertEqual(L, [])
+        transaction.commit()
         self.assertIn('pas_ident', L[0].changed)
 
+    def test_store_reindexes_once(self):
+        self.config.include('arche.testing')
+        self.config.include('arche.testing.catalog')
+        self.config.include('arche_pas.models')
+        self.config.include('arche_pas.catalog')
+        root = barebone_fixture(self.config)
+        request = testing.DummyRequest()
+        apply_request_extensions(request)
+        request.root = root
+        self.config.begin(request)
+        user = User()
+        provider = self._dummy_provider()
+        self.config.registry.registerAdapter(provider, name=provider.name)
+        root['users']['jane'] = user
+        obj = provider(request)
+        L = []
+
+        def subsc(obj, event):
+            L.append(event)
+
+        self.config.add_subscriber(subsc, [IUser, IObjectUpdatedEvent])
+        obj.store(user, {'dummy_key': 'very_secret'})
+        obj.store(user, {'dummy_key': 'other_secret'})
+        transaction.commit()
+        self.assertEqual(len(L), 1)
+
     def test_store_saves_new_keys(self):
         self.config.include('arche.testing')
         self.config.include('arche.testing.catalog')
@@ -234,6 +364,63 @@ class AddPASTests(unittest.TestCase):
 
     # FIXME: Proper tests for add_pas
 
+    def _dummy_provider(self):
+        from arche_pas.models import PASProvider
+
+        class DummyProvider(PASProvider):
+            name = 'dummy'
+            settings = None
+            settings_file = None
+
+        return DummyProvider
+
+    def test_settings_validated(self):
+        factory = self._dummy_provider()
+        self.config.registry.settings['arche_pas.providers'] = {factory.__module__ + ':dummy': dummy_file}
+        self._fut(self.config, factory)
+        provider = self.config.registry.adapters.lookup((IRequest,), IPASProvider, name='dummy')
+        self.assertEqual(provider.settings['client_id'], 'dummy')
+
+    def test_broken_settings_file(self):
+        from tempfile import NamedTemporaryFile
+        factory = self._dummy_provider()
+        with NamedTemporaryFile(mode='w', suffix='.json') as f:
+            f.write('{"client_id": "dummy"}')
+            f.flush()
+            self.config.registry.settings['arche_pas.providers'] = {factory.__module__: f.name}
+            #The test configurator commits each action right away
+            self.assertRaises(ProviderConfigError, self._fut, self.config, factory)
+
+    def test_several_instances(self):
+        factory = self._dummy_provider()
+        module_name = factory.__module__
+        self.config.registry.settings['arche_pas.providers'] = {
+            module_name + ':dummy_one': dummy_file,
+            module_name + ':dummy_two': dummy_file,
+        }
+        self._fut(self.config, factory)
+        adapters = self.config.registry.adapters
+        one = adapters.lookup((IRequest,), IPASProvider, name='dummy_one')
+        two = adapters.lookup((IRequest,), IPASProvider, name='dummy_two')
+        self.assertTrue(issubclass(one, factory))
+        self.assertIsNot(one, two)
+        self.assertEqual(one.name, 'dummy_one')
+        self.assertEqual(one.settings_file, dummy_file)
+        self.assertEqual(factory.settings_file, None)
+        self.assertIsNot(one.http_adapter(), two.http_adapter())
+
+    def test_duplicate_name(self):
+        factory = self._dummy_provider()
+        module_name = factory.__module__
+        self.config.registry.settings['arche_pas.providers'] = {module_name + ':dummy': dummy_file}
+        self._fut(self.config, factory)
+        self.assertRaises(ProviderConfigError, self._fut, self.config, factory)
+
+    def test_not_configured(self):
+        factory = self._dummy_provider()
+        self.config.registry.settings['arche_pas.providers'] = {}
+        self.assertRaises(ProviderConfigError, self._fut, self.config, factory)
+
 
 class RegistrationCaseTests(unittest.TestCase):
 
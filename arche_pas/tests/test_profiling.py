@@ -0,0 +1,76 @@
+import cProfile
+import shutil
+import tempfile
+import unittest
+
+from pyramid import testing
+
+
+class ProfileStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @property
+    def _cut(self):
+        from arche_pas.profiling import ProfileStore
+        return ProfileStore
+
+    def test_keeps_newest(self):
+        obj = self._cut(self.directory, keep=2)
+        names = [obj.save(cProfile.Profile(), '/pas_callback/gamma') for x in range(3)]
+        self.assertEqual(obj.filenames(), [names[2], names[1]])
+
+    def test_get_path(self):
+        obj = self._cut(self.directory)
+        name = obj.save(cProfile.Profile(), '/pas_callback/gamma')
+        self.assertTrue(obj.get_path(name).endswith(name))
+        self.assertEqual(obj.get_path('../' + name), obj.get_path(name))
+        self.assertEqual(obj.get_path('other.pstats'), None)
+
+
+class ProfilingTweenTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        testing.tearDown()
+        shutil.rmtree(self.directory)
+
+    def _mk_tween(self, **settings):
+        from arche_pas.profiling import ProfileStore
+        from arche_pas.profiling import profiling_tween_factory
+        self.config.registry.settings.update(settings)
+        self.config.registry.pas_profile_store = store = ProfileStore(self.directory)
+        handler = lambda request: 'response'
+        return profiling_tween_factory(handler, self.config.registry), store
+
+    def test_header(self):
+        tween, store = self._mk_tween(**{'arche_pas.profiling.header_token': 'secret'})
+        request = testing.DummyRequest(path='/pas_callback/gamma', headers={'X-PAS-Profile': 'secret'})
+        self.assertEqual(tween(request), 'response')
+        self.assertEqual(len(store.filenames()), 1)
+
+    def test_wrong_header(self):
+        tween, store = self._mk_tween(**{'arche_pas.profiling.header_token': 'secret'})
+        request = testing.DummyRequest(path='/pas_callback/gamma', headers={'X-PAS-Profile': 'wrong'})
+        tween(request)
+        self.assertEqual(store.filenames(), [])
+
+    def test_token_matches(self):
+        from arche_pas.profiling import _token_matches
+        self.assertTrue(_token_matches(b'secret', 'secret'))
+        self.assertTrue(_token_matches('s\xe4kert', 's\xe4kert'))
+        self.assertFalse(_token_matches('secre', 'secret'))
+        self.assertFalse(_token_matches(None, 'secret'))
+
+    def test_sample_rate(self):
+        tween, store = self._mk_tween(**{'arche_pas.profiling.sample_rate': '1'})
+        tween(testing.DummyRequest(path='/pas_begin/gamma'))
+        tween(testing.DummyRequest(path='/other'))
+        self.assertEqual(len(store.filenames()), 1)
@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+from pyramid import testing
+
+from arche_pas.interfaces import ICallbackRecorder
+
+
+class _Provider(object):
+    name = 'gamma'
+    id_key = 'id'
+
+
+class AnonymiserTests(unittest.TestCase):
+
+    @property
+    def _cut(self):
+        from arche_pas.recorder import Anonymiser
+        return Anonymiser
+
+    def test_structure_kept(self):
+        obj = self._cut('secret')
+        data = {'email': 'Jane@Example.com', 'email_verified': True, 'groups': ['a', 'b'], 'age': None}
+        result = obj(data)
+        self.assertTrue(result['email'].endswith('@example.invalid'))
+        self.assertNotIn('jane', result['email'].lower())
+        self.assertEqual(result['email'], obj('jane@example.com'))
+        self.assertEqual(result['email_verified'], True)
+        self.assertEqual(result['age'], None)
+        self.assertEqual(len(result['groups']), 2)
+        self.assertTrue(result['groups'][0].startswith('anon-'))
+
+    def test_salt(self):
+        self.assertNotEqual(self._cut('one')('jane'), self._cut('two')('jane'))
+
+
+class CallbackRecorderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        testing.tearDown()
+        shutil.rmtree(self.directory)
+
+    @property
+    def _cut(self):
+        from arche_pas.recorder import CallbackRecorder
+        return CallbackRecorder
+
+    def test_build_record(self):
+        obj = self._cut(self.directory, 'secret')
+        record = obj.build_record('gamma', 'id', {'id': 123, 'nick': 'jane'}, 'login',
+                                  {'authenticated': False, 'linked': True}, 10)
+        self.assertEqual(record['case'], 'login')
+        self.assertEqual(record['linked'], True)
+        self.assertEqual(record['authenticated'], False)
+        self.assertEqual(record['profile']['id'], obj.anonymise('123'))
+
+    def test_record_written_by_thread(self):
+        from arche_pas.recorder import read_recordings
+        from arche_pas.recorder import record_callback
+        obj = self._cut(self.directory, 'secret')
+        self.config.registry.registerUtility(obj, ICallbackRecorder)
+        profile = {'id': 'jane'}
+        record_callback(testing.DummyRequest(), _Provider(), profile, 'case2', {'linked': False})
+        #Later changes to the profile aren't recorded
+        profile['id'] = 'john'
+        obj.join()
+        filenames = [os.path.join(self.directory, x) for x in os.listdir(self.directory)]
+        records = [x[1] for x in read_recordings(filenames)]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['case'], 'case2')
+        self.assertEqual(records[0]['profile']['id'], obj.anonymise('jane'))
+
+
+class ReplayerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        transaction.abort()
+        testing.tearDown()
+
+    def _fixture(self):
+        from arche.testing import barebone_fixture
+        from arche_pas.models import PASProvider
+        from pyramid.request import apply_request_extensions
+
+        class DummyProvider(PASProvider):
+            name = 'dummy'
+            title = 'Wakka'
+            settings = None
+            id_key = 'dummy_key'
+
+        self.config.include('arche.testing')
+        self.config.include('arche.testing.catalog')
+        self.config.include('arche_pas.catalog')
+        self.config.include('arche_pas.models')
+        root = barebone_fixture(self.config)
+        request = testing.DummyRequest()
+        self.config.begin(request)
+        apply_request_extensions(request)
+        request.root = root
+        self.config.registry.registerAdapter(DummyProvider, name=DummyProvider.name)
+        return request
+
+    def test_linked_replays_as_login(self):
+        from arche_pas.replay import Replayer
+        obj = Replayer(self._fixture())
+        record = {'provider': 'dummy', 'profile': {'dummy_key': 'anon-x'}, 'linked': True, 'case': 'login'}
+        self.assertEqual(obj.replay(record), 'login')
+
+
+class CompareResultsTests(unittest.TestCase):
+
+    def test_compare(self):
+        from arche_pas.replay import compare_results
+        old = {'a': 'case1', 'b': 'case2', 'c': 'login'}
+        new = {'a': 'case1', 'b': 'case4', 'd': 'login'}
+        self.assertEqual(compare_results(old, new), [('b', 'case2', 'case4')])
@@ -0,0 +1,266 @@
+import shutil
+import tempfile
+import unittest
+from multiprocessing.pool import ThreadPool
+from os import path
+from time import time
+
+import transaction
+from arche.interfaces import IUser
+from pyramid import testing
+from pyramid.interfaces import IRequest
+from zope.interface import Interface
+from zope.interface import implementer
+
+from arche_pas.interfaces import IPASProvider
+from arche_pas.interfaces import ITokenVault
+
+
+class RateLimiterTests(unittest.TestCase):
+
+    @property
+    def _cut(self):
+        from arche_pas.refresh import RateLimiter
+        return RateLimiter
+
+    def test_burst_then_throttle(self):
+        obj = self._cut(50, burst=2)
+        start = time()
+        for i in range(4):
+            obj.wait()
+        # Two calls in the burst, two more at 50/s
+        self.assertGreaterEqual(time() - start, 0.03)
+
+
+class CheckpointTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @property
+    def _cut(self):
+        from arche_pas.refresh import Checkpoint
+        return Checkpoint
+
+    def test_save_load_clear(self):
+        obj = self._cut(path.join(self.directory, 'checkpoint.json'))
+        self.assertEqual(obj.load(), None)
+        obj.save('jane')
+        self.assertEqual(obj.load(), 'jane')
+        obj.clear()
+        self.assertEqual(obj.load(), None)
+
+    def test_no_file(self):
+        obj = self._cut('')
+        obj.save('jane')
+        self.assertEqual(obj.load(), None)
+
+
+@implementer(IUser)
+class _User(object):
+
+    def __init__(self, userid, tokens):
+        self.userid = userid
+        #Provider name -> stored token, or None if it can't be decrypted
+        self.__pas_tokens__ = tokens
+        self.profiles = {}
+
+
+class _Vault(object):
+
+    def __init__(self, user):
+        self.user = user
+
+    def __iter__(self):
+        return iter(sorted(self.user.__pas_tokens__))
+
+    def get(self, provider_name, default=None):
+        token = self.user.__pas_tokens__.get(provider_name, None)
+        if token is None:
+            return default
+        return token
+
+    def __setitem__(self, provider_name, token):
+        self.user.__pas_tokens__[provider_name] = token
+
+
+class _Provider(object):
+    name = 'gamma'
+    id_key = 'id'
+    #Access token -> profile returned by the provider
+    profiles = {}
+
+    def __init__(self, request):
+        self.request = request
+
+    def get_id(self, user):
+        return user.userid
+
+    def refresh_token(self, token):
+        if token['refresh_token'] == 'bad':
+            return None
+        return {'access_token': token['refresh_token'], 'refresh_token': 'rotated'}
+
+    def fetch_profile(self, token):
+        return self.profiles[token['access_token']]
+
+    def store(self, user, profile_data):
+        changed = user.profiles.get(self.name) != profile_data
+        user.profiles[self.name] = profile_data
+        return changed and set(profile_data) or set()
+
+
+class _Limiter(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def wait(self):
+        self.calls.append(time())
+
+
+class _Jar(object):
+
+    def cacheMinimize(self):
+        pass
+
+
+class _Root(dict):
+    _p_jar = _Jar()
+
+
+class RefreshProfilesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.config.registry.registerAdapter(_Vault, (Interface,), ITokenVault)
+        self.config.registry.registerAdapter(_Provider, (IRequest,), IPASProvider, name='gamma')
+        _Provider.profiles = {
+            'jane-token': {'id': 'jane', 'nick': 'J'},
+            'john-token': {'id': 'john', 'nick': 'Johnny'},
+            'other-token': {'id': 'someone_else'},
+        }
+
+    def tearDown(self):
+        transaction.abort()
+        testing.tearDown()
+
+    def _fut(self, users, **kw):
+        from arche_pas.refresh import refresh_profiles
+        request = testing.DummyRequest()
+        request.root = _Root(users=users)
+        #Docids are the userids here
+        request.resolve_docids = lambda docids, perm=None: [users[x] for x in docids if x in users]
+        return refresh_profiles(request, sorted(users) + ['nobody'], **kw)
+
+    def _users(self, **tokens):
+        return dict((userid, _User(userid, {'gamma': token and {'access_token': token}}))
+                    for (userid, token) in tokens.items())
+
+    def test_changed_and_unchanged(self):
+        users = self._users(jane='jane-token', john='john-token')
+        users['jane'].profiles['gamma'] = {'id': 'jane', 'nick': 'J'}
+        counts, pending = self._fut(users)
+        self.assertEqual(counts, {'fetched': 2, 'changed': 1, 'failed': 0})
+        self.assertEqual(pending, [])
+        self.assertEqual(users['john'].profiles['gamma']['nick'], 'Johnny')
+
+    def test_mismatched_account_skipped(self):
+        users = self._users(jane='other-token')
+        counts, pending = self._fut(users)
+        self.assertEqual(counts, {'fetched': 0, 'changed': 0, 'failed': 1})
+        self.assertEqual(users['jane'].profiles, {})
+
+    def test_failed_token_retrieval(self):
+        users = self._users(jane=None, john='john-token')
+        counts, pending = self._fut(users)
+        self.assertEqual(counts, {'fetched': 1, 'changed': 1, 'failed': 1})
+        self.assertEqual(users['jane'].profiles, {})
+
+    def test_expired_token_refreshed(self):
+        users = {'jane': _User('jane', {'gamma': {'access_token': 'old', 'refresh_token': 'jane-token',
+                                                  'expires_at': time() - 10}}),
+                 'john': _User('john', {'gamma': {'access_token': 'old', 'refresh_token': 'bad',
+                                                  'expires_at': time() - 10}})}
+        limiter = _Limiter()
+        counts, pending = self._fut(users, limiters={'gamma': limiter})
+        self.assertEqual(counts, {'fetched': 1, 'changed': 1, 'failed': 1})
+        self.assertEqual(users['jane'].__pas_tokens__['gamma']['refresh_token'], 'rotated')
+        #Refresh and fetch for jane, refresh for john
+        self.assertEqual(len(limiter.calls), 3)
+
+    def test_unconfigured_provider_ignored(self):
+        users = {'jane': _User('jane', {'old': {'access_token': 'jane-token'}})}
+        counts, pending = self._fut(users)
+        self.assertEqual(counts, {'fetched': 0, 'changed': 0, 'failed': 0})
+
+    def test_limiter_with_pool(self):
+        users = self._users(jane='jane-token', john='john-token')
+        limiter = _Limiter()
+        pool = ThreadPool(2)
+        try:
+            counts, pending = self._fut(users, limiters={'gamma': limiter}, pool=pool)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(counts, {'fetched': 2, 'changed': 2, 'failed': 0})
+        self.assertEqual(len(limiter.calls), 2)
+
+
+class IterUseridsTests(unittest.TestCase):
+
+    @property
+    def _fut(self):
+        from arche_pas.refresh import iter_userids
+        return iter_userids
+
+    def test_resume(self):
+        users = {'anna': 1, 'jane': 2, 'zed': 3}
+
+        class Users(object):
+            def keys(self):
+                return sorted(users)
+
+        self.assertEqual(list(self._fut(Users())), ['anna', 'jane', 'zed'])
+        self.assertEqual(list(self._fut(Users(), 'jane')), ['zed'])
+
+
+class _Catalog(object):
+
+    def __init__(self, docids):
+        self.docids = docids
+        self.queries = []
+
+    def query(self, query):
+        self.queries.append(query)
+        return len(self.docids), self.docids
+
+
+class IterTokenDocidsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    @property
+    def _fut(self):
+        from arche_pas.refresh import iter_token_docids
+        return iter_token_docids
+
+    def test_resume(self):
+        from BTrees.IFBTree import IFSet
+        self.config.registry.registerAdapter(_Provider, (IRequest,), IPASProvider, name='gamma')
+        request = testing.DummyRequest()
+        request.root = _Root()
+        request.root.catalog = _Catalog(IFSet([3, 1, 7]))
+        self.assertEqual(list(self._fut(request)), [1, 3, 7])
+        self.assertEqual(list(self._fut(request, 3)), [7])
+        self.assertEqual(request.root.catalog.queries[0].index_name, 'pas_tokens')
+
+    def test_no_providers(self):
+        self.assertEqual(list(self._fut(testing.DummyRequest())), [])
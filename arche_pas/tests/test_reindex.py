@@ -0,0 +1,76 @@
+import unittest
+
+from pyramid import testing
+
+
+class ChangedProvidersTests(unittest.TestCase):
+
+    @property
+    def _fut(self):
+        from arche_pas.reindex import changed_providers
+        return changed_providers
+
+    def test_changes(self):
+        old = {'gamma': 'cid', 'github': 'id', 'old': 'id'}
+        new = {'gamma': 'cid', 'github': 'login', 'google': 'sub'}
+        self.assertEqual(self._fut(old, new), ['github', 'google', 'old'])
+
+    def test_first_start(self):
+        self.assertEqual(self._fut(None, {'gamma': 'cid'}), [])
+
+
+class ClaimReindexTests(unittest.TestCase):
+
+    @property
+    def _fut(self):
+        from arche_pas.reindex import claim_reindex
+        return claim_reindex
+
+    def test_first_start_records(self):
+        root = testing.DummyModel()
+        self.assertEqual(self._fut(root, {'gamma': 'cid'}, now=10), [])
+        self.assertEqual(root.__pas_providers__, {'gamma': 'cid'})
+
+    def test_changed(self):
+        from arche_pas.reindex import finish_reindex
+        root = testing.DummyModel()
+        root.__pas_providers__ = {'gamma': 'cid'}
+        self.assertEqual(self._fut(root, {'gamma': 'cid', 'github': 'id'}, now=10), ['github'])
+        self.assertEqual(root.__pas_providers__, {'gamma': 'cid', 'github': 'id'})
+        #Claimed by the first worker
+        self.assertEqual(self._fut(root, {'gamma': 'cid', 'github': 'id'}, now=20), [])
+        #Lease expired
+        self.assertEqual(self._fut(root, {'gamma': 'cid', 'github': 'id'}, now=10000), ['github'])
+        finish_reindex(root)
+        self.assertEqual(self._fut(root, {'gamma': 'cid', 'github': 'id'}, now=20000), [])
+
+
+class StartReindexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        from arche_pas import reindex
+        reindex._auto_reindex_disabled = False
+        testing.tearDown()
+
+    def _handlers(self):
+        #Pyramid wraps subscribers, compare by name
+        return [x.handler.__name__ for x in self.config.registry.registeredHandlers()]
+
+    def test_off_by_default(self):
+        self.config.include('arche_pas.reindex')
+        self.assertNotIn('start_reindex', self._handlers())
+
+    def test_enabled(self):
+        self.config.registry.settings['arche_pas.auto_reindex'] = 'true'
+        self.config.include('arche_pas.reindex')
+        self.assertIn('start_reindex', self._handlers())
+
+    def test_disabled_in_scripts(self):
+        from arche_pas.reindex import disable_auto_reindex
+        from arche_pas.reindex import start_reindex
+        disable_auto_reindex()
+        #Returns before looking at the event
+        self.assertEqual(start_reindex(None), None)
@@ -0,0 +1,171 @@
+import unittest
+from time import time
+
+import transaction
+from arche.api import User
+from pyramid import testing
+from ZODB.POSException import ConflictError
+from zope.interface import Interface
+from zope.interface.verify import verifyObject
+
+from arche_pas.interfaces import ITokenCipher
+from arche_pas.interfaces import ITokenVault
+
+try:
+    from cryptography.fernet import Fernet
+except ImportError:  # pragma: no coverage
+    Fernet = None
+
+
+@unittest.skipIf(Fernet is None, "cryptography not installed")
+class TokenVaultTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.config.registry.settings['arche_pas.token_vault.keys'] = Fernet.generate_key().decode('ascii')
+        self.config.include('arche_pas.tokens')
+
+    def tearDown(self):
+        transaction.abort()
+        testing.tearDown()
+
+    @property
+    def _cut(self):
+        from arche_pas.tokens import TokenVault
+        return TokenVault
+
+    def test_verify_object(self):
+        self.failUnless(verifyObject(ITokenVault, self._cut(User())))
+
+    def test_encrypted(self):
+        user = User()
+        obj = self._cut(user)
+        obj['gamma'] = {'access_token': 'secret', 'expires_at': 100}
+        self.assertNotIn('secret', user.__pas_tokens__['gamma'][1])
+        self.assertEqual(obj.get('gamma'), {'access_token': 'secret', 'expires_at': 100})
+
+    def test_expires_in(self):
+        obj = self._cut(User())
+        obj['gamma'] = {'access_token': 'secret', 'expires_in': 60}
+        self.assertAlmostEqual(obj.expires_at('gamma'), time() + 60, delta=5)
+
+    def test_due(self):
+        obj = self._cut(User())
+        obj['gamma'] = {'access_token': 'a', 'expires_at': 100}
+        obj['google_oauth2'] = {'access_token': 'b', 'expires_at': 200}
+        obj['facebook'] = {'access_token': 'c'}
+        self.assertEqual(obj.due(150), ['gamma'])
+
+    def test_key_rotation(self):
+        user = User()
+        self._cut(user)['gamma'] = {'access_token': 'secret'}
+        from arche_pas.tokens import TokenCipher
+        old_key = self.config.registry.settings['arche_pas.token_vault.keys']
+        cipher = TokenCipher([Fernet.generate_key().decode('ascii'), old_key])
+        self.config.registry.registerUtility(cipher, ITokenCipher)
+        self.assertEqual(self._cut(user).get('gamma'), {'access_token': 'secret'})
+
+    def test_get_access_token_refreshes_expired(self):
+        from arche_pas.models import PASProvider
+        from arche_pas.tokens import get_access_token
+
+        class DummyProvider(PASProvider):
+            name = 'dummy'
+
+            def refresh_token(self, token):
+                return {'access_token': 'new', 'expires_at': time() + 60}
+
+        self.config.registry.registerAdapter(DummyProvider, name=DummyProvider.name)
+        request = testing.DummyRequest()
+        user = User()
+        self._cut(user)['dummy'] = {'access_token': 'old', 'expires_at': time() - 10}
+        self.assertEqual(get_access_token(request, user, 'dummy'), 'new')
+        self.assertEqual(self._cut(user).get('dummy')['access_token'], 'new')
+
+    def test_iter_due_tokens(self):
+        from arche.testing import barebone_fixture
+        from pyramid.request import apply_request_extensions
+        from arche_pas.tokens import iter_due_tokens
+        self.config.include('arche.testing')
+        self.config.include('arche.testing.catalog')
+        self.config.include('arche_pas.catalog')
+        root = barebone_fixture(self.config)
+        request = testing.DummyRequest()
+        self.config.begin(request)
+        apply_request_extensions(request)
+        request.root = root
+        for (name, expires_at) in (('jane', 100), ('john', 300), ('jim', None)):
+            user = root['users'][name] = User()
+            self._cut(user)['gamma'] = {'access_token': name, 'expires_at': expires_at}
+        self._cut(root['users']['john'])['dummy'] = {'access_token': 'j', 'expires_at': 50}
+        transaction.commit()
+        results = sorted((user.userid, name) for (user, name) in iter_due_tokens(request, 150))
+        self.assertEqual(results, [('jane', 'gamma'), ('john', 'dummy')])
+
+
+class _Jar(object):
+
+    def cacheMinimize(self):
+        pass
+
+
+class _Root(dict):
+    _p_jar = _Jar()
+
+
+class _Vault(object):
+
+    def __init__(self, user):
+        self.user = user
+
+    def __setitem__(self, provider_name, token):
+        self.user.tokens[provider_name] = token
+
+
+class _TokenUser(object):
+
+    def __init__(self):
+        self.tokens = {}
+
+
+class CommitTokensTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.config.registry.registerAdapter(_Vault, (Interface,), ITokenVault)
+        self.request = testing.DummyRequest()
+        self.request.root = _Root(users={'jane': _TokenUser()})
+
+    def tearDown(self):
+        transaction.abort()
+        testing.tearDown()
+
+    @property
+    def _fut(self):
+        from arche_pas.tokens import commit_tokens
+        return commit_tokens
+
+    def _conflict(self, times):
+        calls = []
+
+        def apply(request):
+            calls.append(request)
+            if len(calls) <= times:
+                def fail():
+                    raise ConflictError()
+                transaction.get().addBeforeCommitHook(fail)
+
+        return apply, calls
+
+    def test_retried_after_conflict(self):
+        apply, calls = self._conflict(1)
+        tokens = [('jane', 'gamma', {'access_token': 'new'}), ('gone', 'gamma', {'access_token': 'x'})]
+        self.assertEqual(self._fut(self.request, tokens, apply=apply), [])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.request.root['users']['jane'].tokens, {'gamma': {'access_token': 'new'}})
+
+    def test_kept_when_giving_up(self):
+        apply, calls = self._conflict(10)
+        tokens = [('jane', 'gamma', {'access_token': 'new'})]
+        self.assertEqual(self._fut(self.request, tokens, apply=apply, attempts=3), tokens)
+        self.assertEqual(len(calls), 3)
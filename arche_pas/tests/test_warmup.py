@@ -0,0 +1,83 @@
+import unittest
+from threading import Event
+
+from pyramid import testing
+
+from arche_pas.interfaces import IPASWarmup
+
+
+class WarmupTests(unittest.TestCase):
+
+    @property
+    def _cut(self):
+        from arche_pas.warmup import Warmup
+        return Warmup
+
+    def test_run_once(self):
+        L = []
+        obj = self._cut(steps=[('one', lambda request: L.append(request) or 1)])
+        obj.run('request')
+        obj.run('request')
+        self.assertEqual(L, ['request'])
+        status = obj.status()
+        self.assertTrue(status['ready'])
+        self.assertEqual(status['results'], {'one': 1})
+        self.assertEqual(sorted(status['timings']), ['one', 'total'])
+
+    def test_failing_step(self):
+
+        def fail(request):
+            raise ValueError("Nope")
+
+        obj = self._cut(steps=[('fail', fail), ('two', lambda request: 2)])
+        obj.run(None)
+        self.assertTrue(obj.ready)
+        self.assertEqual(obj.errors, {'fail': 'Nope'})
+        self.assertEqual(obj.results, {'two': 2})
+        #No error messages in the public status
+        self.assertEqual(obj.status()['failed'], ['fail'])
+        self.assertNotIn('Nope', repr(obj.status()))
+
+    def test_status_is_a_copy(self):
+        obj = self._cut(steps=[('one', lambda request: 1)])
+        status = obj.status()
+        obj.run(None)
+        self.assertEqual(status['results'], {})
+
+
+class ReadyViewTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _fixture(self, mode):
+        from arche_pas.warmup import Warmup
+        self.config.registry.settings['arche_pas.warmup'] = mode
+        warmup = Warmup(steps=[('one', lambda request: 1)])
+        self.config.registry.registerUtility(warmup, IPASWarmup)
+        return warmup
+
+    def test_not_ready(self):
+        from arche_pas.warmup import ready_view
+        self._fixture('startup')
+        request = testing.DummyRequest()
+        self.assertEqual(ready_view(request)['ready'], False)
+        self.assertEqual(request.response.status_int, 503)
+
+    def test_endpoint_runs_in_background(self):
+        from arche_pas.warmup import ready_view
+        warmup = self._fixture('endpoint')
+        proceed = Event()
+        warmup.steps = [('one', lambda request: proceed.wait(5) and 1)]
+        request = testing.DummyRequest()
+        self.assertEqual(ready_view(request)['ready'], False)
+        self.assertEqual(request.response.status_int, 503)
+        proceed.set()
+        warmup.thread.join(5)
+        request = testing.DummyRequest()
+        self.assertEqual(ready_view(request)['ready'], True)
+        self.assertEqual(request.response.status_int, 200)
+        self.assertEqual(warmup.status()['results'], {'one': 1})
@@ -0,0 +1,40 @@
+import unittest
+
+
+class BackgroundWorkerTests(unittest.TestCase):
+
+    @property
+    def _cut(self):
+        from arche_pas.workers import BackgroundWorker
+        return BackgroundWorker
+
+    def test_handled_in_threads(self):
+        L = []
+        obj = self._cut(L.append, 'test', threads=2)
+        self.assertTrue(obj.submit(1))
+        self.assertTrue(obj.submit(2))
+        obj.join()
+        self.assertEqual(sorted(L), [1, 2])
+        self.assertEqual(len(obj._threads), 2)
+
+    def test_failing_item(self):
+        L = []
+
+        def handle(item):
+            if item == 1:
+                raise ValueError()
+            L.append(item)
+
+        obj = self._cut(handle, 'test')
+        obj.submit(1)
+        obj.submit(2)
+        obj.join()
+        self.assertEqual(L, [2])
+
+    def test_queue_full(self):
+        obj = self._cut(lambda item: None, 'test', queue_size=1)
+        #Not started, so nothing is consumed
+        obj._start = lambda: None
+        self.assertTrue(obj.submit(1))
+        self.assertFalse(obj.submit(2))
+        self.assertEqual(obj.queue.qsize(), 1)
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+from time import time
+
+import transaction
+from BTrees.OOBTree import OOBTree
+from arche.interfaces import IUser
+from pyramid.threadlocal import get_current_registry
+from repoze.catalog.query import Lt
+from ZODB.POSException import ConflictError
+from zope.component import adapter
+from zope.interface import implementer
+
+from arche_pas import logger
+from arche_pas.catalog import TOKEN_INDEXES
+from arche_pas.catalog import queue_pas_reindex
+from arche_pas.exceptions import ProviderConfigError
+from arche_pas.interfaces import IPASProvider
+from arche_pas.interfaces import ITokenCipher
+from arche_pas.interfaces import ITokenVault
+
+
+@implementer(ITokenCipher)
+class TokenCipher(object):
+    """ Encrypts tokens with Fernet from the cryptography package.
+        The first key is used for encryption, all of them for decryption
+        so keys can be rotated.
+    """
+
+    def __init__(self, keys):
+        try:
+            from cryptography.fernet import Fernet
+            from cryptography.fernet import InvalidToken
+            from cryptography.fernet import MultiFernet
+        except ImportError:  # pragma: no coverage
+            raise ProviderConfigError("The token vault requires the 'cryptography' package.")
+        if not keys:
+            raise ProviderConfigError("No keys configured for the token vault.")
+        try:
+            self.fernet = MultiFernet([Fernet(k.encode('ascii')) for k in keys])
+        except ValueError as exc:
+            raise ProviderConfigError("Bad token vault key: %s" % exc)
+        self.InvalidToken = InvalidToken
+
+    def encrypt(self, token):
+        return self.fernet.encrypt(json.dumps(token).encode('utf-8')).decode('ascii')
+
+    def decrypt(self, value):
+        try:
+            return json.loads(self.fernet.decrypt(value.encode('ascii')).decode('utf-8'))
+        except self.InvalidToken:
+            logger.warning("Couldn't decrypt token, was the key removed?")
+
+
+@implementer(ITokenVault)
+@adapter(IUser)
+class TokenVault(object):
+    """ Encrypted OAuth tokens stored on the user, one per provider.
+        Expiry time is kept in clear text so expiring tokens can be found without decrypting.
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    @property
+    def data(self):
+        try:
+            return self.context.__pas_tokens__
+        except AttributeError:
+            self.context.__pas_tokens__ = OOBTree()
+            return self.context.__pas_tokens__
+
+    @property
+    def cipher(self):
+        cipher = get_current_registry().queryUtility(ITokenCipher)
+        if cipher is None:
+            raise ProviderConfigError("The token vault isn't enabled, set 'arche_pas.token_vault.keys'")
+        return cipher
+
+    def get(self, provider_name, default=None):
+        try:
+            expires_at, value = self.data[provider_name]
+        except KeyError:
+            return default
+        token = self.cipher.decrypt(value)
+        if token is None:
+            return default
+        return token
+
+    def __setitem__(self, provider_name, token):
+        token = dict(token)
+        if not token.get('expires_at') and token.get('expires_in'):
+            token['expires_at'] = time() + float(token['expires_in'])
+        self.data[provider_name] = (token.get('expires_at', None), self.cipher.encrypt(token))
+        queue_pas_reindex(self.context, changed=TOKEN_INDEXES, data_changed=False)
+
+    def __delitem__(self, provider_name):
+        del self.data[provider_name]
+        queue_pas_reindex(self.context, changed=TOKEN_INDEXES, data_changed=False)
+
+    def __contains__(self, provider_name):
+        #Don't create the tree just to check
+        return provider_name in getattr(self.context, '__pas_tokens__', ())
+
+    def __iter__(self):
+        return iter(getattr(self.context, '__pas_tokens__', ()))
+
+    def expires_at(self, provider_name):
+        return self.data[provider_name][0]
+
+    def due(self, before):
+        """ Names of providers with tokens expiring before this timestamp. """
+        tokens = getattr(self.context, '__pas_tokens__', {})
+        return [k for (k, v) in tokens.items() if v[0] is not None and v[0] < before]
+
+
+def vault_enabled(registry):
+    return registry.queryUtility(ITokenCipher) is not None
+
+
+def save_token(provider, user):
+    """ Save the token the provider fetched during this request, if the vault is enabled. """
+    if provider.token is not None and vault_enabled(provider.request.registry):
+        ITokenVault(user)[provider.name] = provider.token
+
+
+def stash_token(provider, reg_id):
+    """ Keep the token encrypted in the session until registration or linking is done. """
+    cipher = provider.request.registry.queryUtility(ITokenCipher)
+    if cipher is not None and provider.token is not None:
+        provider.request.session['%s.token' % reg_id] = cipher.encrypt(provider.token)
+
+
+def restore_token(provider, reg_id):
+    value = provider.request.session.pop('%s.token' % reg_id, None)
+    cipher = provider.request.registry.queryUtility(ITokenCipher)
+    if cipher is not None and value:
+        provider.token = cipher.decrypt(value)
+
+
+def get_access_token(request, user, provider_name):
+    """ Return a valid access token for the user at provider, or None.
+        Expired tokens are refreshed right away, tokens about to expire are left
+        for the batched background refresh in the 'arche_pas_refresh_tokens' script.
+    """
+    vault = ITokenVault(user)
+    token = vault.get(provider_name)
+    if token is None:
+        return None
+    expires_at = token.get('expires_at', None)
+    if expires_at is not None and expires_at <= time():
+        provider = request.registry.queryAdapter(request, IPASProvider, name=provider_name)
+        if provider is None:
+            return None
+        token = provider.refresh_token(token)
+        if token is None:
+            return None
+        vault[provider_name] = token
+    return token['access_token']
+
+
+def iter_due_tokens(request, before):
+    """ Yield (user, provider_name) for all tokens expiring before the timestamp.
+        Only users whose first token expires before it are loaded, they're found
+        through the pas_token_expiry index.
+    """
+    docids = request.root.catalog.query(Lt('pas_token_expiry', before))[1]
+    for user in request.resolve_docids(sorted(docids), perm = None):
+        if not IUser.providedBy(user):
+            continue
+        for provider_name in TokenVault(user).due(before):
+            yield user, provider_name
+
+
+def refresh_tokens(request, items, pool=None):
+    """ Refresh the tokens of all (user, provider_name) in items.
+        Requests to the providers are made concurrently if a thread pool is passed,
+        but all database access happens in this thread. Nothing is stored, returns
+        [(userid, provider_name, new_token)] to pass on to commit_tokens.
+    """
+    jobs = []
+    for (user, provider_name) in items:
+        provider = request.registry.queryAdapter(request, IPASProvider, name=provider_name)
+        token = ITokenVault(user).get(provider_name)
+        if provider is None or token is None:
+            continue
+        jobs.append((user.userid, provider, token))
+
+    def _refresh(job):
+        userid, provider, token = job
+        try:
+            return provider.refresh_token(token)
+        except Exception:
+            logger.exception("Refreshing %s token for %s failed", provider.name, userid)
+
+    if pool is None:
+        results = [_refresh(x) for x in jobs]
+    else:
+        results = pool.map(_refresh, jobs)
+    return [(userid, provider.name, new_token)
+            for ((userid, provider, token), new_token) in zip(jobs, results) if new_token is not None]
+
+
+def store_tokens(request, tokens):
+    """ Put [(userid, provider_name, token)] in the vaults of the users. Returns the number stored. """
+    users = request.root['users']
+    count = 0
+    for (userid, provider_name, token) in tokens:
+        user = users.get(userid, None)
+        if user is not None:
+            ITokenVault(user)[provider_name] = token
+            count += 1
+    return count
+
+
+def commit_tokens(request, tokens, apply=None, attempts=5):
+    """ Store refreshed tokens and commit, retrying on conflicts.
+
+        Providers usually invalidate the old refresh token when they hand out a
+        new one, so the new tokens must not be lost with an aborted transaction.
+        On a conflict the users are loaded again and the tokens stored in a new
+        transaction.
+
+        :param apply: Called with the request before each commit, for other changes
+            to commit together with the tokens.
+        :return: Tokens that still couldn't be committed. Keep them and try again.
+    """
+    root = request.root
+    for attempt in range(attempts):
+        store_tokens(request, tokens)
+        if apply is not None:
+            apply(request)
+        try:
+            transaction.commit()
+        except ConflictError:
+            transaction.abort()
+            logger.info("Conflict while storing refreshed tokens, retrying")
+        else:
+            return []
+        finally:
+            root._p_jar.cacheMinimize()
+    logger.error("Couldn't commit %s refreshed tokens after %s attempts", len(tokens), attempts)
+    return list(tokens)
+
+
+def includeme(config):
+    """ Enable the token vault by setting one or more Fernet keys, newest first.
+        Generate a key with: python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key())"
+
+        arche_pas.token_vault.keys = <key>
+    """
+    config.registry.registerAdapter(TokenVault)
+    keys = config.registry.settings.get('arche_pas.token_vault.keys', '').split()
+    if keys:
+        config.registry.registerUtility(TokenCipher(keys))
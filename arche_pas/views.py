@@ -2,12 +2,16 @@
 from arche_pas import _
 from arche_pas import logger
 
+import json
+from hashlib import sha1
+
 import deform
-from arche.events import ObjectUpdatedEvent
 from arche.interfaces import IEmailValidationTokens
+from arche.interfaces import IRoot
 from arche.interfaces import IUser
 from arche.interfaces import IViewInitializedEvent
 from arche.security import PERM_EDIT
+from arche.security import PERM_MANAGE_SYSTEM
 from arche.utils import get_content_schemas
 from arche.views.auth import LoginForm
 from arche.views.auth import RegisterForm
@@ -19,15 +23,26 @@ from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.httpexceptions import HTTPForbidden
 from pyramid.httpexceptions import HTTPFound
 from pyramid.httpexceptions import HTTPNotFound
+from pyramid.httpexceptions import HTTPNotModified
 from pyramid.renderers import render
+from six import integer_types
 from six import string_types
 from transaction import commit
-from zope.component.event import objectEventNotify
 from zope.interface.interfaces import ComponentLookupError
 
+from arche_pas.audit import audit_event
+from arche_pas.catalog import build_pas_summary
+from arche_pas.catalog import get_id_keys
+from arche_pas.catalog import get_pas_serial
+from arche_pas.catalog import get_pas_summary
+from arche_pas.catalog import provider_counts
+from arche_pas.catalog import queue_pas_reindex
 from arche_pas.interfaces import IPASProvider
 from arche_pas.interfaces import IProviderData
+from arche_pas.interfaces import ITokenVault
 from arche_pas.models import UnknownProvider
+from arche_pas.recorder import record_callback
+from arche_pas.tokens import restore_token
 
 
 class BeginAuthView(BaseView):
@@ -39,7 +54,8 @@ class BeginAuthView(BaseView):
         if came_from:
             self.request.session['came_from'] = came_from
         if provider:
-            redirect_url = provider.begin()
+            with provider.timer('begin'):
+                redirect_url = provider.begin()
             logger.debug('Begin redirects to: %s', redirect_url)
             return HTTPFound(location=redirect_url)
         raise HTTPNotFound(_("No login provider with that name"))
@@ -50,12 +66,23 @@ class CallbackAuthView(BaseView):
     def __call__(self):
         provider_name = self.request.matchdict.get('provider', '')
         provider = self.request.registry.queryAdapter(self.request, IPASProvider, name = provider_name)
+        if provider is None:
+            raise HTTPNotFound(_("No login provider with that name"))
+        with provider.timer('callback'):
+            return self.handle_callback(provider)
+
+    def handle_callback(self, provider):
+        provider_name = provider.name
         profile_data = provider.callback()
         user_ident = profile_data.get(provider.id_key, None)
         if not user_ident:
+            provider.count('missing_ident')
             raise HTTPBadRequest("Profile response didn't contain a user identifier.")
         user = provider.get_user(user_ident)
         if user:
+            record_callback(self.request, provider, profile_data, 'login',
+                            {'authenticated': bool(self.request.authenticated_userid), 'linked': True})
+            provider.count('login')
             provider.logger.info('Logged in %s via provider %s', user.userid, provider_name)
             self.flash_messages.add(_("Logged in via ${provider}",
                                       mapping={'provider': self.request.localizer.translate(provider.title)}),
@@ -67,6 +94,7 @@ class CallbackAuthView(BaseView):
             provider.logger.info('Rendering registration via provider %s', provider_name)
             reg_response = provider.prepare_register(profile_data)
             if isinstance(reg_response, string_types):
+                provider.count('register')
                 return HTTPFound(
                     location = self.request.route_url('pas_register',
                                                       provider = provider.name,
@@ -166,9 +194,11 @@ class RegisterPASForm(BaseForm):
                 )
         else:
             self.flash_messages.add(_("Welcome, you're now registered!"), type="success")
+        restore_token(self.provider, self.reg_id)
         self.provider.store(user, self.provider_response)
         commit()  # We want potential conflicts to be checked here. In case of errors this will abort login
         self.request.session.pop(self.reg_id, None)
+        self.provider.count('registered')
         return self.provider.login(user, first_login = True, came_from = redirect_url)
 
 
@@ -207,6 +237,7 @@ class ConfirmLinkAccountPASForm(BaseForm):
         return data
 
     def link_success(self, appstruct):
+        restore_token(self.provider, self.reg_id)
         self.provider.store(self.request.profile, self.provider_response)
         #FIXME: Decide about overwrite of email
         #Maybe flag email as validated?
@@ -220,6 +251,7 @@ class ConfirmLinkAccountPASForm(BaseForm):
                                   mapping={'provider_title': provider_title}),
                                 type="success")
         self.request.session.pop(self.reg_id, None)
+        self.provider.count('linked')
         # Treat this as a login, and fire that event
         self.provider.notify_login(self.request.profile, first_login=False)
         redirect_url = self.request.session.pop('came_from', None)
@@ -243,10 +275,13 @@ class RemovePASDataForm(BaseForm):
             self.context.password = None
         if appstruct['providers_to_remove']:
             provider_data = IProviderData(self.context)
+            tokens = ITokenVault(self.context)
             for provider_name in appstruct['providers_to_remove']:
                 del provider_data[provider_name]
-            event = ObjectUpdatedEvent(self.context, changed = ['pas_ident'])
-            objectEventNotify(event)
+                audit_event(self.request, 'unlink', self.context.userid, provider_name)
+                if provider_name in tokens:
+                    del tokens[provider_name]
+            queue_pas_reindex(self.context)
             self.flash_messages.add(_("Removed successfully"), type='success')
         return HTTPFound(location=self.request.resource_url(self.context, 'pas_linked_accounts'))
 
@@ -286,6 +321,84 @@ class LinkedAccountsInfo(BaseView):
                 'provider_data': provider_data}
 
 
+def linked_accounts_json(context, request):
+    """ Linked and unlinked providers for a user. The ETag only depends on a counter
+        on the user and the configured providers, so unchanged data can be
+        answered with 304 without loading any provider data.
+    """
+    providers = dict(request.registry.getAdapters((request,), IPASProvider))
+    localizer = request.localizer
+    titles = [(name, localizer.translate(providers[name].title)) for name in sorted(providers)]
+    etag_data = json.dumps([get_pas_serial(context), request.locale_name, titles])
+    etag = sha1(etag_data.encode('utf-8')).hexdigest()
+    if etag in request.if_none_match:
+        return HTTPNotModified(etag=etag, cache_control='private, no-cache')
+    summary = get_pas_summary(context)
+    if summary is None:
+        #Not created yet for this user
+        summary = build_pas_summary(context, get_id_keys(request.registry))
+    linked = []
+    unlinked = []
+    for (name, title) in titles:
+        if name in summary:
+            linked.append({'name': name, 'title': title, 'id': summary[name]['ident']})
+        else:
+            unlinked.append({'name': name, 'title': title})
+    for name in sorted(set(summary) - set(providers)):
+        linked.append({'name': name, 'title': localizer.translate(UnknownProvider(name).title), 'id': None})
+    request.response.etag = etag
+    request.response.cache_control = 'private, no-cache'
+    return {'linked': linked, 'unlinked': unlinked}
+
+
+class PASStatsView(BaseView):
+    """ Number of users linked to each provider, straight from the catalog. """
+
+    def __call__(self):
+        catalog = self.request.root.catalog
+        providers = dict(self.request.registry.getAdapters((self.request,), IPASProvider))
+        counts = provider_counts(catalog)
+        rows = []
+        for name in set(counts) | set(providers):
+            rows.append({
+                'name': name,
+                'title': providers.get(name, UnknownProvider(name)).title,
+                'count': counts.get(name, 0),
+                'configured': name in providers,
+            })
+        rows.sort(key=lambda x: x['count'], reverse=True)
+        return {'rows': rows,
+                'linked_users': catalog['pas_providers'].documentCount(),
+                'title': _("Linked accounts statistics")}
+
+
+class LookupUsersView(BaseView):
+    """ Find users for many provider identifiers in one call. For trusted clients.
+
+        POST a JSON body like {"provider": "gamma", "idents": ["id1", "id2"]}.
+        Returns {"users": {"id1": "userid"}, "missing": ["id2"]}.
+    """
+    max_idents = 10000
+
+    def __call__(self):
+        try:
+            data = self.request.json_body
+            provider_name = data['provider']
+            idents = data['idents']
+        except (ValueError, KeyError, TypeError):
+            raise HTTPBadRequest("Expected a JSON object with 'provider' and 'idents'")
+        if not isinstance(idents, list) or not all(isinstance(x, string_types + integer_types) for x in idents):
+            raise HTTPBadRequest("'idents' must be a list of strings or numbers")
+        if len(idents) > self.max_idents:
+            raise HTTPBadRequest("At most %s idents per request" % self.max_idents)
+        provider = self.request.registry.queryAdapter(self.request, IPASProvider, name=provider_name)
+        if provider is None:
+            raise HTTPNotFound("No provider named %r" % provider_name)
+        users = provider.get_users(idents)
+        return {'users': dict((ident, user.userid) for (ident, user) in users.items()),
+                'missing': [x for x in idents if x not in users]}
+
+
 def linked_accounts_menu_item(context, request, va, **kw):
     """
     Render menu item in profile.
@@ -334,6 +447,12 @@ def includeme(config):
         renderer="arche_pas:templates/oauth_exception.pt")
     config.add_view(LinkedAccountsInfo, context=IUser, name='pas_linked_accounts',
                     renderer='arche_pas:templates/linked_accounts.pt', permission=PERM_EDIT)
+    config.add_view(linked_accounts_json, context=IUser, name='pas_linked_accounts.json',
+                    renderer='json', permission=PERM_EDIT)
+    config.add_view(PASStatsView, context=IRoot, name='pas_stats',
+                    renderer='arche_pas:templates/stats.pt', permission=PERM_MANAGE_SYSTEM)
+    config.add_view(LookupUsersView, context=IRoot, name='pas_lookup_users',
+                    renderer='json', request_method='POST', permission=PERM_MANAGE_SYSTEM)
     config.add_view_action(
         linked_accounts_menu_item, 'user_menu', 'pas_linked_accounts',
         title=_("Linked accounts"), priority=30
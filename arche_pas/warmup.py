@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+""" Do the slow parts of the first login up front, so the first users after a
+    deploy don't have to wait for them.
+
+        # Warm up in a background thread when the application is created
+        arche_pas.warmup = startup
+        # Or when /pas_ready is first requested
+        arche_pas.warmup = endpoint
+
+    /pas_ready answers 503 until warm-up is done and then 200, with the time
+    each step took. Point the load balancers health check at it.
+
+    Warm-up happens in the process it runs in, so with a server that loads the
+    application before forking workers use endpoint, otherwise the workers
+    would share the connections to the providers.
+"""
+from __future__ import unicode_literals
+
+from importlib import import_module
+from threading import Lock
+from threading import Thread
+from time import time
+
+from pyramid.interfaces import IApplicationCreated
+from pyramid.renderers import get_renderer
+from pyramid.scripting import prepare
+from pyramid.security import NO_PERMISSION_REQUIRED
+from repoze.catalog.query import Any
+from zope.interface import implementer
+
+from arche_pas import logger
+from arche_pas.exceptions import ProviderConfigError
+from arche_pas.interfaces import IPASProvider
+from arche_pas.interfaces import IPASWarmup
+
+
+TEMPLATES = (
+    'arche_pas:templates/providers_login.pt',
+    'arche_pas:templates/providers_register.pt',
+    'arche_pas:templates/linked_accounts.pt',
+    'arche_pas:templates/link_form.pt',
+)
+IMPORTS = ('requests', 'requests_oauthlib', 'oauthlib.oauth2')
+MODES = ('startup', 'endpoint')
+
+
+def warm_templates(request):
+    """ Compile the templates used during login. """
+    for name in TEMPLATES:
+        template = get_renderer(name).implementation()
+        #Chameleon compiles on first render unless asked to
+        cook_check = getattr(template, 'cook_check', None)
+        if cook_check is not None:
+            cook_check()
+    return len(TEMPLATES)
+
+
+def warm_imports(request):
+    """ Import the OAuth libraries, they're otherwise imported on first use. """
+    for name in IMPORTS:
+        import_module(name)
+    return len(IMPORTS)
+
+
+def warm_indexes(request):
+    """ Load the PAS indexes into this connections cache, through queries so this
+        doesn't depend on how the indexes store things. Returns the number of docids loaded.
+    """
+    catalog = request.root.catalog
+    names = [name for (name, provider) in request.registry.getAdapters((request,), IPASProvider)]
+    count = len(catalog.query(Any('pas_providers', names))[1])
+    #pas_ident values can't be listed without loading the users, so load its docids instead
+    count += len(catalog['pas_ident'].docids())
+    return count
+
+
+def warm_connections(request, timeout=5):
+    """ Open a connection to each provider and keep it in the providers pool. """
+    count = 0
+    for (name, provider) in request.registry.getAdapters((request,), IPASProvider):
+        try:
+            session = provider.oauth2_session(provider.settings['client_id'])
+            session.head(provider.settings['token_uri'], timeout=timeout, allow_redirects=False)
+        except Exception as exc:
+            logger.warning("Warm-up couldn't connect to provider %r: %s", name, exc)
+        else:
+            count += 1
+    return count
+
+
+DEFAULT_STEPS = (
+    ('imports', warm_imports),
+    ('templates', warm_templates),
+    ('indexes', warm_indexes),
+    ('connections', warm_connections),
+)
+
+
+@implementer(IPASWarmup)
+class Warmup(object):
+    """ Runs steps once. A failing step is logged and doesn't stop the others,
+        the worker is usable either way.
+    """
+
+    def __init__(self, steps=DEFAULT_STEPS):
+        self.steps = steps
+        self.ready = False
+        self.started = False
+        self.thread = None
+        self.timings = {}
+        self.results = {}
+        self.errors = {}
+        #Held while the steps run
+        self._run_lock = Lock()
+        #Held while the state above changes, so status() gets a consistent copy
+        self._lock = Lock()
+
+    def run(self, request, blocking=True):
+        if not self._run_lock.acquire(blocking):
+            #Already running
+            return
+        try:
+            if self.ready:
+                return
+            start = time()
+            for (name, step) in self.steps:
+                step_start = time()
+                try:
+                    result = step(request)
+                except Exception as exc:
+                    logger.exception("Warm-up step %r failed", name)
+                    with self._lock:
+                        self.errors[name] = "%s" % exc
+                else:
+                    with self._lock:
+                        self.results[name] = result
+                with self._lock:
+                    self.timings[name] = round(time() - step_start, 4)
+            with self._lock:
+                self.timings['total'] = round(time() - start, 4)
+                self.ready = True
+            logger.info("Warm-up done in %.2f seconds: %s", self.timings['total'],
+                        ", ".join("%s %.3f" % (k, v) for (k, v) in sorted(self.timings.items()) if k != 'total'))
+        finally:
+            self._run_lock.release()
+
+    def start(self, registry):
+        """ Run in a background thread with a request of its own. Only the first call does anything. """
+        with self._lock:
+            if self.started:
+                return
+            self.started = True
+
+        def target():
+            env = prepare(registry=registry)
+            try:
+                self.run(env['request'])
+            finally:
+                env['closer']()
+
+        self.thread = Thread(target=target, name='arche_pas warm-up')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def status(self):
+        #Error messages may contain details about the setup, only say which steps failed
+        with self._lock:
+            return {'ready': self.ready,
+                    'timings': dict(self.timings),
+                    'results': dict(self.results),
+                    'failed': sorted(self.errors)}
+
+
+def get_warmup(registry):
+    return registry.queryUtility(IPASWarmup)
+
+
+def run_at_startup(event):
+    registry = event.app.registry
+    get_warmup(registry).start(registry)
+
+
+def ready_view(request):
+    warmup = get_warmup(request.registry)
+    if request.registry.settings.get('arche_pas.warmup') == 'endpoint':
+        #Warm up in the background, health checks shouldn't wait for the providers
+        warmup.start(request.registry)
+    status = warmup.status()
+    if not status['ready']:
+        request.response.status = 503
+    return status
+
+
+def includeme(config):
+    settings = config.registry.settings
+    mode = settings.get('arche_pas.warmup', '') or ''
+    if not mode:
+        return
+    if mode not in MODES:
+        raise ProviderConfigError("arche_pas.warmup must be one of %s" % ", ".join(MODES))
+    config.registry.registerUtility(Warmup(), IPASWarmup)
+    config.add_route('pas_ready', '/pas_ready')
+    config.add_view(ready_view, route_name='pas_ready', renderer='json', permission=NO_PERMISSION_REQUIRED)
+    if mode == 'startup':
+        config.add_subscriber(run_at_startup, IApplicationCreated)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+""" Background threads that work through a bounded queue, for things that
+    shouldn't add to the time a request takes.
+"""
+from __future__ import unicode_literals
+
+from threading import Lock
+from threading import Thread
+
+from six.moves import queue
+
+from arche_pas import logger
+
+
+class BackgroundWorker(object):
+    """ Calls handle with each submitted item in threads background threads.
+
+        At most queue_size items wait for a thread. When the queue is full,
+        submit returns False instead of blocking the request, and the caller
+        decides what dropping the item means. Exceptions from handle are
+        logged and don't stop the thread.
+    """
+
+    def __init__(self, handle, name, threads=1, queue_size=1000):
+        self.handle = handle
+        self.name = name
+        self.threads = threads
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = Lock()
+
+    def submit(self, item):
+        self._start()
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            return False
+        return True
+
+    def _start(self):
+        #Started on first use rather than at startup, so they're created after forking
+        if len(self._threads) < self.threads:
+            with self._lock:
+                while len(self._threads) < self.threads:
+                    thread = Thread(target=self._work, name='%s %s' % (self.name, len(self._threads)))
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                self.handle(item)
+            except Exception:
+                logger.exception("%s failed", self.name)
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        """ Wait until everything submitted has been handled. """
+        self.queue.join()
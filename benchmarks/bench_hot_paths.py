@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+""" Benchmarks for arche_pas hot paths.
+
+    Builds a site with synthetic users in a ZODB (MappingStorage or FileStorage),
+    times the hot paths and compares the results with a stored baseline.
+
+    Usage:
+        python benchmarks/bench_hot_paths.py --scales 1000,10000
+        python benchmarks/bench_hot_paths.py --save-baseline
+        python benchmarks/bench_hot_paths.py --storage file --threshold 1.5
+
+    Exit status is 1 if any hot path is slower than baseline * threshold.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import random
+import shutil
+import sys
+import tempfile
+from os import path
+from timeit import default_timer
+
+import transaction
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.MappingStorage import MappingStorage
+from arche.api import User
+from arche.testing import barebone_fixture
+from pyramid import testing
+from pyramid.request import apply_request_extensions
+
+from arche_pas.catalog import get_pas_ident
+from arche_pas.interfaces import IProviderData
+from arche_pas.models import PASProvider
+from arche_pas.models import get_register_case
+from arche_pas.views import LinkedAccountsInfo
+from arche_pas.views import inject_providers
+
+
+here = path.dirname(path.realpath(__file__))
+DEFAULT_BASELINE = path.join(here, 'baseline.json')
+DEFAULT_SCALES = (1000, 10000, 100000)
+#Registration params matching case 4
+REG_CASE_PARAMS = dict(
+    require_authenticated=False,
+    email_validated_provider=True,
+    user_exist_locally=False,
+    email_from_provider=True,
+    provider_validation_trusted=True,
+)
+
+
+class BenchProvider(PASProvider):
+    name = 'bench'
+    title = 'Bench'
+    id_key = 'id'
+    trust_email = True
+    settings = {
+        'client_id': 'bench',
+        'client_secret': 'bench',
+        'auth_uri': 'http://localhost/auth',
+        'token_uri': 'http://localhost/token',
+    }
+
+    def get_email(self, response, validated=False):
+        return response.get('email', None)
+
+
+class DummyForm(object):
+
+    def __init__(self, request):
+        self.request = request
+        self.form_options = {}
+
+
+def profile_data(i, extra=''):
+    return {
+        'id': 'ident-%s' % i,
+        'email': 'user%s@example.com' % i,
+        'firstName': 'First%s' % i,
+        'lastName': 'Last%s%s' % (i, extra),
+    }
+
+
+class Site(object):
+    """ Pyramid config, root and synthetic users stored in a ZODB. """
+
+    def __init__(self, scale, storage='mapping'):
+        self.scale = scale
+        self.tmpdir = None
+        if storage == 'file':
+            self.tmpdir = tempfile.mkdtemp(prefix='arche_pas_bench')
+            storage = FileStorage(path.join(self.tmpdir, 'Data.fs'))
+        else:
+            storage = MappingStorage()
+        self.db = DB(storage, cache_size=scale * 2)
+        self.config = testing.setUp()
+        self.config.include('pyramid_chameleon')
+        self.config.include('betahaus.viewcomponent')
+        self.config.include('arche.testing')
+        self.config.include('arche.testing.catalog')
+        self.config.include('arche_pas.models')
+        self.config.include('arche_pas.catalog')
+        self.config.include('arche_pas.registration_cases')
+        self.config.include('arche_pas.views')
+        self.config.registry.registerAdapter(BenchProvider, name=BenchProvider.name)
+        self.request = testing.DummyRequest()
+        apply_request_extensions(self.request)
+        self.config.begin(self.request)
+        self.conn = self.db.open()
+        root = barebone_fixture(self.config)
+        self.conn.root()['app_root'] = root
+        self.request.root = root
+        self.provider = BenchProvider(self.request)
+        users = root['users']
+        for i in range(scale):
+            user = User(email='user%s@example.com' % i)
+            IProviderData(user)[self.provider.name] = profile_data(i)
+            users['user%s' % i] = user
+            if i % 1000 == 999:
+                transaction.commit()
+        transaction.commit()
+
+    @property
+    def root(self):
+        return self.request.root
+
+    def close(self):
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+        testing.tearDown()
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir)
+
+
+def measure(func, number, repeat):
+    """ Best of repeat, as seconds per call. """
+    best = None
+    for r in range(repeat):
+        start = default_timer()
+        for i in range(number):
+            func(i)
+        elapsed = (default_timer() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run_scale(scale, storage='mapping', number=200, repeat=5):
+    site = Site(scale, storage=storage)
+    rnd = random.Random(scale)
+    picks = [rnd.randrange(scale) for x in range(number)]
+    users = site.root['users']
+    provider = site.provider
+    registry = site.config.registry
+    results = {}
+    try:
+        results['get_register_case'] = measure(
+            lambda i: get_register_case(registry=registry, **REG_CASE_PARAMS), number, repeat)
+        results['get_pas_ident'] = measure(
+            lambda i: get_pas_ident(users['user%s' % picks[i]], None), number, repeat)
+        results['get_user'] = measure(
+            lambda i: provider.get_user('ident-%s' % picks[i]), number, repeat)
+        results['store_unchanged'] = measure(
+            lambda i: provider.store(users['user%s' % picks[i]], profile_data(picks[i])), number, repeat)
+        counter = iter(range(number * repeat))
+
+        def store_changed(i):
+            provider.store(users['user%s' % picks[i]], profile_data(picks[i], next(counter)))
+            #Reindexing happens on commit
+            transaction.commit()
+
+        results['store_changed'] = measure(store_changed, number, repeat)
+        results['linked_accounts_info'] = measure(
+            lambda i: LinkedAccountsInfo(users['user%s' % picks[i]], site.request)(), number, repeat)
+        results['inject_providers'] = measure(
+            lambda i: inject_providers(DummyForm(site.request), "arche_pas:templates/providers_login.pt"),
+            number, repeat)
+    finally:
+        site.close()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Return a list of (scale, name, current, baseline) that regressed. """
+    regressions = []
+    for (scale, timings) in results.items():
+        for (name, current) in timings.items():
+            previous = baseline.get(scale, {}).get(name, None)
+            if previous and current > previous * threshold:
+                regressions.append((scale, name, current, previous))
+    return regressions
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description="Benchmark arche_pas hot paths")
+    parser.add_argument('--scales', default=",".join(str(x) for x in DEFAULT_SCALES),
+                        help="Comma separated number of synthetic users")
+    parser.add_argument('--storage', choices=('mapping', 'file'), default='mapping')
+    parser.add_argument('--number', type=int, default=200, help="Calls per measurement")
+    parser.add_argument('--repeat', type=int, default=5, help="Measurements, best is kept")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="Fail if slower than baseline times this")
+    args = parser.parse_args(argv[1:])
+    results = {}
+    for scale in [int(x) for x in args.scales.split(',')]:
+        print("Running with %s users..." % scale)
+        results[str(scale)] = run_scale(scale, storage=args.storage, number=args.number, repeat=args.repeat)
+        for (name, value) in sorted(results[str(scale)].items()):
+            print("  %-24s %10.1f us" % (name, value * 1000000))
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Baseline saved to %s" % args.baseline)
+        return 0
+    if not path.isfile(args.baseline):
+        print("No baseline found at %s, run with --save-baseline first" % args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    for (scale, name, current, previous) in regressions:
+        print("REGRESSION %s users %s: %.1f us, baseline %.1f us" % (
+            scale, name, current * 1000000, previous * 1000000))
+    return regressions and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
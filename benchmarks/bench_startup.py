@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+""" Startup benchmark for arche_pas.
+
+    Times config.include('arche_pas') with all bundled providers enabled, each run
+    in a fresh interpreter so nothing is already imported. Also reports whether
+    the OAuth libraries were imported during startup, they shouldn't be.
+
+    Usage:
+        python benchmarks/bench_startup.py --repeat 20
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+from os import path
+
+
+BUNDLED_PROVIDERS = (
+    'arche_pas.providers.facebook',
+    'arche_pas.providers.gamma',
+    'arche_pas.providers.google_oauth2',
+    'arche_pas.providers.wp_oauth2',
+    'arche_pas.providers.fake',
+)
+#Modules that should only be imported on first begin() or callback()
+LAZY_MODULES = ('requests', 'requests_oauthlib')
+#Runs in the child process. Everything arche_pas depends on is set up before timing starts.
+CHILD = """
+import json, sys
+from timeit import default_timer
+from pyramid import testing
+settings = json.loads(sys.argv[1])
+config = testing.setUp(settings=settings)
+config.include('pyramid_chameleon')
+config.include('betahaus.viewcomponent')
+config.include('arche.testing')
+config.include('arche.testing.catalog')
+config.commit()
+before = set(sys.modules)
+start = default_timer()
+config.include('arche_pas')
+config.commit()
+seconds = default_timer() - start
+print(json.dumps({
+    'seconds': seconds,
+    'imported': sorted(x for x in set(sys.modules) - before if sys.modules[x] is not None),
+}))
+"""
+
+
+def write_provider_files(directory):
+    """ Dummy settings for each provider, good enough to pass validation. """
+    rows = []
+    for name in BUNDLED_PROVIDERS:
+        filename = path.join(directory, name.rsplit('.', 1)[-1] + '.json')
+        with open(filename, 'w') as f:
+            json.dump({
+                'client_id': 'bench',
+                'client_secret': 'bench',
+                'auth_uri': 'https://localhost/auth',
+                'token_uri': 'https://localhost/token',
+                'profile_uri': 'https://localhost/profile',
+            }, f)
+        rows.append("%s %s" % (name, filename))
+    return "\n".join(rows)
+
+
+def run_once(settings):
+    output = subprocess.check_output([sys.executable, '-c', CHILD, json.dumps(settings)])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description="Time arche_pas startup with all bundled providers.")
+    parser.add_argument('--repeat', type=int, default=10,
+                        help="Number of fresh processes to time.")
+    args = parser.parse_args(argv[1:])
+    directory = tempfile.mkdtemp(prefix='arche_pas_bench_')
+    try:
+        settings = {'arche_pas.providers': write_provider_files(directory)}
+        results = [run_once(settings) for i in range(args.repeat)]
+    finally:
+        shutil.rmtree(directory)
+    timings = [x['seconds'] * 1000 for x in results]
+    print("includeme with %s providers, %s runs" % (len(BUNDLED_PROVIDERS), len(timings)))
+    print("  min %.1f ms, median %.1f ms, p90 %.1f ms" % (
+        min(timings), percentile(timings, 50), percentile(timings, 90)))
+    imported = results[-1]['imported']
+    print("  %s modules imported" % len(imported))
+    eager = [x for x in LAZY_MODULES if x in imported]
+    if eager:
+        print("  Imported during startup: %s" % ", ".join(eager))
+        return 1
+    print("  OAuth libraries not imported during startup")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
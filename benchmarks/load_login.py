@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+""" End-to-end login load harness.
+
+    Serves the Pyramid app from a paster .ini and the fake identity provider
+    locally, then runs begin -> callback -> register/login cycles against them.
+
+    The .ini must enable the fake provider and allow insecure transport:
+
+        arche_pas.providers =
+            arche_pas.providers.fake %(here)s/fake.json
+        arche_pas.insecure_transport = true
+
+    Usage:
+        python benchmarks/load_login.py development.ini --cycles 5000 --concurrency 8 --users 1000
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import re
+import sys
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from threading import Thread
+from timeit import default_timer
+
+import requests
+from pyramid.config import Configurator
+from pyramid.paster import get_app
+from pyramid.paster import setup_logging
+from ZODB.POSException import ConflictError
+
+from arche_pas.fake_idp import FakeIdP
+from arche_pas.fake_idp import make_threaded_server
+
+
+INPUT_RE = re.compile(r'<input[^>]*>', re.I)
+ATTR_RE = re.compile(r'(name|value|type)="([^"]*)"', re.I)
+
+
+class ConflictCounter(object):
+    """ Counts ZODB conflicts, both retried ones and the ones that reached the client. """
+
+    def __init__(self):
+        self.retried = 0
+        self.failed = 0
+        self._lock = Lock()
+
+    def before_retry(self, event):
+        if isinstance(getattr(event, 'exception', None), ConflictError):
+            with self._lock:
+                self.retried += 1
+
+    def middleware(self, app):
+        def wrapper(environ, start_response):
+            try:
+                return app(environ, start_response)
+            except ConflictError:
+                with self._lock:
+                    self.failed += 1
+                raise
+        return wrapper
+
+
+def install_conflict_counter(app, counter):
+    try:
+        from pyramid_retry import IBeforeRetry
+    except ImportError:  # pragma: no coverage
+        print("pyramid_retry not installed, only counting conflicts that reach the client")
+        return
+    config = Configurator(registry=app.registry)
+    config.add_subscriber(counter.before_retry, IBeforeRetry)
+    config.commit()
+
+
+def form_fields(html):
+    fields = {}
+    for tag in INPUT_RE.findall(html):
+        attrs = dict((k.lower(), v) for (k, v) in ATTR_RE.findall(tag))
+        if 'name' in attrs and attrs.get('type', '').lower() not in ('submit', 'button', 'checkbox'):
+            fields[attrs['name']] = attrs.get('value', '')
+    return fields
+
+
+def cycle(app_url, ident):
+    """ Run one begin -> callback -> register/login cycle. Returns outcome. """
+    session = requests.Session()
+    response = session.get(app_url + '/pas_begin/fake', params={'login_hint': ident},
+                           allow_redirects=False)
+    if response.status_code != 302:
+        return 'begin_error'
+    # Authorize at the IdP, which redirects back to pas_callback
+    response = session.get(response.headers['Location'], allow_redirects=False)
+    if response.status_code != 302:
+        return 'authorize_error'
+    response = session.get(response.headers['Location'], allow_redirects=False)
+    if response.status_code != 302:
+        return 'callback_error'
+    location = response.headers['Location']
+    if '/pas_register/' not in location:
+        return 'login'
+    response = session.get(location)
+    fields = form_fields(response.text)
+    fields['userid'] = 'fake_%s' % ident
+    fields['register'] = 'register'
+    response = session.post(location, data=fields, allow_redirects=False)
+    if response.status_code == 302 and '/pas_register/' not in response.headers['Location']:
+        return 'register'
+    return 'register_error'
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return value
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description="Run login cycles against a local app")
+    parser.add_argument('config_uri', help="Paster .ini file")
+    parser.add_argument('--cycles', type=positive_int, default=1000)
+    parser.add_argument('--concurrency', type=positive_int, default=4)
+    parser.add_argument('--users', type=positive_int, default=100,
+                        help="Number of distinct identities. First cycle per identity registers.")
+    parser.add_argument('--app-port', type=int, default=6544)
+    parser.add_argument('--idp-port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="IdP latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="IdP error rate")
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    app = get_app(args.config_uri)
+    counter = ConflictCounter()
+    install_conflict_counter(app, counter)
+    app_server = make_threaded_server(counter.middleware(app), port=args.app_port)
+    idp = FakeIdP(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=1)
+    idp_server = make_threaded_server(idp, port=args.idp_port)
+    for server in (app_server, idp_server):
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    app_url = 'http://127.0.0.1:%s' % args.app_port
+
+    def _run(i):
+        start = default_timer()
+        try:
+            outcome = cycle(app_url, 'user%s' % (i % args.users))
+        except requests.RequestException:
+            outcome = 'connection_error'
+        return outcome, default_timer() - start
+
+    pool = ThreadPool(args.concurrency)
+    start = default_timer()
+    results = pool.map(_run, range(args.cycles), chunksize=1)
+    elapsed = default_timer() - start
+    pool.close()
+    app_server.shutdown()
+    idp_server.shutdown()
+
+    outcomes = Counter(outcome for (outcome, seconds) in results)
+    latencies = sorted(seconds for (outcome, seconds) in results)
+    print("Cycles:      %s in %.1f s" % (args.cycles, elapsed))
+    print("Throughput:  %.1f cycles/s" % (args.cycles / elapsed))
+    for pct in (50, 90, 99):
+        print("p%s latency: %.1f ms" % (pct, percentile(latencies, pct) * 1000))
+    print("Max latency: %.1f ms" % (latencies[-1] * 1000))
+    for (outcome, count) in sorted(outcomes.items()):
+        print("%-12s %s" % (outcome + ':', count))
+    print("ZODB conflicts retried: %s, failed: %s" % (counter.retried, counter.failed))
+    print("IdP requests: %s" % idp.stats)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
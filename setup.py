@@ -9,7 +9,8 @@ CHANGES = open(os.path.join(here, 'CHANGES.rst')).read()
 requires = ('Arche',
             'requests_oauthlib',
             'colander',
-            'pyramid>=1.8'
+            'pyramid>=1.8',
+            'transaction>=2.1',
             )
 
 
@@ -32,10 +33,26 @@ setup(name='arche_pas',
       include_package_data=True,
       zip_safe=False,
       install_requires=requires,
+      extras_require={
+          'token_vault': ['cryptography'],
+          'avatars': ['Pillow'],
+          'bearer_jwt': ['PyJWT', 'cryptography'],
+      },
       tests_require=requires,
       test_suite="arche_pas",
       entry_points = """\
       [fanstatic.libraries]
       arche_pas = arche_pas.fanstatic_lib:library
+      [console_scripts]
+      arche_pas_refresh_tokens = arche_pas.scripts:refresh_tokens_script
+      arche_pas_refresh_profiles = arche_pas.scripts:refresh_profiles_script
+      arche_pas_import_links = arche_pas.scripts:import_links_script
+      arche_pas_remove_providers = arche_pas.scripts:remove_providers_script
+      arche_pas_export = arche_pas.scripts:export_script
+      arche_pas_backfill_summary = arche_pas.scripts:backfill_summary_script
+      arche_pas_reindex_providers = arche_pas.scripts:reindex_providers_script
+      arche_pas_aggregate_logins = arche_pas.scripts:aggregate_logins_script
+      arche_pas_audit = arche_pas.scripts:audit_query_script
+      arche_pas_replay = arche_pas.scripts:replay_script
       """,
       )